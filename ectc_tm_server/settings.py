@@ -90,6 +90,29 @@ TEMPLATES = [
 WSGI_APPLICATION = 'ectc_tm_server.wsgi.application'
 
 
+# Cache
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+#
+# The tournament snapshots and brackets are cached under versions that are
+# bumped by whichever process changes the data (web workers, management
+# commands), so the cache must be shared between processes; the default
+# per-process LocMemCache would keep serving stale data. The table is
+# created by `manage.py createcachetable`. MAX_ENTRIES must leave room for
+# the change log of each tournament (tournament_snapshot.CHANGE_LOG_SIZE
+# entries) besides the snapshots and brackets of the past hour, or the log
+# is culled and clients have to reload the snapshot. db_settings.py may
+# override CACHES (e.g. with a redis cache).
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'tmdb_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 20000,
+        },
+    },
+}
+
 # Database
 # https://docs.djangoproject.com/en/1.8/ref/settings/#databases
 
@@ -185,5 +208,12 @@ CHANNEL_LAYERS = {
         },
     },
 }
+if 'test' in sys.argv:
+    # the tests broadcast match updates without a redis server
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+        },
+    }
 
 ASGI_APPLICATION = 'ectc_tm_server.routing.application'
@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+class TmdbConfig(AppConfig):
+    name = 'tmdb'
+
+    def ready(self):
+        # connects the receivers that invalidate cached tournament snapshots
+        # and brackets
+        from tmdb import bracket_cache, tournament_snapshot
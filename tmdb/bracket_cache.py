@@ -0,0 +1,192 @@
+"""
+The bracket of a division, as shown by the bracket view: its layout (the
+columns of cells of each round) and the HTML fragment rendered from it.
+
+Brackets are cached per division under a version number which is
+incremented in the database (once the transaction commits) whenever the
+matches or the registrations of the division change, like the tournament
+snapshots of tournament_snapshot. As for those, the cache must be shared
+between processes (see CACHES in settings.py), so that a bracket changed
+by a management command is not served stale by the web server. A bracket is
+built from one query for the matches and one for the registrations, with
+their teams and schools.
+"""
+
+import threading
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.template.loader import render_to_string
+
+from tmdb import models
+from tmdb.tournament_snapshot import initial_version
+
+BRACKET_TIMEOUT = 60 * 60
+
+def _version_key(tournament_division_id):
+    return "bracket-version-%d" %(tournament_division_id,)
+
+def _bracket_key(tournament_division_id, version):
+    return "bracket-%d-%d" %(tournament_division_id, version)
+
+def get_version(tournament_division_id):
+    return models.CacheVersion.get_version(
+            _version_key(tournament_division_id), initial_version())
+
+def bump_version(tournament_division_id):
+    return models.CacheVersion.bump_version(
+            _version_key(tournament_division_id), initial_version())
+
+def _team_cell(team_registration):
+    if team_registration is None:
+        return None
+    return {'pk': team_registration.pk,
+            'bracket_str': team_registration.bracket_str()}
+
+def get_lowest_bye_seed(team_registrations, team_matches):
+    """Returns the lowest seed of team_registrations that is not in a
+    match of the first round of team_matches."""
+    if not team_matches:
+        return 1
+    max_round_num = max(team_match.round_num for team_match in team_matches)
+    seeds = {tr.seed for tr in team_registrations if tr.seed}
+    max_seed = max(seeds)
+    for team_match in team_matches:
+        if team_match.round_num != max_round_num:
+            continue
+        if team_match.blue_team:
+            seeds.remove(team_match.blue_team.seed)
+        if team_match.red_team:
+            seeds.remove(team_match.red_team.seed)
+    if not seeds:
+        return max_seed
+    return max(seeds)
+
+def build_bracket(tournament_division):
+    """
+    Returns the bracket of tournament_division: {'columns': the cells of
+    each round, from the first to the final, 'column_height', 'html': the
+    rendered columns, 'unassigned_teams' and 'lowest_bye_seed'}.
+    """
+    team_registrations = {tr.pk: tr for tr in models.SparringTeamRegistration\
+            .objects.filter(tournament_division=tournament_division)\
+            .select_related('team__school', 'team__division')}
+    team_matches = list(models.SparringTeamMatch.objects.filter(
+            division=tournament_division))
+    matches = {}
+    num_rounds = 0
+    for team_match in team_matches:
+        team_match.blue_team = team_registrations.get(team_match.blue_team_id)
+        team_match.red_team = team_registrations.get(team_match.red_team_id)
+        matches[(team_match.round_num, team_match.round_slot)] = team_match
+        num_rounds = max(num_rounds, team_match.round_num)
+
+    columns = []
+    for round_num in reversed(range(num_rounds + 1)):
+        round_num_matches = 2**round_num
+        column = []
+        columns.append(column)
+        for round_slot in range(round_num_matches):
+            match = matches.get((round_num, round_slot))
+            cell = {'pk': None, 'number': None, 'round_num': round_num,
+                    'round_slot': round_slot, 'blue_team': None,
+                    'red_team': None,
+                    'height': str(100 / (round_num_matches)) + "%"}
+            cell_type = []
+            if match is None:
+                cell_type.append("bracket_cell_without_match")
+            else:
+                cell.update(pk=match.pk, number=match.number,
+                        blue_team=_team_cell(match.blue_team),
+                        red_team=_team_cell(match.red_team))
+                cell_type.append("bracket_cell_with_match")
+            if round_slot % 2:
+                cell_type.append("lower_child_cell")
+            else:
+                cell_type.append("upper_child_cell")
+            cell['cell_type'] = " ".join(cell_type)
+            column.append(cell)
+    if (0, 0) in matches:
+        columns[-1][0]['cell_type'] = "bracket_cell_with_match" \
+                + " bracket_finals_cell"
+
+    bracket = {
+        'columns': columns,
+        'column_height': str(64 * 2**num_rounds) + "px",
+        'unassigned_teams': [str(tr) for tr in sorted(
+                team_registrations.values(),
+                key=lambda tr: (tr.team.school.name, tr.team.number))
+                if tr.seed is None],
+        'lowest_bye_seed': get_lowest_bye_seed(team_registrations.values(),
+                team_matches),
+    }
+    bracket['html'] = render_to_string('tmdb/bracket_fragment.html',
+            dict(bracket, tournament_division=tournament_division))
+    return bracket
+
+def get_bracket(tournament_division):
+    """Returns the bracket (see build_bracket) of tournament_division,
+    from the cache if its version is there."""
+    key = _bracket_key(tournament_division.pk,
+            get_version(tournament_division.pk))
+    bracket = cache.get(key)
+    if bracket is None:
+        bracket = build_bracket(tournament_division)
+        cache.set(key, bracket, BRACKET_TIMEOUT)
+    return bracket
+
+_get_tournament_division_ids = {
+    models.TournamentSparringDivision:
+            lambda tournament_division: [tournament_division.pk],
+    models.SparringTeamMatch: lambda match: [match.division_id],
+    models.SparringTeamRegistration:
+            lambda registration: [registration.tournament_division_id],
+    models.SparringTeam: lambda team: models.SparringTeamRegistration\
+            .objects.filter(team=team)\
+            .values_list('tournament_division', flat=True),
+    models.School: lambda school: models.SparringTeamRegistration\
+            .objects.filter(team__school=school)\
+            .values_list('tournament_division', flat=True),
+}
+
+_changed_divisions = threading.local()
+
+def _bump_changed_divisions():
+    tournament_division_ids = getattr(_changed_divisions,
+            'tournament_division_ids', None)
+    if not tournament_division_ids:
+        return
+    _changed_divisions.tournament_division_ids = set()
+    for tournament_division_id in tournament_division_ids:
+        bump_version(tournament_division_id)
+
+def invalidate_divisions(tournament_division_ids):
+    """Bumps the versions of the brackets of tournament_division_ids once
+    the transaction commits, once per division however often it changes."""
+    if not hasattr(_changed_divisions, 'tournament_division_ids'):
+        _changed_divisions.tournament_division_ids = set()
+    _changed_divisions.tournament_division_ids.update(tournament_division_ids)
+    transaction.on_commit(_bump_changed_divisions)
+
+def invalidate_bracket(sender, instance, **kwargs):
+    invalidate_divisions(_get_tournament_division_ids[sender](instance))
+
+for sender in _get_tournament_division_ids:
+    post_save.connect(invalidate_bracket, sender=sender,
+            dispatch_uid="invalidate_bracket_on_save")
+    post_delete.connect(invalidate_bracket, sender=sender,
+            dispatch_uid="invalidate_bracket_on_delete")
+
+@receiver(models.division_matches_rebuilt,
+        sender=models.TournamentSparringDivision,
+        dispatch_uid="invalidate_bracket_on_rebuild")
+def invalidate_bracket_on_rebuild(sender, tournament_division, **kwargs):
+    invalidate_divisions([tournament_division.pk])
+
+@receiver(models.tournament_data_changed, sender=models.Tournament,
+        dispatch_uid="invalidate_brackets_on_change")
+def invalidate_brackets_on_change(sender, tournament_id, **kwargs):
+    invalidate_divisions(models.TournamentSparringDivision.objects.filter(
+            tournament_id=tournament_id).values_list('id', flat=True))
@@ -1,76 +1,291 @@
 import json
 
-from django.core import serializers
-from django.db.models.signals import post_save, post_delete
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
 from django.dispatch import receiver
-from channels.generic.websocket import WebsocketConsumer
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from asgiref.sync import async_to_sync, sync_to_async
 
-from . import models
-from .views.tournament_view import json_fields
+from . import match_queue, models, tournament_snapshot
 
-def match_updates_group_name(tournament_slug):
-    return "match-updates-%s" %(tournament_slug,)
+def match_updates_group_name(tournament_id, ring_number=None,
+        division_id=None):
+    """
+    Returns the name of the group of the clients that receive every match
+    update of tournament_id or, given ring_number or division_id, only the
+    updates of the matches at that ring or in that division.
+    """
+    if ring_number is not None:
+        return "match-updates-%d-ring-%d" %(tournament_id, ring_number)
+    if division_id is not None:
+        return "match-updates-%d-division-%d" %(tournament_id, division_id)
+    return "match-updates-%d" %(tournament_id,)
 
-def create_message(message_type, message_content, dump_message_content=True):
+def scoped_match_updates_group_name(tournament_id):
+    """Returns the name of the group of all the clients of a ring or
+    division group, which receive the rebuilds and resyncs of the
+    tournament."""
+    return "match-updates-%d-scoped" %(tournament_id,)
+
+def get_scoped_updates(tournament_id, compact_matches, previous_ring_numbers):
+    """
+    Splits the compact rows of an update among the ring and division groups
+    of tournament_id. A match is sent to the group of its ring, to the
+    groups of the rings it left (previous_ring_numbers) and to the group of
+    its division. Returns {group name: compact rows}.
+    """
+    field_names = compact_matches['fields']
+    ring_index = field_names.index('ring_number') + 1
+    division_index = field_names.index('division') + 1
+    group_rows = {}
+    for row in compact_matches['rows']:
+        ring_numbers = set(previous_ring_numbers.get(row[0], ()))
+        if row[ring_index] is not None:
+            ring_numbers.add(row[ring_index])
+        group_names = [match_updates_group_name(tournament_id,
+                ring_number=ring_number) for ring_number in ring_numbers]
+        group_names.append(match_updates_group_name(tournament_id,
+                division_id=row[division_index]))
+        for group_name in group_names:
+            group_rows.setdefault(group_name, []).append(row)
+    return {group_name: dict(compact_matches, rows=rows)
+            for group_name, rows in group_rows.items()}
+
+def create_message(message_type, message_content, dump_message_content=True,
+        version=None, message_id=None, previous_version=None):
     if dump_message_content:
         message_content = json.dumps(message_content)
-    return json.dumps({
+    message = {
             'message_type': message_type,
-            'message_content': message_content})
-
-@receiver([post_save, post_delete], sender=models.SparringTeamMatch,
-        dispatch_uid="update_team_match")
-def update_team_match(sender, instance, **kwargs):
-    team_match_json = json.loads(serializers.serialize('json', [instance],
-            fields = json_fields['team_match']))
-    tournament_slug = instance.division.tournament.slug
-    group_name = match_updates_group_name(tournament_slug)
-    async_to_sync(get_channel_layer().group_send)(group_name, {
-        'type': 'update_sparring_team_match',
-        'message': create_message('update', team_match_json,
-            dump_message_content=False)
-    })
-
-class SparringTeamMatchConsumer(WebsocketConsumer):
-    def connect(self):
+            'message_content': message_content}
+    if version is not None:
+        message['version'] = version
+    if previous_version is not None:
+        message['previous_version'] = previous_version
+    if message_id is not None:
+        message['message_id'] = message_id
+    return json.dumps(message, cls=DjangoJSONEncoder, separators=(',', ':'))
+
+@receiver(tournament_snapshot.tournament_changed, sender=models.Tournament,
+        dispatch_uid="send_tournament_change")
+def send_tournament_change(sender, tournament_id, version, change,
+        previous_ring_numbers=None, **kwargs):
+    """
+    Sends a change to the clients of every match of the tournament. Updates
+    are also sent, split by ring and division, to the clients of only those
+    matches, so that the tablet of a ring does not receive the results of
+    every other ring; such a client skips the versions of the other rings
+    (see SparringTeamMatchConsumer.update_sparring_team_match). The rarer
+    rebuilds and resyncs go to every scoped client.
+    """
+    if change is None:
+        # clients have to load a new snapshot to see this change
+        change = {'message_type': 'resync', 'message_content': None}
+    group_contents = {
+        match_updates_group_name(tournament_id): change['message_content'],
+    }
+    if change['message_type'] == 'update':
+        group_contents.update(get_scoped_updates(tournament_id,
+                change['message_content'], previous_ring_numbers or {}))
+    else:
+        group_contents[scoped_match_updates_group_name(tournament_id)] = \
+                change['message_content']
+    group_send = async_to_sync(get_channel_layer().group_send)
+    for group_name, message_content in group_contents.items():
+        group_send(group_name, {
+            'type': 'update_sparring_team_match',
+            'message': create_message(change['message_type'],
+                    message_content, dump_message_content=False,
+                    version=version)
+        })
+
+class SparringTeamMatchConsumer(AsyncWebsocketConsumer):
+    """
+    Sends the match updates of a tournament to the match list. Runs in the
+    event loop, so connected clients do not hold threads; only the database
+    and cache accesses run in threads.
+    """
+    async def connect(self):
         self.tournament_slug = self.scope['url_route']['kwargs']['tournament_slug']
-        self.sparring_team_match_group = match_updates_group_name(
-                self.tournament_slug)
-        async_to_sync(self.channel_layer.group_add)(
-                self.sparring_team_match_group, self.channel_name)
-        self.accept()
-
-    def disconnect(self, close_code):
-        async_to_sync(self.channel_layer.group_discard)(
-                self.sparring_team_match_group, self.channel_name)
-
-    def receive(self, text_data):
-        if not self.scope['user'].has_perm('tmdb.change_sparringteammatch'):
-            err_msg = str(self.scope['user'])
-            err_msg += " does not have permission to change this value"
-            self.send(create_message('error', err_msg))
+        self.tournament_id = await database_sync_to_async(
+                SparringTeamMatchConsumer.get_tournament_id)(
+                        self.tournament_slug)
+        if self.tournament_id is None:
+            await self.close()
             return
+        self.subscription = None
+        # the version of the last change sent to a subscribed client
+        self.sent_version = None
+        self.sparring_team_match_groups = []
+        await self.join_groups([match_updates_group_name(self.tournament_id)])
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        if self.tournament_id is None:
+            return
+        await self.join_groups([])
+
+    async def join_groups(self, group_names):
+        """Moves this client from the groups it is in to group_names."""
+        # joining first, so that no change is missed in between
+        for group_name in group_names:
+            if group_name not in self.sparring_team_match_groups:
+                await self.channel_layer.group_add(group_name,
+                        self.channel_name)
+        for group_name in self.sparring_team_match_groups:
+            if group_name not in group_names:
+                await self.channel_layer.group_discard(group_name,
+                        self.channel_name)
+        self.sparring_team_match_groups = group_names
+
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            SparringTeamMatchConsumer.process_update_message(text_data)
-        except Exception as e:
-            self.send(create_message('error', str(e)))
+            message = json.loads(text_data)
+        except (TypeError, ValueError) as e:
+            await self.send(text_data=create_message('error',
+                    "Invalid message: %s" %(e,)))
             return
+        message_type = None
+        if isinstance(message, dict):
+            message_type = message.get('message_type')
+        if message_type == 'sync':
+            reply = await sync_to_async(
+                    SparringTeamMatchConsumer.create_sync_message)(
+                            self.tournament_id, message.get('version'),
+                            self.subscription)
+        elif message_type == 'subscribe':
+            reply = await self.subscribe(message)
+        elif message_type == 'update':
+            reply = await database_sync_to_async(
+                    SparringTeamMatchConsumer.process_update)(
+                            self.scope['user'], message)
+        else:
+            reply = create_message('error', "Unknown message type: %s" %(
+                    message_type,))
+        await self.send(text_data=reply)
 
-    def update_sparring_team_match(self, event):
+    async def update_sparring_team_match(self, event):
+        """
+        Sends a change to the client, filtered by its subscription. A client
+        of a ring or division group only receives the versions of its
+        matches, so each change it is sent carries the previous_version it
+        was sent: the versions in between did not concern it, and it only
+        has to sync if it has not seen previous_version.
+        """
         message = event['message']
-        self.send(text_data=message)
+        if self.subscription is not None:
+            message = json.loads(message)
+            # the change of a match of both the ring and the division of the
+            # client is received from both groups
+            version = message.get('version')
+            if version is not None and self.sent_version is not None \
+                    and version <= self.sent_version:
+                return
+            previous_version = self.sent_version
+            self.sent_version = version
+            message = create_message(message['message_type'],
+                    self.subscription.filter_change(message)[
+                            'message_content'],
+                    dump_message_content=False, version=version,
+                    previous_version=previous_version)
+        await self.send(text_data=message)
+
+    async def subscribe(self, message):
+        """
+        Scopes the updates sent to this client to the matches passing the
+        match queue filter in message (see MatchQueueFilter.from_params),
+        plus match_ids, the matches the client already has. An empty filter
+        subscribes to every match.
+
+        A client filtering by ring or division joins the groups of that ring
+        or division, which only receive the changes of their matches, and
+        the scoped group, which receives the rebuilds and resyncs.
+        """
+        try:
+            queue_filter = match_queue.MatchQueueFilter.from_params(
+                    message.get('filter') or {})
+        except ValidationError as e:
+            return create_message('error', " ".join(e.messages))
+        if queue_filter.ring_number is not None \
+                or queue_filter.division_id is not None:
+            await self.join_groups([
+                match_updates_group_name(self.tournament_id,
+                        ring_number=queue_filter.ring_number,
+                        division_id=queue_filter.division_id),
+                scoped_match_updates_group_name(self.tournament_id),
+            ])
+        else:
+            await self.join_groups([
+                    match_updates_group_name(self.tournament_id)])
+        # the versions sent from now on follow the new filter
+        self.sent_version = None
+        if queue_filter.is_empty():
+            self.subscription = None
+        else:
+            school_ids = {}
+            if queue_filter.school_id is not None:
+                school_ids = await database_sync_to_async(
+                        match_queue.get_school_ids)(self.tournament_id)
+            self.subscription = match_queue.MatchQueueSubscription(
+                    queue_filter, school_ids, message.get('match_ids', ()))
+        return create_message('subscribed', message.get('filter'),
+                dump_message_content=False)
+
+    @staticmethod
+    def get_tournament_id(tournament_slug):
+        return models.Tournament.objects.filter(
+                slug=tournament_slug).values_list('id', flat=True).first()
+
+    @staticmethod
+    def process_update(user, message):
+        """
+        Applies an update message from user,
+        {"message_type": "update", "message_id": ..., "updates": [
+            {"id": match id, "fields": {field: value}, "version": version},
+        ]}, in one transaction. Returns an "ack" with the changed matches or
+        an "error" reply, either carrying the message_id.
+        """
+        message_id = message.get('message_id')
+        if not user.has_perm('tmdb.change_sparringteammatch'):
+            err_msg = str(user)
+            err_msg += " does not have permission to change this value"
+            return create_message('error', err_msg, message_id=message_id)
+        try:
+            changed_matches = models.SparringTeamMatch.apply_updates([
+                    (update['id'], update['fields'], update.get('version'))
+                    for update in message['updates']])
+        except Exception as e:
+            return create_message('error', str(e), message_id=message_id)
+        return create_message('ack', tournament_snapshot.compact_values(
+                models.SparringTeamMatch.objects.filter(pk__in=[
+                        match.pk for match in changed_matches]),
+                tournament_snapshot.json_fields['team_match']),
+                dump_message_content=False, message_id=message_id)
 
     @staticmethod
-    def process_update_message(text_data):
-        raw_msgs = json.loads(text_data)
-        parsed_msgs = serializers.deserialize('json', text_data)
-        for raw_msg, parsed_msg in zip(raw_msgs, parsed_msgs):
-            model_class = type(parsed_msg.object)
-            model_instance = model_class.objects.get(pk=parsed_msg.object.pk)
-            for model_attr in raw_msg['fields'].keys():
-                model_attr_value = getattr(parsed_msg.object, model_attr)
-                setattr(model_instance, model_attr, model_attr_value)
-            model_instance.clean()
-            model_instance.save()
+    def create_sync_message(tournament_id, since_version, subscription=None):
+        """
+        Returns the changes a client that has loaded the snapshot at
+        since_version has missed, scoped to its subscription, or tells it
+        to load a new snapshot if they are not all in the change log, or
+        since_version is missing or not an integer.
+        """
+        changes = None
+        try:
+            since_version = int(since_version)
+        except (TypeError, ValueError):
+            since_version = None
+        if since_version is not None:
+            changes = tournament_snapshot.get_changes(tournament_id,
+                    since_version)
+        if changes is None:
+            return create_message('snapshot_required', None,
+                    dump_message_content=False)
+        version, changes = changes
+        if subscription is not None:
+            changes = [subscription.filter_change(change)
+                    for change in changes]
+        return create_message('changes', changes, dump_message_content=False,
+                version=version)
@@ -1,4 +1,5 @@
 from django import forms
+from django.db import transaction
 import datetime
 
 from tmdb import models
@@ -33,6 +34,29 @@ class MatchForm(forms.ModelForm):
             self.cleaned_data['ring_assignment_time'] = datetime.datetime.now()
         return super(MatchForm, self).clean()
 
+    def save(self, commit=True):
+        """
+        Saves the ring status of the match. A new winning team is recorded
+        with SparringTeamMatch.record_result, in the same transaction, so
+        that the match and the match the winner advances to are locked and
+        checked against the version of the match that was read. Raises
+        IntegrityError if the result cannot be recorded.
+        """
+        team_match = super(MatchForm, self).save(commit=False)
+        if not commit:
+            return team_match
+        update_fields = [field_name for field_name in self.changed_data
+                if field_name != 'winning_team']
+        if 'ring_number' in update_fields:
+            update_fields.append('ring_assignment_time')
+        with transaction.atomic():
+            if 'winning_team' in self.changed_data:
+                models.SparringTeamMatch.record_result(team_match.pk,
+                        team_match.winning_team_id, team_match.version)
+            if update_fields:
+                team_match.save(update_fields=update_fields)
+        return team_match
+
     class Meta:
         model = models.SparringTeamMatch
         fields = ['ring_number', 'ring_assignment_time', 'winning_team', 'in_holding']
@@ -49,9 +73,25 @@ class ConfigurationSetting(forms.ModelForm):
             'value': ''
         }
 
+def confirm_lost_match_results(form, tournament_division, seeds):
+    """
+    Raises a ValidationError, and shows the form's confirm_delete_matches
+    checkbox, if regenerating the bracket of tournament_division from seeds
+    would erase match results.
+    """
+    lost_results = tournament_division.diff_matches_from_slots(
+            seeds).lost_results
+    if not lost_results:
+        return
+    form.fields['confirm_delete_matches'].widget = forms.CheckboxInput()
+    raise forms.ValidationError("Performing this operation will DELETE THE RESULTS of %d matches in the %s division (%s). Are you sure you want to do this?" %(len(lost_results), str(tournament_division), ", ".join(str(match) for match in sorted(lost_results, key=lambda match: match.number))))
+
 class SparringTeamRegistrationPointsForm(forms.ModelForm):
     confirm_delete_matches = forms.BooleanField(
             required=False, initial=False, widget=forms.HiddenInput())
+    search_slots = forms.BooleanField(required=False, initial=False,
+            label="Search for a better bracket (takes up to %g seconds)" %(
+                    models.TournamentSparringDivision.SLOT_SEARCH_TIME_BUDGET,))
 
     class Meta:
         model = models.SparringTeamRegistration
@@ -60,22 +100,37 @@ class SparringTeamRegistrationPointsForm(forms.ModelForm):
     def clean(self, *args, **kwargs):
         cleaned_data = super(SparringTeamRegistrationPointsForm, self).clean(
                 *args, **kwargs)
-        confirm_delete_matches = cleaned_data['confirm_delete_matches']
-        if confirm_delete_matches:
+        if 'points' not in cleaned_data:
             return cleaned_data
         tournament_division = self.instance.tournament_division
-        num_existing_matches = models.SparringTeamMatch.objects.filter(
-                division=tournament_division,
-                winning_team__isnull=False).count()
-        if not num_existing_matches:
+        time_budget = None
+        if cleaned_data.get('search_slots'):
+            time_budget = models.TournamentSparringDivision\
+                    .SLOT_SEARCH_TIME_BUDGET
+        # assigned once, so that the bracket previewed here is the one saved;
+        # seeded by the division, so that points changes that do not move
+        # the top seeds keep the slots (and the results) of the other teams.
+        # Searched in this process: forking the threaded web server for a
+        # process pool can deadlock on the locks held by its other threads
+        self.slot_assignment = tournament_division.get_slot_assignment(
+                seed=tournament_division.pk, time_budget=time_budget,
+                max_workers=1,
+                points={self.instance.pk: cleaned_data['points']})
+        if cleaned_data['confirm_delete_matches']:
             return cleaned_data
-        self.fields['confirm_delete_matches'].widget = forms.CheckboxInput()
-        raise forms.ValidationError("The %s division already has %d matches with results. Performing this operation will DELETE THESE MATCH RESULTS. Are you sure you want to do this?" %(str(tournament_division), num_existing_matches))
+        teams, slots = self.slot_assignment
+        confirm_lost_match_results(self, tournament_division,
+                {slots[team.pk]: team for team in teams if team.pk in slots})
+        return cleaned_data
 
     def save(self, *args, **kwargs):
+        tournament_division = self.instance.tournament_division
+        teams, slots = self.slot_assignment
+        # the new seeds first, so that saving the instance keeps its seed
+        tournament_division.save_slots(teams, slots)
+        self.instance.seed = slots.get(self.instance.pk)
         super().save(*args, **kwargs)
-        self.instance.tournament_division.assign_slots_to_team_registrations()
-        self.instance.tournament_division.create_matches_from_slots()
+        tournament_division.update_matches_from_slots()
 
 class SparringTeamRegistrationSeedingForm(forms.ModelForm):
     confirm_delete_matches = forms.BooleanField(
@@ -94,23 +149,21 @@ class SparringTeamRegistrationSeedingForm(forms.ModelForm):
         if existing_seeds:
             raise forms.ValidationError("A team already has seed #%d: %s" %(
                     self.cleaned_data['seed'], existing_seeds.first().team))
+        return self.cleaned_data['seed']
 
     def clean(self, *args, **kwargs):
         confirm_delete_matches = self.cleaned_data['confirm_delete_matches']
         if confirm_delete_matches:
             return self.cleaned_data
         tournament_division = self.instance.tournament_division
-        num_existing_matches = models.SparringTeamMatch.objects.filter(
-                division=tournament_division,
-                winning_team__isnull=False).count()
-        if not num_existing_matches:
-            return self.cleaned_data
-        self.fields['confirm_delete_matches'].widget = forms.CheckboxInput()
-        raise forms.ValidationError("The %s division already has %d matches with results. Performing this operation will DELETE THESE MATCH RESULTS. Are you sure you want to do this?" %(str(tournament_division), num_existing_matches))
+        confirm_lost_match_results(self, tournament_division,
+                tournament_division.get_seeds(self.instance,
+                        self.cleaned_data.get('seed')))
+        return self.cleaned_data
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
-        self.instance.tournament_division.create_matches_from_slots()
+        self.instance.tournament_division.update_matches_from_slots()
 
 class SparringTeamRegistrationBracketSeedingForm(forms.Form):
     seed = forms.IntegerField()
@@ -167,18 +220,14 @@ class SparringTeamRegistrationBracketSeedingForm(forms.Form):
             return
         team_registration = self.cleaned_data['team_registration']
         division = team_registration.tournament_division
-        num_existing_matches = models.SparringTeamMatch.objects.filter(
-                division=division, winning_team__isnull=False).count()
-        if not num_existing_matches:
-            return
-        self.fields['confirm_delete_matches'].widget = forms.CheckboxInput()
-        raise forms.ValidationError("The %s division already has %d matches with results. Performing this operation will DELETE THESE MATCH RESULTS. Are you sure you want to do this?" %(str(division.division), num_existing_matches))
+        confirm_lost_match_results(self, division, division.get_seeds(
+                team_registration, self.cleaned_data['seed']))
 
     def save(self, *args, **kwargs):
         team_registration = self.cleaned_data['team_registration']
         team_registration.seed = self.cleaned_data['seed']
         team_registration.save()
-        team_registration.tournament_division.create_matches_from_slots()
+        team_registration.tournament_division.update_matches_from_slots()
 
 class TournamentSparringDivisionBracketGenerateForm(forms.ModelForm):
     confirm_delete_matches = forms.BooleanField(
@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tmdb import models
+
+class Command(BaseCommand):
+    help = ('Assigns bracket slots to the teams of every division of a'
+            ' tournament and regenerates the brackets. Existing match results'
+            ' are deleted.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('tournament_slug',
+                help="Slug of the tournament")
+        parser.add_argument('-w', '--workers', type=int, default=None,
+                help="Number of worker processes (default: number of CPUs)")
+        parser.add_argument('--seed', type=int, default=None,
+                help="Random seed, to reproduce a slot assignment")
+        parser.add_argument('--time-budget', type=float, default=None,
+                help="Seconds to spend optimizing each division's slots")
+
+    def handle(self, *args, **options):
+        try:
+            tournament = models.Tournament.objects.get(
+                    slug=options['tournament_slug'])
+        except models.Tournament.DoesNotExist:
+            raise CommandError("No tournament with slug %s" %(
+                    options['tournament_slug'],))
+
+        start = time.perf_counter()
+        teams_by_division = tournament.assign_slots_to_all_divisions(
+                seed=options['seed'], max_workers=options['workers'],
+                time_budget=options['time_budget'])
+        elapsed = time.perf_counter() - start
+        for tournament_division in models.TournamentSparringDivision.objects\
+                .filter(tournament=tournament):
+            tournament_division.create_matches_from_slots()
+        self.stdout.write("Assigned slots to %d teams in %d divisions in %.3fs"
+                %(sum(len(teams) for teams in teams_by_division.values()),
+                len(teams_by_division), elapsed))
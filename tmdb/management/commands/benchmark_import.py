@@ -0,0 +1,53 @@
+import json
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tmdb.util.import_benchmark import benchmark_import, environment, \
+        scale_team_file
+
+DEFAULT_DATA_DIR = Path(__file__).parents[2] / 'tests' / 'registration_test_data'
+
+class Command(BaseCommand):
+    help = ('Benchmarks parse_team_file and Tournament.import_registration_data'
+            ' on registration files and scaled copies of them, writing a JSON'
+            ' report. All imports are rolled back.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('filenames', nargs='*', type=Path,
+                help="Registration files (default: the test data files)")
+        parser.add_argument('-s', '--scales', nargs='+', type=int,
+                default=[1, 2, 5, 10], help="Scale factors to benchmark")
+        parser.add_argument('-r', '--rounds', type=int, default=3,
+                help="Number of timed rounds per benchmark")
+        parser.add_argument('-o', '--output', type=Path,
+                help="Write the JSON report to this file instead of stdout")
+
+    def handle(self, *args, **options):
+        filenames = options['filenames'] or sorted(
+                DEFAULT_DATA_DIR.glob('*.csv'))
+        if options['rounds'] < 1:
+            raise CommandError("--rounds must be at least 1")
+
+        results = []
+        for filename in filenames:
+            with open(filename, 'r') as fh:
+                lines = fh.readlines()
+            for scale in options['scales']:
+                result = benchmark_import(scale_team_file(lines, scale),
+                        rounds=options['rounds'])
+                result.update({'file': filename.name, 'scale': scale})
+                results.append(result)
+                self.stderr.write("%s x%d: %d teams imported in %.3fs"
+                        " (%d queries)" %(filename.name, scale,
+                        result['num_teams'], result[
+                                'import_registration_data']['wall_time'][
+                                'mean'], result['import_registration_data'][
+                                'num_queries']))
+
+        report = json.dumps({'environment': environment(),
+                'results': results}, indent=2)
+        if options['output']:
+            options['output'].write_text(report)
+        else:
+            self.stdout.write(report)
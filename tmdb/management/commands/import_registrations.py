@@ -0,0 +1,111 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+from pathlib import Path
+import re
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from tmdb import models
+from tmdb.util import TeamFileParseError, group_team_records, read_team_file
+
+REGISTRATION_FILENAME_RE = re.compile(
+        r'^(?P<year>\d{4})\.(?P<tournament_num>\d+)-(?P<location>[a-z]+)')
+
+def read_registration_file(filename):
+    """Runs in a worker process, so it must not access the database."""
+    with open(filename, 'rb') as fh:
+        try:
+            return read_team_file(fh), []
+        except TeamFileParseError as e:
+            return [], e.errors
+
+class Command(BaseCommand):
+    help = ('Imports a directory of registration dashboard exports, parsing'
+            ' them in parallel. Files must be named'
+            ' <season start year>.<tournament number>-<location>_*.csv')
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', type=Path,
+                help="Directory containing the registration CSV files")
+        parser.add_argument('-w', '--workers', type=int, default=None,
+                help="Number of parser processes (default: number of CPUs)")
+        parser.add_argument('--create-tournaments', action='store_true',
+                help="Create seasons and tournaments that do not exist yet"
+                        " (with placeholder dates and URLs)")
+
+    def handle(self, *args, **options):
+        filenames = sorted(options['directory'].glob('*.csv'))
+        if not filenames:
+            raise CommandError("No CSV files found in %s" %(
+                    options['directory'],))
+        filename_matches = [REGISTRATION_FILENAME_RE.match(filename.name)
+                for filename in filenames]
+        unmatched = [filename.name for filename, match in zip(filenames,
+                filename_matches) if match is None]
+        if unmatched:
+            raise CommandError("Unable to determine tournament of %s" %(
+                    ", ".join(unmatched),))
+        tournaments = [self.get_tournament(filename, match,
+                options['create_tournaments'])
+                for filename, match in zip(filenames, filename_matches)]
+
+        start = time.perf_counter()
+        # forked workers must not share the parent's database connections
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            parsed_files = list(executor.map(read_registration_file,
+                    filenames))
+        parse_time = time.perf_counter() - start
+
+        num_teams = 0
+        for filename, tournament, (team_records, errors) in zip(
+                filenames, tournaments, parsed_files):
+            if errors:
+                self.stderr.write("Skipping %s:\n  %s" %(
+                        filename.name, "\n  ".join(errors)))
+                continue
+            if tournament.imported:
+                self.stderr.write("Skipping %s: %s has already been imported"
+                        %(filename.name, tournament))
+                continue
+            teams_data = tournament.import_parsed_registration_data(
+                    group_team_records(team_records))
+            num_teams += len(teams_data)
+            self.stdout.write("Imported %d teams into %s in %.3fs" %(
+                    len(teams_data), tournament,
+                    tournament.import_statistics.elapsed))
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write("Imported %d teams from %d files in %.3fs"
+                " (parsing: %.3fs, %.1f teams/sec)" %(num_teams,
+                len(filenames), elapsed, parse_time,
+                num_teams / elapsed if elapsed else 0))
+
+    def get_tournament(self, filename, match, create_tournaments):
+        year = int(match.group('year'))
+        tournament_num = int(match.group('tournament_num'))
+        location = match.group('location')
+
+        season = models.Season.objects.filter(start_date__year=year).first()
+        tournament = None
+        if season is not None:
+            tournament = models.Tournament.objects.filter(season=season,
+                    location__iexact=location).first()
+        if tournament is not None:
+            return tournament
+        if not create_tournaments:
+            raise CommandError("No %s tournament in the %d season for %s"
+                    " (use --create-tournaments)" %(location, year,
+                    filename.name))
+
+        if season is None:
+            season = models.Season.objects.create(
+                    start_date=date(year=year, month=9, day=1),
+                    end_date=date(year=year+1, month=9, day=1))
+        return models.Tournament.objects.create(season=season,
+                location=location,
+                date=season.start_date + timedelta(days=tournament_num),
+                registration_doc_url='http://ectc-online.org/%d/%s' %(
+                        year, filename.name))
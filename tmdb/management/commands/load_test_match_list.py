@@ -0,0 +1,74 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from tmdb import models
+from tmdb.util.import_benchmark import environment
+from tmdb.util.websocket_load_test import load_test_match_list
+
+IN_MEMORY_CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'CONFIG': {
+            'capacity': 1000,
+        },
+    },
+}
+
+class Command(BaseCommand):
+    help = ('Load tests the match list websocket of a tournament with an'
+            ' increasing number of clients connected to one worker over the'
+            ' in-memory channel layer, writing a JSON report. Reports the'
+            ' largest number of clients that received every update within'
+            ' --max-latency.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('tournament_slug')
+        parser.add_argument('-c', '--clients', nargs='+', type=int,
+                default=[10, 50, 100, 200, 400],
+                help="Numbers of concurrent clients to test")
+        parser.add_argument('-u', '--updates', type=int, default=20,
+                help="Number of match updates broadcast per test")
+        parser.add_argument('--max-latency', type=float, default=1.0,
+                help="Largest p95 delivery latency (s) a worker sustains")
+        parser.add_argument('-o', '--output',
+                help="Write the JSON report to this file instead of stdout")
+
+    def handle(self, *args, **options):
+        try:
+            tournament = models.Tournament.objects.get(
+                    slug=options['tournament_slug'])
+        except models.Tournament.DoesNotExist:
+            raise CommandError("Tournament %s does not exist" %(
+                    options['tournament_slug'],))
+
+        results = []
+        max_sustained_clients = 0
+        with override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS):
+            for num_clients in options['clients']:
+                result = load_test_match_list(tournament, num_clients,
+                        num_updates=options['updates'],
+                        timeout=10 * options['max_latency'])
+                result['sustained'] = not result['num_lost'] and \
+                        result['latency']['p95'] <= options['max_latency']
+                if result['sustained']:
+                    max_sustained_clients = max(max_sustained_clients,
+                            num_clients)
+                results.append(result)
+                self.stderr.write("%d clients: connected in %.3fs, synced in"
+                        " %.3fs, %d/%d updates delivered (p95 latency %.3fs)"
+                        %(num_clients, result['connect_time'],
+                        result['sync_time'], result['num_delivered'],
+                        num_clients * options['updates'],
+                        result['latency']['p95'] if result['latency']
+                                else float('nan')))
+
+        report = json.dumps({'environment': environment(),
+                'max_sustained_clients': max_sustained_clients,
+                'results': results}, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                fh.write(report)
+        else:
+            self.stdout.write(report)
@@ -0,0 +1,225 @@
+"""
+Filtered, paginated views of the matches of a tournament, for devices
+(e.g. the tablet at a ring) that only show part of the match list.
+
+A MatchQueueFilter selects matches by ring, division, school and status,
+both as a queryset and for single matches of a websocket update, so that
+the match queue endpoint and the websocket subscriptions agree.
+"""
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+from tmdb import models
+from tmdb.tournament_snapshot import compact_values, json_fields
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# the statuses of the match list (see evaluate_status in match_websocket.js)
+STATUS_QUERIES = {
+    'not_started': Q(winning_team__isnull=True, ring_number__isnull=True,
+            in_holding=False),
+    'in_holding': Q(winning_team__isnull=True, ring_number__isnull=True,
+            in_holding=True),
+    'sent_to_ring': Q(winning_team__isnull=True, ring_number__isnull=False,
+            at_ring=False, competing=False),
+    'at_ring': Q(winning_team__isnull=True, ring_number__isnull=False,
+            at_ring=True, competing=False),
+    'competing': Q(winning_team__isnull=True, ring_number__isnull=False,
+            competing=True),
+    'complete': Q(winning_team__isnull=False),
+}
+STATUS_QUERIES['active'] = Q(winning_team__isnull=True) \
+        & (Q(ring_number__isnull=False) | Q(in_holding=True))
+
+def get_status(fields):
+    """Returns the status (a key of STATUS_QUERIES other than 'active') of
+    a match, given the dict of its fields."""
+    if fields['winning_team'] is not None:
+        return 'complete'
+    if fields['ring_number'] is not None:
+        if fields['competing']:
+            return 'competing'
+        if fields['at_ring']:
+            return 'at_ring'
+        return 'sent_to_ring'
+    if fields['in_holding']:
+        return 'in_holding'
+    return 'not_started'
+
+def encode_cursor(number, match_id):
+    return "%d-%d" %(number, match_id)
+
+def decode_cursor(cursor):
+    try:
+        number, match_id = cursor.split('-')
+        return int(number), int(match_id)
+    except ValueError:
+        raise ValidationError("Invalid cursor: %s" %(cursor,))
+
+def parse_limit(limit):
+    if limit in (None, ''):
+        return DEFAULT_PAGE_SIZE
+    try:
+        return int(limit)
+    except ValueError:
+        raise ValidationError("Invalid limit: %s" %(limit,))
+
+class MatchQueueFilter():
+    """
+    Selects the matches at ring_number, in the TournamentSparringDivision
+    division_id, with a team from school_id and with the given status (a
+    key of STATUS_QUERIES). Criteria that are None select every match.
+    """
+    def __init__(self, ring_number=None, division_id=None, school_id=None,
+            status=None):
+        if status is not None and status not in STATUS_QUERIES:
+            raise ValidationError("Invalid status: %s" %(status,))
+        self.ring_number = ring_number
+        self.division_id = division_id
+        self.school_id = school_id
+        self.status = status
+
+    @staticmethod
+    def from_params(params):
+        """Creates a MatchQueueFilter from request parameters (ring,
+        division, school and status)."""
+        values = {}
+        for param in ('ring', 'division', 'school',):
+            value = params.get(param)
+            if value in (None, ''):
+                continue
+            try:
+                values[param] = int(value)
+            except (TypeError, ValueError):
+                raise ValidationError("Invalid %s: %s" %(param, value))
+        return MatchQueueFilter(ring_number=values.get('ring'),
+                division_id=values.get('division'),
+                school_id=values.get('school'),
+                status=params.get('status') or None)
+
+    def is_empty(self):
+        return self.ring_number is None and self.division_id is None \
+                and self.school_id is None and self.status is None
+
+    def queryset(self, tournament_id):
+        queryset = models.SparringTeamMatch.objects.filter(
+                division__tournament_id=tournament_id)
+        if self.ring_number is not None:
+            queryset = queryset.filter(ring_number=self.ring_number)
+        if self.division_id is not None:
+            queryset = queryset.filter(division_id=self.division_id)
+        if self.school_id is not None:
+            queryset = queryset.filter(Q(blue_team__team__school_id=
+                    self.school_id) | Q(red_team__team__school_id=
+                    self.school_id))
+        if self.status is not None:
+            queryset = queryset.filter(STATUS_QUERIES[self.status])
+        return queryset.order_by('number', 'id')
+
+    def matches(self, fields, school_ids):
+        """Returns whether the match with the dict of fields passes this
+        filter. school_ids maps SparringTeamRegistration ids to their
+        schools' ids."""
+        if self.ring_number is not None \
+                and fields['ring_number'] != self.ring_number:
+            return False
+        if self.division_id is not None \
+                and fields['division'] != self.division_id:
+            return False
+        if self.school_id is not None and self.school_id not in (
+                school_ids.get(fields['blue_team']),
+                school_ids.get(fields['red_team'])):
+            return False
+        if self.status is None:
+            return True
+        status = get_status(fields)
+        if self.status == 'active':
+            return status not in ('complete', 'not_started')
+        return status == self.status
+
+def get_school_ids(tournament_id):
+    """Returns the ids of the schools of the team registrations of
+    tournament_id, by registration id."""
+    return dict(models.SparringTeamRegistration.objects.filter(
+            tournament_division__tournament_id=tournament_id).values_list(
+            'id', 'team__school'))
+
+def get_page(tournament_id, queue_filter, after=None,
+        limit=DEFAULT_PAGE_SIZE):
+    """
+    Returns the matches of tournament_id that pass queue_filter, in match
+    number order, starting after the cursor `after`, with at most `limit`
+    matches: {'matches': compact rows, 'team_registrations': names of the
+    teams in them, 'next': the cursor of the next page or None}.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    queryset = queue_filter.queryset(tournament_id)
+    if after is not None:
+        number, match_id = decode_cursor(after)
+        queryset = queryset.filter(Q(number__gt=number)
+                | Q(number=number, id__gt=match_id))
+    # one extra match tells whether there is a next page
+    matches = compact_values(queryset[:limit + 1], json_fields['team_match'])
+    next_cursor = None
+    if len(matches['rows']) > limit:
+        matches['rows'] = matches['rows'][:limit]
+        number_index = matches['fields'].index('number') + 1
+        next_cursor = encode_cursor(matches['rows'][-1][number_index],
+                matches['rows'][-1][0])
+    team_field_indexes = [matches['fields'].index(field_name) + 1
+            for field_name in ('blue_team', 'red_team',)]
+    team_registration_ids = {row[index] for row in matches['rows']
+            for index in team_field_indexes if row[index] is not None}
+    team_registrations = models.SparringTeamRegistration.objects.filter(
+            pk__in=team_registration_ids).select_related(
+            'team__school', 'team__division')
+    return {
+        'matches': matches,
+        'team_registrations': {team_registration.pk: str(team_registration)
+                for team_registration in team_registrations},
+        'next': next_cursor,
+    }
+
+class MatchQueueSubscription():
+    """
+    Scopes the match updates sent to a websocket client to a
+    MatchQueueFilter. An update of a match is sent if the match passes the
+    filter, or if the client has it (e.g. from the match queue endpoint) so
+    that it sees the match leave the queue.
+    """
+    def __init__(self, queue_filter, school_ids, match_ids=()):
+        self.queue_filter = queue_filter
+        self.school_ids = school_ids
+        self.match_ids = set(match_ids)
+
+    def filter_compact_values(self, compact_matches):
+        """Returns compact_matches (see compact_values) without the
+        matches the client does not need."""
+        field_names = compact_matches['fields']
+        rows = []
+        for row in compact_matches['rows']:
+            if self.queue_filter.matches(dict(zip(field_names, row[1:])),
+                    self.school_ids):
+                self.match_ids.add(row[0])
+            elif row[0] in self.match_ids:
+                self.match_ids.discard(row[0])
+            else:
+                continue
+            rows.append(row)
+        return dict(compact_matches, rows=rows)
+
+    def filter_change(self, change):
+        """Returns the change (a logged or broadcast message) with only the
+        matches the client needs. Changes are never dropped, since the clients
+        of the whole tournament rely on their consecutive versions."""
+        if change['message_type'] == 'update':
+            return dict(change, message_content=self.filter_compact_values(
+                    change['message_content']))
+        if change['message_type'] == 'division_rebuilt':
+            return dict(change, message_content=dict(
+                    change['message_content'],
+                    matches=self.filter_compact_values(
+                            change['message_content']['matches'])))
+        return change
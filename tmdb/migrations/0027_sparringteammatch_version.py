@@ -0,0 +1,18 @@
+# Generated by Django 2.2.10 on 2026-10-18 20:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tmdb', '0026_modify_slug_lengths'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sparringteammatch',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
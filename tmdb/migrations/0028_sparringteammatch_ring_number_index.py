@@ -0,0 +1,17 @@
+# Generated by Django 2.2.10 on 2026-10-18 20:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tmdb', '0027_sparringteammatch_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='sparringteammatch',
+            index=models.Index(fields=['ring_number', 'number'], name='tmdb_match_ring_number_idx'),
+        ),
+    ]
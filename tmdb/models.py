@@ -1,14 +1,37 @@
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import logging
 import string
+import threading
 
 from django.db import models, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
 from django.core.exceptions import ValidationError
 from django.db.utils import IntegrityError
+from django.dispatch import Signal, receiver
 from itertools import product
 from django.utils.text import slugify
 
-from tmdb.util import BracketGenerator, SlotAssigner, parse_team_file
+from tmdb.util import BracketGenerator, BracketGraph, BracketGraphCache, \
+        ImportStatistics, SlotAssignmentTeam, assign_slots, parse_team_file, \
+        search_slots
 from .school_registration_validator import SchoolRegistrationValidator
 
+logger = logging.getLogger(__name__)
+
+# sent once the matches of a TournamentSparringDivision have been replaced,
+# instead of a post_save/post_delete for every match
+division_matches_rebuilt = Signal(providing_args=['tournament_division'])
+# sent once bulk writes, which do not send post_save, have changed the
+# registrations of a tournament
+tournament_data_changed = Signal(providing_args=['tournament_id'])
+
+def send_tournament_data_changed(tournament_id):
+    transaction.on_commit(lambda: tournament_data_changed.send(
+            sender=Tournament, tournament_id=tournament_id))
+
 def sanitize_school_name(school_name):
     school_name = slugify(school_name).replace('_', '-')
     school_name = ' '.join(s.upper() for s in school_name.split('-'))
@@ -16,6 +39,8 @@ def sanitize_school_name(school_name):
 
 class SchoolValidationError(IntegrityError): pass
 
+class MatchVersionConflict(IntegrityError): pass
+
 class SexField(models.CharField):
     FEMALE = 'F'
     MALE = 'M'
@@ -235,78 +260,98 @@ class Tournament(models.Model):
 
     @staticmethod
     def create_schools(teams_by_division):
-        schools = School.objects.all()
-        schools_by_name = {s.name: s for s in schools}
         teams = []
         for division_teams in teams_by_division.values():
-            for team in division_teams:
-                school_name = sanitize_school_name(team['school_name'])
-                if school_name not in schools_by_name:
-                    schools_by_name[school_name] = School.objects.create(
-                            name=school_name)
-                team['school'] = schools_by_name[school_name]
-                teams.append(team)
+            teams.extend(division_teams)
+        school_names = {sanitize_school_name(team['school_name'])
+                for team in teams}
+        schools_by_name = School.objects.in_bulk(school_names,
+                field_name='name')
+        new_schools = []
+        for school_name in sorted(school_names - set(schools_by_name)):
+            school = School(name=school_name)
+            school.slug = school.slugify()
+            new_schools.append(school)
+        if new_schools:
+            School.objects.bulk_create(new_schools)
+            schools_by_name = School.objects.in_bulk(school_names,
+                    field_name='name')
+        for team in teams:
+            team['school'] = schools_by_name[
+                    sanitize_school_name(team['school_name'])]
         return teams
 
     def add_season_registrations(self, teams_data):
-        school_season_registrations = {}
+        schools = {team['school'].pk: team['school'] for team in teams_data}
+
+        def get_season_registrations():
+            return {r.school_id: r for r in
+                    SchoolSeasonRegistration.objects.filter(
+                            season=self.season, school__in=schools.keys())}
+
+        school_season_registrations = get_season_registrations()
+        new_registrations = [SchoolSeasonRegistration(school=school,
+                season=self.season, division=3)
+                for school_id, school in schools.items()
+                if school_id not in school_season_registrations]
+        if new_registrations:
+            SchoolSeasonRegistration.objects.bulk_create(new_registrations)
+            school_season_registrations = get_season_registrations()
         for team in teams_data:
-            school = team['school']
-            season_registration = school_season_registrations.get(school.name)
-            if season_registration is None:
-                object_model = SchoolSeasonRegistration.objects
-                season_registration = object_model.get_or_create(
-                    school=team['school'], season=self.season,
-                    defaults={'division': 3})[0]
-                school_season_registrations[school.name] = season_registration
-            team['school_season_registration'] = season_registration
+            team['school_season_registration'] = \
+                    school_season_registrations[team['school'].pk]
 
     def add_tournament_registrations(self, teams_data):
-        existing_registrations = {}
-        # cache existing registrations in memory
-        for registration in SchoolTournamentRegistration.objects.filter(
-                tournament=self):
-            existing_registrations[registration.school_season_registration] = registration
+        season_registrations = {team['school_season_registration'].pk:
+                team['school_season_registration'] for team in teams_data}
+
+        def get_tournament_registrations():
+            return {r.school_season_registration_id: r for r in
+                    SchoolTournamentRegistration.objects.filter(
+                            tournament=self,
+                            school_season_registration__in=
+                                    season_registrations.keys())}
+
+        existing_registrations = get_tournament_registrations()
+        new_registrations = [SchoolTournamentRegistration(
+                school_season_registration=season_registration,
+                tournament=self, imported=True)
+                for pk, season_registration in season_registrations.items()
+                if pk not in existing_registrations]
+        if new_registrations:
+            SchoolTournamentRegistration.objects.bulk_create(
+                    new_registrations)
+            existing_registrations = get_tournament_registrations()
         for team in teams_data:
-            registration = existing_registrations.get(team['school_season_registration'])
-            if not registration:
-                registration = SchoolTournamentRegistration(
-                    school_season_registration=team['school_season_registration'],
-                    tournament=self,
-                    imported=True)
-                registration.clean()
-                registration.save()
-                existing_registrations[team['school_season_registration']] = registration
-            team['school_tournament_registration'] = registration
+            team['school_tournament_registration'] = existing_registrations[
+                    team['school_season_registration'].pk]
 
     @staticmethod
     def add_sparring_teams(teams_data):
-        existing_teams = {}
-        # cache existing teams in memory
-        for team_data in SparringTeam.objects.all():
-            team_key = (
-                team_data.school.name,
-                team_data.division,
-                # team_data.division.sex,
-                # team_data.division.skill_level,
-                team_data.number,
-            )
-            existing_teams[team_key] = team_data
-        # iterate over new teams, creating as needed
-        for team_data in teams_data:
-            team_key = (
-                team_data['school'].name,
-                team_data['sparring_division'],
+        def team_key(team_data):
+            return (
+                team_data['school'].pk,
+                team_data['sparring_division'].pk,
                 team_data['team_num'],
             )
-            team = existing_teams.get(team_key)
-            if not team:
-                team = SparringTeam(school=team_data['school'],
-                    division=team_data['sparring_division'],
-                    number=team_data['team_num'])
-                team.clean()
-                team.save()
-            team_data['sparring_team'] = team
+
+        team_keys = {team_key(team_data) for team_data in teams_data}
+        existing_teams = SparringTeam.get_teams_by_key(team_keys)
+        new_teams = {}
+        for team_data in teams_data:
+            key = team_key(team_data)
+            if key in existing_teams or key in new_teams:
+                continue
+            team = SparringTeam(school=team_data['school'],
+                division=team_data['sparring_division'],
+                number=team_data['team_num'])
+            team.slug = team.slugify()
+            new_teams[key] = team
+        if new_teams:
+            SparringTeam.objects.bulk_create(new_teams.values())
+            existing_teams = SparringTeam.get_teams_by_key(team_keys)
+        for team_data in teams_data:
+            team_data['sparring_team'] = existing_teams[team_key(team_data)]
 
     def add_sparring_team_registrations(self, teams_data):
         tournament_divisions = {}
@@ -333,6 +378,135 @@ class Tournament(models.Model):
             team_data['sparring_team_registration'] = sparring_team_registration
         SparringTeamRegistration.objects.bulk_create(registrations)
 
+    def diff_registration_data(self, team_file):
+        """
+        Compares the teams in team_file with the SparringTeamRegistrations
+        of this tournament without modifying the database.
+        """
+        existing_registrations = {}
+        for registration in SparringTeamRegistration.objects.filter(
+                tournament_division__tournament=self).select_related(
+                'team__school', 'team__division'):
+            team = registration.team
+            team_key = (team.school.name, team.division_id, team.number)
+            existing_registrations[team_key] = registration
+
+        diff = RegistrationDiff()
+        teams_by_division = parse_team_file(team_file)
+        for division_teams in teams_by_division.values():
+            for team_data in division_teams:
+                team_key = (sanitize_school_name(team_data['school_name']),
+                        team_data['sparring_division'].pk,
+                        team_data['team_num'])
+                registration = existing_registrations.pop(team_key, None)
+                if registration is None:
+                    diff.added.append(team_data)
+                elif RegistrationDiff.weight_classes_changed(
+                        registration, team_data):
+                    diff.updated.append((registration, team_data))
+        diff.removed.extend(existing_registrations.values())
+        if diff.removed:
+            removed_ids = [registration.pk for registration in diff.removed]
+            matches = SparringTeamMatch.objects.filter(
+                    models.Q(blue_team__in=removed_ids)
+                    | models.Q(red_team__in=removed_ids)
+                    | models.Q(winning_team__in=removed_ids))
+            diff.reset_divisions = list(TournamentSparringDivision.objects
+                    .filter(pk__in=matches.values('division')))
+        return diff
+
+    def apply_registration_diff(self, diff):
+        """
+        Applies a RegistrationDiff created by diff_registration_data.
+
+        The matches of a division are only deleted if one of the removed
+        teams has been placed in its bracket (see diff.reset_divisions).
+        """
+        if diff.updated:
+            updated_registrations = []
+            for registration, team_data in diff.updated:
+                registration.lightweight = team_data['has_lightweight']
+                registration.middleweight = team_data['has_middleweight']
+                registration.heavyweight = team_data['has_heavyweight']
+                updated_registrations.append(registration)
+            SparringTeamRegistration.objects.bulk_update(
+                    updated_registrations,
+                    ['lightweight', 'middleweight', 'heavyweight'])
+
+        if diff.removed:
+            SparringTeamMatch.objects.filter(
+                    division__in=diff.reset_divisions).delete()
+            SparringTeamRegistration.objects.filter(
+                    pk__in=[r.pk for r in diff.removed]).delete()
+
+        if diff.added:
+            teams_data = Tournament.create_schools({None: diff.added})
+            self.add_season_registrations(teams_data)
+            self.add_tournament_registrations(teams_data)
+            Tournament.add_sparring_teams(teams_data)
+            self.add_sparring_team_registrations(teams_data)
+        send_tournament_data_changed(self.pk)
+
+    def update_registration_data(self, team_file, dry_run=False):
+        """
+        Brings the registrations of an imported tournament in line with
+        team_file, only touching the teams that were added, removed or
+        changed. With dry_run, the changes are computed but not applied.
+        """
+        if not self.imported:
+            raise IntegrityError("%s has not been imported" %(self))
+
+        with transaction.atomic():
+            diff = self.diff_registration_data(team_file)
+            if not dry_run:
+                self.apply_registration_diff(diff)
+        return diff
+
+    def division_statuses(self):
+        """Returns the TournamentSparringDivisionStatus of every division
+        of this tournament that has matches, keyed by division id."""
+        return TournamentSparringDivision.get_statuses(
+                SparringTeamMatch.objects.filter(division__tournament=self))
+
+    def assign_slots_to_all_divisions(self, seed=None, max_workers=None,
+            time_budget=None):
+        """
+        Assigns a bracket slot to every team of every division of this
+        tournament. The divisions are slotted in parallel worker processes
+        unless max_workers is 1. If time_budget is given, each division's
+        slots are optimized for that many seconds.
+        """
+        tournament_divisions = list(TournamentSparringDivision.objects.filter(
+                tournament=self))
+        teams_by_division = defaultdict(list)
+        for team in TournamentSparringDivision.get_slot_assignment_queryset()\
+                .filter(tournament_division__tournament=self):
+            teams_by_division[team.tournament_division_id].append(team)
+        slot_assignment_teams = [
+                TournamentSparringDivision.slot_assignment_teams(
+                        teams_by_division[tournament_division.pk])
+                for tournament_division in tournament_divisions]
+        num_seeds = [TournamentSparringDivision.NUM_SEEDS] * len(
+                tournament_divisions)
+        seeds = [seed] * len(tournament_divisions)
+        time_budgets = [time_budget] * len(tournament_divisions)
+
+        if max_workers == 1 or len(tournament_divisions) < 2:
+            slots = list(map(assign_slots, slot_assignment_teams, num_seeds,
+                    seeds, time_budgets))
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                slots = list(executor.map(assign_slots, slot_assignment_teams,
+                        num_seeds, seeds, time_budgets))
+
+        with transaction.atomic():
+            for tournament_division, division_slots in zip(
+                    tournament_divisions, slots):
+                tournament_division.save_slots(
+                        teams_by_division[tournament_division.pk],
+                        division_slots)
+        return teams_by_division
+
     def drop_registration_data(self):
         SparringTeamMatch.objects.filter(division__tournament=self).delete()
         SparringTeamRegistration.objects.filter(
@@ -345,18 +519,82 @@ class Tournament(models.Model):
         if self.imported:
             raise IntegrityError("%s has already been imported" %(self))
 
-        SparringTeamRegistration.objects.filter(
-                tournament_division__tournament=self).delete()
-        teams_by_division = parse_team_file(team_file)
-        teams_data = Tournament.create_schools(teams_by_division)
-        self.add_season_registrations(teams_data)
-        self.add_tournament_registrations(teams_data)
-        Tournament.add_sparring_teams(teams_data)
-        self.add_sparring_team_registrations(teams_data)
-        self.imported = True
-        self.save()
+        stats = ImportStatistics()
+        with stats.stage('parse_team_file'):
+            teams_by_division = parse_team_file(team_file)
+        return self.import_parsed_registration_data(teams_by_division, stats)
+
+    def import_parsed_registration_data(self, teams_by_division, stats=None):
+        """
+        Imports teams_by_division, as returned by parse_team_file or
+        group_team_records, into this tournament in one transaction.
+        """
+        if self.imported:
+            raise IntegrityError("%s has already been imported" %(self))
+
+        if stats is None:
+            stats = ImportStatistics()
+        with transaction.atomic():
+            with stats.stage('delete_registrations'):
+                SparringTeamRegistration.objects.filter(
+                        tournament_division__tournament=self).delete()
+            with stats.stage('create_schools'):
+                teams_data = Tournament.create_schools(teams_by_division)
+            with stats.stage('add_season_registrations'):
+                self.add_season_registrations(teams_data)
+            with stats.stage('add_tournament_registrations'):
+                self.add_tournament_registrations(teams_data)
+            with stats.stage('add_sparring_teams'):
+                Tournament.add_sparring_teams(teams_data)
+            with stats.stage('add_sparring_team_registrations'):
+                self.add_sparring_team_registrations(teams_data)
+            with stats.stage('save_tournament'):
+                self.imported = True
+                self.save()
+        self.import_statistics = stats
+        logger.info("Imported %d teams into %s\n%s", len(teams_data), self,
+                stats)
         return teams_data
 
+class RegistrationDiff():
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.updated = []
+        self.reset_divisions = []
+
+    @staticmethod
+    def weight_classes_changed(registration, team_data):
+        return (registration.lightweight != team_data['has_lightweight']
+                or registration.middleweight != team_data['has_middleweight']
+                or registration.heavyweight != team_data['has_heavyweight'])
+
+    def has_changes(self):
+        return bool(self.added or self.removed or self.updated)
+
+    def report(self):
+        lines = []
+        for team_data in self.added:
+            lines.append("Add %s %s%d" %(
+                    sanitize_school_name(team_data['school_name']),
+                    team_data['sparring_division'], team_data['team_num']))
+        for registration in self.removed:
+            lines.append("Remove %s" %(registration,))
+        for registration, team_data in self.updated:
+            lines.append("Update %s to (%s%s%s)" %(registration,
+                    "L" if team_data['has_lightweight'] else "",
+                    "M" if team_data['has_middleweight'] else "",
+                    "H" if team_data['has_heavyweight'] else ""))
+        for division in self.reset_divisions:
+            lines.append("Delete the %s bracket" %(division,))
+        return lines
+
+    def __str__(self):
+        if not self.has_changes():
+            return "No changes"
+        return "%d added, %d removed, %d updated" %(
+                len(self.added), len(self.removed), len(self.updated))
+
 class School(models.Model):
     name = models.CharField(max_length=127, unique=True)
     short_name = models.CharField(max_length=127, unique=False, blank=True,
@@ -452,9 +690,12 @@ class SparringDivision(models.Model):
         return start_val + (100 if self.sex == SexField.FEMALE else 0) + 1
 
 class TournamentSparringDivisionStatus():
-    def __init__(self, num_matches, num_matches_completed):
+    def __init__(self, num_matches=0, num_matches_completed=0,
+            num_matches_competing=0, num_matches_at_ring=0):
         self.num_matches = num_matches
         self.num_matches_completed = num_matches_completed
+        self.num_matches_competing = num_matches_competing
+        self.num_matches_at_ring = num_matches_at_ring
 
     def __str__(self):
         if not self.num_matches:
@@ -463,6 +704,11 @@ class TournamentSparringDivisionStatus():
                  self.num_matches_completed, self.num_matches,)
 
 class TournamentSparringDivision(models.Model):
+    NUM_SEEDS = 4
+    # the most seconds spent searching for a better slot assignment when
+    # the web UI asks for it, in the process of the request
+    SLOT_SEARCH_TIME_BUDGET = 1.0
+
     tournament = models.ForeignKey(Tournament, on_delete=models.CASCADE)
     division = models.ForeignKey(SparringDivision, on_delete=models.PROTECT)
 
@@ -476,62 +722,275 @@ class TournamentSparringDivision(models.Model):
         return "%s (%s)" %(self.division, self.tournament)
 
     def status(self):
-        matches = SparringTeamMatch.objects.filter(division=self)
-        num_matches = num_matches_completed = 0
-        for match in matches:
-            num_matches += 1
-            num_matches_completed += bool(match.winning_team)
-        return TournamentSparringDivisionStatus(num_matches,
-                num_matches_completed)
+        return TournamentSparringDivision.get_statuses(
+                SparringTeamMatch.objects.filter(division=self)).get(
+                self.pk, TournamentSparringDivisionStatus())
 
-    def assign_slots_to_team_registrations(self):
+    @staticmethod
+    def get_statuses(matches):
+        """
+        Counts matches by division with one aggregate query, returning a
+        TournamentSparringDivisionStatus for each division id. The
+        statuses are counted the same way as the match list: a match is
+        competing or at the ring only if it has a ring and no winner yet.
+        """
+        in_progress = models.Q(winning_team__isnull=True,
+                ring_number__isnull=False)
+        division_counts = matches.order_by().values('division').annotate(
+                num_matches=models.Count('id'),
+                num_matches_completed=models.Count('id',
+                        filter=models.Q(winning_team__isnull=False)),
+                num_matches_competing=models.Count('id',
+                        filter=in_progress & models.Q(competing=True)),
+                num_matches_at_ring=models.Count('id',
+                        filter=in_progress & models.Q(competing=False,
+                                at_ring=True)))
+        return {counts.pop('division'): TournamentSparringDivisionStatus(
+                **counts) for counts in division_counts}
+
+    def assign_slots_to_team_registrations(self, seed=None, time_budget=None,
+            max_workers=None):
         """
         Assigns all teams in tournament_division to a slot in the
-        bracket.
-        """
-        teams = SparringTeamRegistration.objects.filter(
-                tournament_division=self)
-        teams = teams.order_by('team__number').order_by('team__school')
-        teams = list(teams)
-        slot_assigner = SlotAssigner(list(teams), 4,
-                get_school_name = lambda team: team.team.school.name,
-                get_points = lambda team: team.points if team.points else 0)
-        with transaction.atomic():
-            for team in teams:
-                team.seed = None
-                team.save()
-            for team in teams:
-                team.seed = slot_assigner.slots_by_team.get(team)
-                team.save()
+        bracket. The same seed reproduces the same assignment. If
+        time_budget is given, candidate assignments are optimized for that
+        many seconds in max_workers processes and the best one is kept.
+        """
+        teams, slots = self.get_slot_assignment(seed=seed,
+                time_budget=time_budget, max_workers=max_workers)
+        self.save_slots(teams, slots)
         return teams
 
+    def get_slot_assignment(self, seed=None, time_budget=None,
+            max_workers=None, points=None):
+        """
+        Returns the teams of this division and their slots, keyed by
+        SparringTeamRegistration.pk, as assigned (without saving them) by
+        assign_slots_to_team_registrations. points maps the pks of teams to
+        points to assign them with instead of their own, so that the
+        assignment can be previewed before the points are saved.
+        """
+        teams = list(TournamentSparringDivision.get_slot_assignment_queryset()
+                .filter(tournament_division=self))
+        for team in teams:
+            if points and team.pk in points:
+                team.points = points[team.pk]
+        slot_assignment_teams = TournamentSparringDivision.slot_assignment_teams(
+                teams)
+        if time_budget:
+            slots = search_slots(slot_assignment_teams,
+                    TournamentSparringDivision.NUM_SEEDS, seed=seed,
+                    time_budget=time_budget, max_workers=max_workers)
+        else:
+            slots = assign_slots(slot_assignment_teams,
+                    TournamentSparringDivision.NUM_SEEDS, seed=seed)
+        return teams, slots
+
+    @staticmethod
+    def get_slot_assignment_queryset():
+        return SparringTeamRegistration.objects.select_related(
+                'team__school').order_by('team__school', 'team__number')
+
+    @staticmethod
+    def slot_assignment_teams(team_registrations):
+        return [SlotAssignmentTeam(team.pk, team.team.school.name,
+                team.points if team.points else 0, team.num_competitors())
+                for team in team_registrations]
+
+    def save_slots(self, team_registrations, slots):
+        """
+        Sets the seed of each of team_registrations to its value in slots
+        (keyed by SparringTeamRegistration.pk). All seeds of the division
+        are cleared first so the (tournament_division, seed) constraint
+        cannot be violated while the new seeds are written.
+        """
+        for team in team_registrations:
+            team.seed = slots.get(team.pk)
+        with transaction.atomic():
+            SparringTeamRegistration.objects.filter(
+                    tournament_division=self).update(seed=None)
+            SparringTeamRegistration.objects.bulk_update(
+                    [team for team in team_registrations
+                            if team.seed is not None], ['seed'])
+        send_tournament_data_changed(self.tournament_id)
+
+    _rebuilding = threading.local()
+
+    @staticmethod
+    def is_rebuilding(tournament_division_id):
+        """
+        Returns whether the matches of the division are being replaced by
+        create_matches_from_slots in this thread, in which case receivers
+        of the per-match signals should wait for division_matches_rebuilt.
+        """
+        return tournament_division_id in getattr(
+                TournamentSparringDivision._rebuilding, 'division_ids', ())
+
+    @contextmanager
+    def _rebuild(self):
+        rebuilding = TournamentSparringDivision._rebuilding
+        if not hasattr(rebuilding, 'division_ids'):
+            rebuilding.division_ids = set()
+        rebuilding.division_ids.add(self.pk)
+        try:
+            yield
+        finally:
+            rebuilding.division_ids.discard(self.pk)
+
     def create_matches_from_slots(self):
-        SparringTeamMatch.objects.filter(division=self).delete()
+        """
+        Replaces the matches of this division with a bracket generated from
+        the seeds of its teams. The new matches are written with one
+        bulk_create and division_matches_rebuilt is sent once the
+        transaction commits.
+        """
         seeded_teams = SparringTeamRegistration.objects.filter(
                 tournament_division=self, seed__isnull=False)
         seeds = {team.seed:team for team in seeded_teams}
         start_val = self.division.match_number_start_val()
         bracket = BracketGenerator(seeds, match_number_start_val=start_val)
+        # the matches are new, so there are no winning teams to propagate
+        # with SparringTeamMatch.record_result()
+        matches = [SparringTeamMatch(division=self,
+                number=bracket_match.number,
+                round_num=bracket_match.round_num,
+                round_slot=bracket_match.round_slot,
+                blue_team=bracket_match.blue_team,
+                red_team=bracket_match.red_team)
+                for bracket_match in bracket]
+
+        with transaction.atomic(), self._rebuild():
+            SparringTeamMatch.objects.filter(division=self).delete()
+            SparringTeamMatch.objects.bulk_create(matches)
+            bracket_graphs.invalidate(self.pk)
+            transaction.on_commit(lambda: division_matches_rebuilt.send(
+                    sender=TournamentSparringDivision,
+                    tournament_division=self))
+
+    def get_seeds(self, team_registration=None, seed=None):
+        """
+        Returns the teams of this division keyed by seed. If
+        team_registration is given, it is moved to seed (or unseeded if
+        seed is None), so that the resulting bracket can be previewed
+        before the change is saved.
+        """
+        seeded_teams = SparringTeamRegistration.objects.filter(
+                tournament_division=self, seed__isnull=False)
+        seeds = {team.seed:team for team in seeded_teams
+                if team_registration is None or team.pk != team_registration.pk}
+        if team_registration is not None and seed is not None:
+            seeds[seed] = team_registration
+        return seeds
+
+    def diff_matches_from_slots(self, seeds=None):
+        """
+        Compares the bracket generated from seeds (by default the current
+        seeds of the division) with the existing matches of the division,
+        by (round_num, round_slot), and returns a BracketDiff.
+
+        A match keeps its result as long as it is fought between the same
+        two teams, so results in subtrees not affected by the seeding
+        change are preserved. The rounds are compared from the first round
+        to the final so that a changed or erased result propagates to the
+        matches that follow it.
+        """
+        if seeds is None:
+            seeds = self.get_seeds()
+        start_val = self.division.match_number_start_val()
+        bracket = BracketGenerator(seeds, match_number_start_val=start_val)
+        existing_matches = {(match.round_num, match.round_slot): match
+                for match in SparringTeamMatch.objects.filter(division=self)}
+        winning_teams = {}
+        diff = BracketDiff()
         for bracket_match in bracket:
-            match = SparringTeamMatch(division=self,
-                    number=bracket_match.number,
-                    round_num = bracket_match.round_num,
-                    round_slot = bracket_match.round_slot)
-
-            try:
-                match.blue_team = bracket_match.blue_team
-            except AttributeError:
-                pass
-            try:
-                bracket_match.red_team
-            except: pass
-            try:
-                match.red_team = bracket_match.red_team
-            except AttributeError:
-                pass
-
-            match.clean()
-            match.save()
+            round_key = (bracket_match.round_num, bracket_match.round_slot)
+            team_ids = []
+            for side, team in enumerate((bracket_match.blue_team,
+                    bracket_match.red_team)):
+                if team is not None:
+                    team_ids.append(team.pk)
+                    continue
+                team_ids.append(winning_teams.get((bracket_match.round_num + 1,
+                        bracket_match.round_slot * 2 + side)))
+            blue_team_id, red_team_id = team_ids
+
+            match = existing_matches.pop(round_key, None)
+            if match is None:
+                diff.created.append(SparringTeamMatch(division=self,
+                        number=bracket_match.number,
+                        round_num=bracket_match.round_num,
+                        round_slot=bracket_match.round_slot,
+                        blue_team_id=blue_team_id, red_team_id=red_team_id))
+                continue
+
+            match_changed = match.number != bracket_match.number
+            match.number = bracket_match.number
+            if (match.blue_team_id, match.red_team_id) != tuple(team_ids):
+                if match.winning_team_id is not None:
+                    diff.lost_results.append(match)
+                match.blue_team_id = blue_team_id
+                match.red_team_id = red_team_id
+                match.reset()
+                match_changed = True
+            if match_changed:
+                # stored as F('version') + 1 by update_matches_from_slots
+                match.version += 1
+                diff.updated.append(match)
+            winning_teams[round_key] = match.winning_team_id
+
+        diff.deleted = list(existing_matches.values())
+        diff.lost_results.extend(match for match in diff.deleted
+                if match.winning_team_id is not None)
+        return diff
+
+    def update_matches_from_slots(self, seeds=None):
+        """
+        Brings the matches of this division in line with its seeds, only
+        writing the matches that changed (see diff_matches_from_slots).
+        Returns the applied BracketDiff.
+        """
+        diff = self.diff_matches_from_slots(seeds)
+        if not diff.has_changes():
+            return diff
+        with transaction.atomic(), self._rebuild():
+            SparringTeamMatch.objects.filter(
+                    pk__in=[match.pk for match in diff.deleted]).delete()
+            # move the updated matches out of the way of the new match
+            # numbers, to satisfy the (division, number) constraint
+            SparringTeamMatch.objects.filter(
+                    pk__in=[match.pk for match in diff.updated]).update(
+                    number=F('number') + BracketDiff.RENUMBER_OFFSET,
+                    version=F('version') + 1)
+            SparringTeamMatch.objects.bulk_update(diff.updated,
+                    BracketDiff.UPDATED_FIELDS)
+            SparringTeamMatch.objects.bulk_create(diff.created)
+            bracket_graphs.invalidate(self.pk)
+            transaction.on_commit(lambda: division_matches_rebuilt.send(
+                    sender=TournamentSparringDivision,
+                    tournament_division=self))
+        return diff
+
+class BracketDiff():
+    RENUMBER_OFFSET = 1000000
+    UPDATED_FIELDS = ['number', 'blue_team', 'red_team', 'winning_team',
+            'in_holding', 'at_ring', 'competing', 'ring_number',
+            'ring_assignment_time']
+
+    def __init__(self):
+        self.created = []
+        self.updated = []
+        self.deleted = []
+        self.lost_results = []
+
+    def has_changes(self):
+        return bool(self.created or self.updated or self.deleted)
+
+    def __str__(self):
+        if not self.has_changes():
+            return "No changes"
+        return "%d created, %d updated, %d deleted, %d results lost" %(
+                len(self.created), len(self.updated), len(self.deleted),
+                len(self.lost_results))
 
 class TournamentSparringDivisionBeltRanks(models.Model):
     belt_rank = BeltRankField()
@@ -558,6 +1017,30 @@ class SparringTeam(models.Model):
     def __str__(self):
         return "%s %s%d" %(str(self.school), str(self.division), self.number,)
 
+    @classmethod
+    def get_teams_by_key(cls, team_keys):
+        """
+        Returns the SparringTeams identified by team_keys, a collection of
+        (school_id, division_id, number) tuples, keyed by those tuples.
+
+        Only teams of the requested schools, divisions and numbers are
+        loaded, so the cost depends on the number of keys and not on the
+        size of the SparringTeam table.
+        """
+        team_keys = set(team_keys)
+        if not team_keys:
+            return {}
+        school_ids, division_ids, numbers = map(set, zip(*team_keys))
+        teams = cls.objects.filter(school__in=school_ids,
+                division__in=division_ids, number__in=numbers).select_related(
+                'school', 'division')
+        teams_by_key = {}
+        for team in teams:
+            team_key = (team.school_id, team.division_id, team.number)
+            if team_key in team_keys:
+                teams_by_key[team_key] = team
+        return teams_by_key
+
     def match_sheet_name(self):
         if self.school.short_name:
             school_name = self.school.short_name
@@ -671,6 +1154,8 @@ class SparringTeamMatch(models.Model):
         ring_assignment_time
                         The time at which the ring was assigned
         winning_team    The winner of the SparringTeamMatch
+        version         Incremented on every save, so that a client can
+                        detect that the match changed since it was read
     """
     division = models.ForeignKey(TournamentSparringDivision, on_delete=models.CASCADE)
     number = models.PositiveIntegerField()
@@ -689,16 +1174,61 @@ class SparringTeamMatch(models.Model):
     in_holding = models.BooleanField(default=False)
     at_ring = models.BooleanField(default=False)
     competing = models.BooleanField(default=False)
+    version = models.PositiveIntegerField(default=0)
+
+    # the fields that match list clients can change
+    UPDATABLE_FIELDS = ('ring_number', 'in_holding', 'at_ring', 'competing',
+            'winning_team',)
 
     class Meta:
         unique_together = (
                 ("division", "round_num", "round_slot"),
                 ("division", "number",),
         )
+        indexes = [
+            # the match queue of a ring
+            models.Index(fields=['ring_number', 'number'],
+                    name='tmdb_match_ring_number_idx'),
+        ]
+
+    # the ring_number the match had when it was read from the database, so
+    # that the clients of that ring are told when it leaves the ring
+    loaded_ring_number = None
 
     def __str__(self):
         return "Match #" + str(self.number)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        match = super(SparringTeamMatch, cls).from_db(db, field_names, values)
+        match.loaded_ring_number = match.__dict__.get('ring_number')
+        return match
+
+    def save(self, *args, **kwargs):
+        version = self.version
+        if not self._state.adding:
+            # incremented by the UPDATE, so that concurrent saves of
+            # separately loaded instances each bump the version; the
+            # instance gets version + 1, which is the stored version if the
+            # match was locked when it was read
+            self.version = F('version') + 1
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'version' not in update_fields:
+            kwargs['update_fields'] = list(update_fields) + ['version']
+        try:
+            super(SparringTeamMatch, self).save(*args, **kwargs)
+        finally:
+            self.version = version
+        self.version += 1
+        # the post_save receivers have seen the ring the match left
+        self.loaded_ring_number = self.ring_number
+
+    def reset(self):
+        """Clears the result and the ring status of the match."""
+        self.winning_team = None
+        self.in_holding = self.at_ring = self.competing = False
+        self.ring_number = self.ring_assignment_time = None
+
     def status(self):
         if self.winning_team:
                 return "Complete"
@@ -719,22 +1249,35 @@ class SparringTeamMatch(models.Model):
             return "Quarter-Finals"
         return "Round of %d" %(1 << (self.round_num))
 
+    def _get_bracket_matches(self, round_keys, for_update=False):
+        """
+        Returns the matches of this division at round_keys (or None where
+        there is no match) with one query, locked if for_update is True.
+        """
+        # the finals have no next round
+        bracket_keys = [round_key for round_key in round_keys
+                if round_key[0] >= 0]
+        matches = {}
+        if bracket_keys:
+            queryset = SparringTeamMatch.objects.filter(
+                    division_id=self.division_id)
+            if for_update:
+                queryset = queryset.select_for_update()
+            round_key_filter = models.Q()
+            for round_num, round_slot in bracket_keys:
+                round_key_filter |= models.Q(round_num=round_num,
+                        round_slot=round_slot)
+            matches = {(match.round_num, match.round_slot): match
+                    for match in queryset.filter(round_key_filter)}
+        return [matches.get(round_key) for round_key in round_keys]
+
     def get_previous_round_matches(self):
-        upper_match_query = SparringTeamMatch.objects.filter(
-                division=self.division, round_num=self.round_num + 1,
-                round_slot=2*self.round_slot)
-        lower_match_query = SparringTeamMatch.objects.filter(
-                division=self.division, round_num=self.round_num + 1,
-                round_slot=2*self.round_slot + 1)
-        return [upper_match_query.first(), lower_match_query.first()]
-
-    def get_next_round_match(self):
-        try:
-            return SparringTeamMatch.objects.get(division=self.division,
-                    round_num=self.round_num-1,
-                    round_slot = self.round_slot / 2)
-        except SparringTeamMatch.DoesNotExist:
-            return None
+        return self._get_bracket_matches(BracketGraph.previous_round_keys(
+                self.round_num, self.round_slot))
+
+    def get_next_round_match(self, for_update=False):
+        return self._get_bracket_matches([BracketGraph.next_round_key(
+                self.round_num, self.round_slot)], for_update)[0]
 
     @staticmethod
     def get_matches_by_round(tournament_division):
@@ -746,27 +1289,179 @@ class SparringTeamMatch(models.Model):
             num_rounds = max(num_rounds, match.round_num)
         return matches, num_rounds
 
-    def update_winning_team(self):
-        parent_match = self.get_next_round_match()
-        if not parent_match:
-            return
-        if parent_match.winning_team:
-            raise IntegrityError("Unable to update match - match #%d's winning team must be removed first" %(parent_match.number))
-        if self.round_slot % 2:
-            if parent_match.red_team == self.winning_team:
-                return
-            parent_match.red_team = self.winning_team
-        else:
-            if parent_match.blue_team == self.winning_team:
-                return
-            parent_match.blue_team = self.winning_team
-        parent_match.clean()
-        parent_match.save()
+    @staticmethod
+    def _lock_match_and_next_round_match(match_id):
+        """
+        Returns the match with id match_id and the match its winner advances
+        to (or None), locked, the earlier round first. If the BracketGraph
+        of the division is loaded, it gives the round of the match, so that
+        both are read with one query; otherwise the graph is loaded for the
+        next result of the division.
+        """
+        queryset = SparringTeamMatch.objects.select_for_update()
+        division_id, bracket_graph = bracket_graphs.find(match_id)
+        if bracket_graph is not None:
+            round_key = bracket_graph.round_keys[match_id]
+            next_round_key = BracketGraph.next_round_key(*round_key)
+            matches = {(match.division_id, match.round_num,
+                    match.round_slot): match for match in queryset.filter(
+                    models.Q(pk=match_id) | models.Q(division_id=division_id,
+                            round_num=next_round_key[0],
+                            round_slot=next_round_key[1])).order_by(
+                    '-round_num')}
+            match = matches.get((division_id,) + round_key)
+            if match is not None and match.pk == match_id:
+                return match, matches.get((division_id,) + next_round_key)
+            bracket_graphs.invalidate(division_id)
+        match = queryset.get(pk=match_id)
+        bracket_graphs.get(match.division_id)
+        return match, match.get_next_round_match(for_update=True)
 
-    def clean(self, *args, **kwargs):
-        self.update_winning_team()
+    @staticmethod
+    def record_result(match_id, winning_team_id, expected_version=None):
+        """
+        Sets the winning team (or None, to clear the result) of the match
+        with id match_id and advances it to the next round match. Both
+        matches are locked, the earlier round first, and written in one
+        transaction; they are read with one query once the BracketGraph of
+        the division is loaded.
+
+        Raises MatchVersionConflict if expected_version is given and the
+        match has been saved since that version was read, and
+        IntegrityError if winning_team_id is not fighting in the match or
+        the next round match already has a result. Returns the changed
+        matches.
+        """
+        with transaction.atomic():
+            match, parent_match = \
+                    SparringTeamMatch._lock_match_and_next_round_match(
+                            match_id)
+            if expected_version is not None \
+                    and match.version != expected_version:
+                raise MatchVersionConflict("Unable to update match - match #%d has been changed by someone else, please reload the page" %(match.number))
+            if winning_team_id is not None and winning_team_id not in (
+                    match.blue_team_id, match.red_team_id):
+                raise IntegrityError("Unable to update match - the winning team of match #%d must be fighting in it" %(match.number))
+            if match.winning_team_id == winning_team_id:
+                return []
+
+            changed_matches = [match]
+            if parent_match is not None:
+                side = 'red_team_id' if match.round_slot % 2 \
+                        else 'blue_team_id'
+                if getattr(parent_match, side) != winning_team_id:
+                    if parent_match.winning_team_id is not None:
+                        raise IntegrityError("Unable to update match - match #%d's winning team must be removed first" %(parent_match.number))
+                    setattr(parent_match, side, winning_team_id)
+                    parent_match.save()
+                    changed_matches.append(parent_match)
+            match.winning_team_id = winning_team_id
+            match.save()
+        return changed_matches
+
+    @staticmethod
+    def apply_updates(updates):
+        """
+        Applies updates, a list of (match_id, fields, expected_version)
+        tuples where fields maps names in UPDATABLE_FIELDS to new values, in
+        one transaction. The matches are fetched and locked with one query;
+        a new winning_team is recorded with record_result.
+
+        Raises MatchVersionConflict if a match has been saved since its
+        expected_version (if not None) was read, ValidationError if a field
+        cannot be updated or has an invalid value, and
+        SparringTeamMatch.DoesNotExist if a match does not exist; nothing is
+        written then. Returns the changed matches.
+        """
+        changed_matches = {}
+        with transaction.atomic():
+            matches = SparringTeamMatch.objects.select_for_update().in_bulk(
+                    [match_id for match_id, _, _ in updates])
+            versions = {match.pk: match.version for match in matches.values()}
+            for match_id, fields, expected_version in updates:
+                match = matches.get(match_id)
+                if match is None:
+                    raise SparringTeamMatch.DoesNotExist("Unable to update match - match %s does not exist" %(match_id,))
+                if expected_version is not None \
+                        and versions[match.pk] != expected_version:
+                    raise MatchVersionConflict("Unable to update match - match #%d has been changed by someone else, please reload the page" %(match.number))
+                changed_fields = []
+                for field_name, value in fields.items():
+                    if field_name not in SparringTeamMatch.UPDATABLE_FIELDS:
+                        raise ValidationError("Unable to update match - %s cannot be changed" %(field_name,))
+                    if field_name == 'winning_team':
+                        continue
+                    field = SparringTeamMatch._meta.get_field(field_name)
+                    setattr(match, field.attname, field.clean(value, match))
+                    changed_fields.append(field.attname)
+                if changed_fields:
+                    match.save(update_fields=changed_fields)
+                    changed_matches[match.pk] = match
+                if 'winning_team' in fields:
+                    winning_team_id = SparringTeamMatch._meta.get_field(
+                            'winning_team').to_python(fields['winning_team'])
+                    for changed_match in SparringTeamMatch.record_result(
+                            match.pk, winning_team_id):
+                        changed_matches[changed_match.pk] = changed_match
+                        if changed_match.pk in matches:
+                            matches[changed_match.pk] = changed_match
+        return list(changed_matches.values())
+
+def _load_bracket_graph_matches(division_id):
+    return SparringTeamMatch.objects.filter(division_id=division_id)\
+            .values_list('id', 'round_num', 'round_slot')
+
+bracket_graphs = BracketGraphCache(_load_bracket_graph_matches)
+
+@receiver(post_save, sender=SparringTeamMatch,
+        dispatch_uid="invalidate_bracket_graph_on_save")
+def invalidate_bracket_graph_on_save(sender, instance, created, **kwargs):
+    if created:
+        bracket_graphs.invalidate(instance.division_id)
+
+@receiver(post_delete, sender=SparringTeamMatch,
+        dispatch_uid="invalidate_bracket_graph_on_delete")
+def invalidate_bracket_graph_on_delete(sender, instance, **kwargs):
+    bracket_graphs.invalidate(instance.division_id)
+
+@receiver(division_matches_rebuilt, sender=TournamentSparringDivision,
+        dispatch_uid="invalidate_bracket_graph_on_rebuild")
+def invalidate_bracket_graph_on_rebuild(sender, tournament_division,
+        **kwargs):
+    bracket_graphs.invalidate(tournament_division.pk)
 
 class ConfigurationSetting(models.Model):
     key = models.TextField(unique=True)
     value = models.TextField()
     REGISTRATION_CREDENTIALS = 'registration_credentials'
+
+class CacheVersion(models.Model):
+    """
+    The version under which cached data (e.g. the snapshot of a tournament)
+    is stored, kept in the database rather than in the cache, so that
+    processes changing the data concurrently each get their own version and
+    an evicted cache entry cannot reset it.
+    """
+    key = models.CharField(max_length=64, unique=True)
+    version = models.BigIntegerField()
+
+    @classmethod
+    def get_version(cls, key, initial_version):
+        version = cls.objects.filter(key=key).values_list('version',
+                flat=True).first()
+        if version is None:
+            version = cls.objects.get_or_create(key=key,
+                    defaults={'version': initial_version})[0].version
+        return version
+
+    @classmethod
+    def bump_version(cls, key, initial_version):
+        """Increments the version of key (created at initial_version if it
+        does not exist) with one UPDATE, and returns the new version."""
+        versions = cls.objects.filter(key=key)
+        with transaction.atomic():
+            if not versions.update(version=F('version') + 1):
+                cls.objects.get_or_create(key=key,
+                        defaults={'version': initial_version})
+                versions.update(version=F('version') + 1)
+            return versions.values_list('version', flat=True).get()
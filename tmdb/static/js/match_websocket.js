@@ -13,8 +13,14 @@ tmdb_vars_MATCH_STATUS_CODE_COMPLETE = 8;
 
 tmdb_vars_MAX_NUM_RINGS = 9;
 
+tmdb_vars_MIN_RECONNECT_DELAY = 1000;
+tmdb_vars_MAX_RECONNECT_DELAY = 30000;
+
 function delete_tourament_datum(datum) {
   datum.model = datum.model.replace(".", "_");
+  if (datum.model == "tmdb_sparringteammatch") {
+    unindex_team_match(tmdb_vars.tournament_data[datum.model][datum.pk]);
+  }
   delete tmdb_vars.tournament_data[datum.model][datum.pk];
 }
 
@@ -27,12 +33,116 @@ function store_tournament_datum(datum) {
   if (tmdb_vars.tournament_data[datum.model] == undefined) {
     tmdb_vars.tournament_data[datum.model] = {};
   }
+  if (datum.model == "tmdb_sparringteammatch") {
+    unindex_team_match(tmdb_vars.tournament_data[datum.model][datum.pk]);
+    index_team_match(datum);
+  }
   tmdb_vars.tournament_data[datum.model][datum.pk] = datum;
 }
 
+// Returns the pks of the deleted and the new matches of the division.
+function replace_division_matches(division_id, team_matches) {
+  var stored_matches = tmdb_vars.tournament_data.tmdb_sparringteammatch || {};
+  var changed_pks = Array.from(
+      tmdb_vars.indexes.matches_by_division[division_id] || []);
+  changed_pks.forEach(function(team_match_pk) {
+    unindex_team_match(stored_matches[team_match_pk]);
+    delete stored_matches[team_match_pk];
+  });
+  team_matches.map(store_tournament_datum);
+  return changed_pks.concat(team_matches.map(team_match => team_match.pk));
+}
+
+// Builds the secondary indexes of the loaded data: the display strings and
+// schools of the team registrations, the schools registered for the
+// tournament, and the matches by division, ring, school and whether they
+// are active. The match indexes are kept up to date as matches are stored
+// and deleted; the rest only changes with a new snapshot.
+function build_indexes() {
+  var tournament_data = tmdb_vars.tournament_data;
+  var indexes = {
+    team_registration_names: {},
+    team_registration_schools: {},
+    school_ids: [],
+    matches_by_division: {},
+    matches_by_ring: {},
+    matches_by_school: {},
+    active_matches: new Set(),
+  };
+  tmdb_vars.indexes = indexes;
+  Object.values(tournament_data.tmdb_sparringteamregistration || {}).forEach(
+      function(team_registration) {
+    var team = tournament_data.tmdb_sparringteam[team_registration.fields.team];
+    indexes.team_registration_schools[team_registration.pk] = team.fields.school;
+    indexes.team_registration_names[team_registration.pk] =
+        format_team_registration(team_registration);
+  });
+  indexes.school_ids = Object.values(
+      tournament_data.tmdb_schooltournamentregistration || {}).map(
+      x => tournament_data.tmdb_schoolseasonregistration[
+          x.fields.school_season_registration].fields.school);
+  Object.values(tournament_data.tmdb_sparringteammatch || {}).forEach(
+      index_team_match);
+}
+
+function add_to_index(index, key, team_match_pk) {
+  if (key == null) {
+    return;
+  }
+  if (index[key] === undefined) {
+    index[key] = new Set();
+  }
+  index[key].add(team_match_pk);
+}
+
+function remove_from_index(index, key, team_match_pk) {
+  if (key == null || index[key] === undefined) {
+    return;
+  }
+  index[key].delete(team_match_pk);
+}
+
+function get_team_match_school_ids(team_match) {
+  var team_registration_schools = tmdb_vars.indexes.team_registration_schools;
+  return [team_match.fields.blue_team, team_match.fields.red_team].filter(
+      team_registration_id => team_registration_id != null).map(
+      team_registration_id => team_registration_schools[team_registration_id]);
+}
+
+function update_team_match_indexes(team_match, update_index) {
+  var indexes = tmdb_vars.indexes;
+  update_index(indexes.matches_by_division, team_match.fields.division,
+      team_match.pk);
+  update_index(indexes.matches_by_ring, team_match.fields.ring_number,
+      team_match.pk);
+  get_team_match_school_ids(team_match).forEach(function(school_id) {
+    update_index(indexes.matches_by_school, school_id, team_match.pk);
+  });
+}
+
+function index_team_match(team_match) {
+  if (tmdb_vars.indexes == null) {
+    return;
+  }
+  update_team_match_indexes(team_match, add_to_index);
+  if (is_active_match(team_match)) {
+    tmdb_vars.indexes.active_matches.add(team_match.pk);
+  }
+}
+
+function unindex_team_match(team_match) {
+  if (tmdb_vars.indexes == null || team_match === undefined) {
+    return;
+  }
+  update_team_match_indexes(team_match, remove_from_index);
+  tmdb_vars.indexes.active_matches.delete(team_match.pk);
+}
+
 function store_initial_data(msg_json) {
   var msg_data = JSON.parse(msg_json);
+  tmdb_vars.indexes = null;
   msg_data.map(store_tournament_datum);
+  build_indexes();
 }
 
 function createTextElem(elem_type, elem_content) {
@@ -57,29 +167,44 @@ function render_updated_display() {
   render_full_display();
 }
 
+// A filter is a predicate, tmdb_vars.team_match_filter, and the function
+// tmdb_vars.team_match_filter_candidates, which returns the pks of the
+// matches that can pass it from the indexes (or null for all matches), so
+// that a filtered view only has to look at those.
+function set_team_match_filter(team_match_filter, team_match_filter_candidates) {
+  tmdb_vars.team_match_filter = team_match_filter;
+  tmdb_vars.team_match_filter_candidates = team_match_filter_candidates;
+}
+
 function set_show_all_filter() {
-  tmdb_vars.team_match_filter = function(team_match) {
+  set_team_match_filter(function(team_match) {
     return true;
-  }
+  }, function() {
+    return null;
+  });
 }
 
-function set_active_matches_filter() {
-  tmdb_vars.team_match_filter = function(team_match) {
-    var match_status = evaluate_status(team_match);
-     if (match_status['match_status_code'] == tmdb_vars_REPORT_STATUS_COMPETING_VALUE) {
-        return true;
-     }
-    if (match_status['match_status_code'] == tmdb_vars_MATCH_STATUS_CODE_SENT_IN_HOLDING) {
-      return true;
-    }
-    if (match_status['match_status_code'] == tmdb_vars_MATCH_STATUS_CODE_SENT_TO_RING) {
-      return true;
-    }
-    if (match_status['match_status_code'] == tmdb_vars_MATCH_STATUS_CODE_AT_RING) {
+function is_active_match(team_match) {
+  var match_status = evaluate_status(team_match);
+   if (match_status['match_status_code'] == tmdb_vars_REPORT_STATUS_COMPETING_VALUE) {
       return true;
-    }
-    return false;
+   }
+  if (match_status['match_status_code'] == tmdb_vars_MATCH_STATUS_CODE_SENT_IN_HOLDING) {
+    return true;
   }
+  if (match_status['match_status_code'] == tmdb_vars_MATCH_STATUS_CODE_SENT_TO_RING) {
+    return true;
+  }
+  if (match_status['match_status_code'] == tmdb_vars_MATCH_STATUS_CODE_AT_RING) {
+    return true;
+  }
+  return false;
+}
+
+function set_active_matches_filter() {
+  set_team_match_filter(is_active_match, function() {
+    return tmdb_vars.indexes.active_matches;
+  });
 }
 
 function set_ring_number_filter() {
@@ -88,11 +213,13 @@ function set_ring_number_filter() {
   filter_value_type.setAttribute('id', 'ring_number_filter');
   filter_value_type.setAttribute('type', 'number');
   $(filter_value_type).on('change', function(e) {
-    var filter_ring_number = $(e.currentTarget).val();
-    if (typeof parseInt(filter_ring_number) == 'number') {
-      tmdb_vars.team_match_filter = function(team_match) {
+    var filter_ring_number = parseInt($(e.currentTarget).val());
+    if (!isNaN(filter_ring_number)) {
+      set_team_match_filter(function(team_match) {
         return team_match.fields.ring_number == filter_ring_number;
-      }
+      }, function() {
+        return tmdb_vars.indexes.matches_by_ring[filter_ring_number] || [];
+      });
     } else {
       set_show_all_filter();
     }
@@ -101,25 +228,29 @@ function set_ring_number_filter() {
   filter_value_div.appendChild(filter_value_type);
 }
 
-function set_division_filter() {
-  var filter_value_div = document.getElementById('filter_value');
-  var filter_value_type = document.createElement('select');
-  filter_value_div.appendChild(filter_value_type);
-
-  var division_objs = Object.values(tmdb_vars.tournament_data.tmdb_sparringdivision);
-  var division_names = division_objs.map(x => x.pk).map(render_division_name).sort();
-
+// Adds an option for each of ids to select_menu, sorted by name.
+function add_filter_value_options(select_menu, ids, render_name) {
   var option = document.createElement('option');
   option.value = '';
   option.text = '---';
-  filter_value_type.appendChild(option);
+  select_menu.appendChild(option);
 
-  for (var division_num = 0; division_num < division_names.length; division_num++) {
+  ids.map(id => [render_name(id), id]).sort().forEach(function(name_id) {
     var option = document.createElement('option');
-    option.value = division_names[division_num];
-    option.text = division_names[division_num];
-    filter_value_type.appendChild(option);
-  }
+    option.value = name_id[1];
+    option.text = name_id[0];
+    select_menu.appendChild(option);
+  });
+}
+
+function set_division_filter() {
+  var filter_value_div = document.getElementById('filter_value');
+  var filter_value_type = document.createElement('select');
+  filter_value_div.appendChild(filter_value_type);
+
+  add_filter_value_options(filter_value_type,
+      Object.keys(tmdb_vars.tournament_data.tmdb_sparringdivision),
+      render_division_name);
 
   $(filter_value_type).on('change', function(e) {
     var selected_division = $(e.currentTarget).find(":selected").val();
@@ -128,9 +259,15 @@ function set_division_filter() {
       render_full_display();
       return;
     }
-    tmdb_vars.team_match_filter = function(team_match) {
-      return get_division(team_match) == selected_division;
-    }
+    var tournament_division_ids = Object.values(
+        tmdb_vars.tournament_data.tmdb_tournamentsparringdivision).filter(
+        x => x.fields.division == selected_division).map(x => x.pk);
+    set_team_match_filter(function(team_match) {
+      return tournament_division_ids.indexOf(team_match.fields.division) >= 0;
+    }, function() {
+      return [].concat.apply([], tournament_division_ids.map(
+          x => Array.from(tmdb_vars.indexes.matches_by_division[x] || [])));
+    });
     render_full_display();
   });
 }
@@ -140,24 +277,8 @@ function set_school_filter() {
   var filter_value_type = document.createElement('select');
   filter_value_div.appendChild(filter_value_type);
 
-  var school_tournament_reg_objs = Object.values(tmdb_vars.tournament_data.tmdb_schooltournamentregistration);
-  var school_season_reg_ids = school_tournament_reg_objs.map(
-      x => x.fields.school_season_registration)
-  var school_ids = school_season_reg_ids.map(
-      x => tmdb_vars.tournament_data.tmdb_schoolseasonregistration[x].fields.school);
-  var school_names = school_ids.map(render_school_name).sort();
-
-  var option = document.createElement('option');
-  option.value = '';
-  option.text = '---';
-  filter_value_type.appendChild(option);
-
-  for (var school_num = 0; school_num < school_names.length; school_num++) {
-    var option = document.createElement('option');
-    option.value = school_names[school_num];
-    option.text = school_names[school_num];
-    filter_value_type.appendChild(option);
-  }
+  add_filter_value_options(filter_value_type, tmdb_vars.indexes.school_ids,
+      render_school_name);
 
   $(filter_value_type).on('change', function(e) {
     var selected_school = $(e.currentTarget).find(":selected").val();
@@ -166,19 +287,13 @@ function set_school_filter() {
       render_full_display();
       return;
     }
-    tmdb_vars.team_match_filter = function(team_match) {
-      var blue_school_name = get_school_name_from_team_registration(
-          team_match.fields.blue_team);
-      if (blue_school_name == selected_school) {
-        return true;
-      }
-      var red_school_name = get_school_name_from_team_registration(
-          team_match.fields.red_team);
-      if (red_school_name == selected_school) {
-        return true;
-      }
-      return false;
-    }
+    selected_school = parseInt(selected_school);
+    set_team_match_filter(function(team_match) {
+      return get_team_match_school_ids(team_match).indexOf(
+          selected_school) >= 0;
+    }, function() {
+      return tmdb_vars.indexes.matches_by_school[selected_school] || [];
+    });
     render_full_display();
   });
 }
@@ -226,7 +341,11 @@ function add_filter_options() {
 }
 
 function render_full_display() {
+  tmdb_vars.match_tables = null;
+  tmdb_vars.visible_matches = [];
+  tmdb_vars.visible_match_numbers = {};
   var match_queues = document.getElementsByClassName("division-queue");
+  var match_tables = [];
   for (var i = 0; i < match_queues.length; ++i) {
     match_queue = match_queues[i];
     match_queue.innerHTML = '';
@@ -237,8 +356,6 @@ function render_full_display() {
       match_queue.appendChild(empty_match_list);
       continue;
     }
-    var team_matches = Object.values(
-        tmdb_vars.tournament_data.tmdb_sparringteammatch);
 
     add_filter_options();
     var match_queue_table = document.createElement("table");
@@ -256,37 +373,119 @@ function render_full_display() {
     match_queue_row.appendChild(createTextElem("th", "Ring No."));
     match_queue_row.appendChild(createTextElem("th", "Winning Team"));
     match_queue_row.appendChild(createTextElem("th", "Status"));
-    team_matches = team_matches.sort(function(team_match1, team_match2) {
-      return team_match1.fields.number - team_match2.fields.number;
-    });
     var match_queue_table_body = document.createElement("tbody");
     match_queue_table.appendChild(match_queue_table_body);
-    team_matches.filter(tmdb_vars.team_match_filter).map(function(team_match) {
-      match_queue_row = document.createElement("tr");
-      match_queue_table_body.appendChild(match_queue_row);
-      match_queue_row.append(createTextElem("td", team_match.fields.number));
-      match_queue_row.append(createTextElem("td", render_round_num(team_match)));
-      match_queue_row.append(createTextElem("td", render_blue_team_name(team_match)));
-      match_queue_row.append(createTextElem("td", render_red_team_name(team_match)));
-      match_queue_row.append(createObjectElem("td", render_report_status(team_match)));
-      match_queue_row.append(createObjectElem("td", render_ring_number(team_match)));
-      match_queue_row.append(createObjectElem("td", render_winning_team(team_match)));
-      match_queue_row.append(createTextElem("td", render_status(team_match)));
-      var match_status = evaluate_status(team_match);
-      match_queue_row.className = match_status['match_status_css_class'];
+    match_tables.push({body: match_queue_table_body, rows: {}});
+  }
+  if (!match_tables.length) {
+    return;
+  }
+  tmdb_vars.match_tables = match_tables;
+
+  var stored_matches = tmdb_vars.tournament_data.tmdb_sparringteammatch;
+  var candidate_pks = tmdb_vars.team_match_filter_candidates();
+  var team_matches = candidate_pks == null ? Object.values(stored_matches)
+      : Array.from(candidate_pks, x => stored_matches[x]);
+  team_matches.filter(tmdb_vars.team_match_filter).sort(function(
+      team_match1, team_match2) {
+    return compare_match_order(team_match1.fields.number, team_match1.pk,
+        team_match2.fields.number, team_match2.pk);
+  }).map(function(team_match) {
+    tmdb_vars.visible_matches.push(
+        {pk: team_match.pk, number: team_match.fields.number});
+    tmdb_vars.visible_match_numbers[team_match.pk] = team_match.fields.number;
+    match_tables.forEach(function(match_table) {
+      var match_row = render_match_row(team_match);
+      match_table.body.appendChild(match_row);
+      match_table.rows[team_match.pk] = match_row;
     });
+  });
+}
+
+function render_match_row(team_match) {
+  var match_queue_row = document.createElement("tr");
+  match_queue_row.append(createTextElem("td", team_match.fields.number));
+  match_queue_row.append(createTextElem("td", render_round_num(team_match)));
+  match_queue_row.append(createTextElem("td", render_blue_team_name(team_match)));
+  match_queue_row.append(createTextElem("td", render_red_team_name(team_match)));
+  match_queue_row.append(createObjectElem("td", render_report_status(team_match)));
+  match_queue_row.append(createObjectElem("td", render_ring_number(team_match)));
+  match_queue_row.append(createObjectElem("td", render_winning_team(team_match)));
+  match_queue_row.append(createTextElem("td", render_status(team_match)));
+  var match_status = evaluate_status(team_match);
+  match_queue_row.className = match_status['match_status_css_class'];
+  return match_queue_row;
+}
+
+// Matches are listed by match number (and pk, to break ties).
+function compare_match_order(number1, pk1, number2, pk2) {
+  if (number1 != number2) {
+    return number1 - number2;
   }
+  return pk1 - pk2;
 }
 
-function get_division(match) {
-  if (match == null) {
-    return null;
+// Returns the position of a match in tmdb_vars.visible_matches, the list of
+// the displayed matches in display order, with a binary search.
+function visible_match_index(number, pk) {
+  var visible_matches = tmdb_vars.visible_matches;
+  var low = 0;
+  var high = visible_matches.length;
+  while (low < high) {
+    var mid = (low + high) >> 1;
+    if (compare_match_order(visible_matches[mid].number,
+        visible_matches[mid].pk, number, pk) < 0) {
+      low = mid + 1;
+    } else {
+      high = mid;
+    }
+  }
+  return low;
+}
+
+function remove_match_row(team_match_pk) {
+  var number = tmdb_vars.visible_match_numbers[team_match_pk];
+  if (number === undefined) {
+    return;
+  }
+  tmdb_vars.visible_matches.splice(
+      visible_match_index(number, team_match_pk), 1);
+  delete tmdb_vars.visible_match_numbers[team_match_pk];
+  tmdb_vars.match_tables.forEach(function(match_table) {
+    match_table.rows[team_match_pk].remove();
+    delete match_table.rows[team_match_pk];
+  });
+}
+
+function insert_match_row(team_match) {
+  var index = visible_match_index(team_match.fields.number, team_match.pk);
+  var next_match = tmdb_vars.visible_matches[index];
+  tmdb_vars.visible_matches.splice(index, 0,
+      {pk: team_match.pk, number: team_match.fields.number});
+  tmdb_vars.visible_match_numbers[team_match.pk] = team_match.fields.number;
+  tmdb_vars.match_tables.forEach(function(match_table) {
+    var match_row = render_match_row(team_match);
+    var next_row = next_match ? match_table.rows[next_match.pk] : null;
+    match_table.body.insertBefore(match_row, next_row);
+    match_table.rows[team_match.pk] = match_row;
+  });
+}
+
+// Re-renders only the rows of the matches with the given pks, which have
+// been changed, added or deleted, instead of the whole table.
+function patch_match_rows(team_match_pks) {
+  if (tmdb_vars.match_tables == null) {
+    render_full_display();
+    return;
   }
-  var tournament_division = tmdb_vars.tournament_data.tmdb_tournamentsparringdivision[match.fields.division];
-  var division = tmdb_vars.tournament_data.tmdb_sparringdivision[tournament_division.fields.division];
-  var tournamentdivision_id = match.fields.division;
-  var division_str = render_division_name(tournament_division.fields.division);
-return division_str + "";
+  var team_matches = tmdb_vars.tournament_data.tmdb_sparringteammatch || {};
+  team_match_pks.forEach(function(team_match_pk) {
+    remove_match_row(team_match_pk);
+    var team_match = team_matches[team_match_pk];
+    if (team_match !== undefined && tmdb_vars.team_match_filter(team_match)) {
+      insert_match_row(team_match);
+    }
+  });
 }
 
 function render_round_num(team_match) {
@@ -313,7 +512,10 @@ function render_team_registration(team_registration_id) {
   if (team_registration_id == null) {
     return null;
   }
-  var team_registration = tmdb_vars.tournament_data.tmdb_sparringteamregistration[team_registration_id];
+  return tmdb_vars.indexes.team_registration_names[team_registration_id];
+}
+
+function format_team_registration(team_registration) {
   var team_id = team_registration.fields.team;
   var team = tmdb_vars.tournament_data.tmdb_sparringteam[team_id];
   var school_str = render_school_name(team.fields.school);
@@ -507,33 +709,132 @@ function evaluate_status(team_match) {
   };
 }
 
+// Converts the compact rows of a match update ({model, fields, rows}, with
+// the pk first in each row) to data in the format of the snapshot.
+function expand_compact_data(compact_data) {
+  return compact_data.rows.map(function(row) {
+    var datum = {model: compact_data.model, pk: row[0], fields: {}};
+    for (var field_num = 0; field_num < compact_data.fields.length; field_num++) {
+      datum.fields[compact_data.fields[field_num]] = row[field_num + 1];
+    }
+    return datum;
+  });
+}
+
+// Applies a change to the loaded data, returning the pks of the changed
+// matches.
+function apply_change(change) {
+  var changed_pks = [];
+  if ('update' === change.message_type) {
+    changed_pks = expand_compact_data(change.message_content).map(
+        function(team_match) {
+      store_tournament_datum(team_match);
+      return team_match.pk;
+    });
+  }
+  if ('division_rebuilt' === change.message_type) {
+    changed_pks = replace_division_matches(change.message_content.division,
+        expand_compact_data(change.message_content.matches));
+  }
+  tmdb_vars.tournament_version = change.version;
+  return changed_pks;
+}
+
+// Applies a change broadcast by the server if it is the next one after the
+// loaded data. A client subscribed to a ring or division is only sent the
+// changes of its matches, each with the previous_version it was sent.
+// Returns the pks of the matches whose rows have to be updated.
+function handle_change(change) {
+  if (tmdb_vars.sync_pending) {
+    tmdb_vars.pending_changes.push(change);
+    return [];
+  }
+  if (change.version <= tmdb_vars.tournament_version) {
+    return [];
+  }
+  var previous_version = change.version - 1;
+  if (change.previous_version !== undefined) {
+    previous_version = change.previous_version;
+  }
+  if ('resync' === change.message_type
+      || previous_version > tmdb_vars.tournament_version) {
+    // missed a change (or it was not logged), catch up from the server
+    request_sync();
+    return [];
+  }
+  return apply_change(change);
+}
+
+// Applies the changes received while the data was being synced, returning
+// the pks of the changed matches.
+function apply_pending_changes() {
+  tmdb_vars.sync_pending = false;
+  var pending_changes = tmdb_vars.pending_changes;
+  tmdb_vars.pending_changes = [];
+  return [].concat.apply([], pending_changes.map(handle_change));
+}
+
 function handle_message(msg) {
   console.log(msg);
   var data = JSON.parse(msg.data);
   var message_type = data.message_type;
   var message_content = data.message_content;
-  if ('update' === message_type) {
-    message_content.map(store_tournament_datum);
+  if ('update' === message_type || 'division_rebuilt' === message_type
+      || 'resync' === message_type) {
+    patch_match_rows(handle_change(data));
+    return;
   }
-  if ('delete' === message_type) {
-    var delete_data = JSON.parse(data['delete']);
-    delete_data.map(delete_tourament_datum);
+  if ('changes' === message_type) {
+    var changed_pks = [].concat.apply([], message_content.filter(
+        function(change) {
+      return change.version > tmdb_vars.tournament_version;
+    }).map(apply_change));
+    tmdb_vars.tournament_version = data.version;
+    patch_match_rows(changed_pks.concat(apply_pending_changes()));
+    return;
+  }
+  if ('snapshot_required' === message_type) {
+    load_snapshot();
+    return;
+  }
+  if ('ack' === message_type) {
+    delete tmdb_vars.pending_updates[data.message_id];
+    patch_match_rows(expand_compact_data(message_content).map(
+        function(team_match) {
+      store_tournament_datum(team_match);
+      return team_match.pk;
+    }));
+    return;
   }
   if ('error' === message_type) {
+    var team_match_pk = tmdb_vars.pending_updates[data.message_id];
+    delete tmdb_vars.pending_updates[data.message_id];
     alert(message_content);
-    render_updated_display();
+    // puts back the values the update tried to change
+    if (team_match_pk !== undefined) {
+      patch_match_rows([team_match_pk]);
+    } else {
+      render_updated_display();
+    }
     return
   }
+  if ('delete' === message_type) {
+    var delete_data = JSON.parse(data['delete']);
+    delete_data.map(delete_tourament_datum);
+  }
   render_updated_display();
 }
 
-function on_websocket_open() {
-  tmdb_vars.tournament_data = {}
-
+// Fetches the snapshot of the tournament, which replaces any loaded data.
+function load_snapshot() {
   var init_data_req = new XMLHttpRequest();
   init_data_req.onreadystatechange = function() {
     if (init_data_req.readyState == 4 && init_data_req.status == 200) {
+      tmdb_vars.tournament_data = {};
       store_initial_data(init_data_req.responseText);
+      tmdb_vars.tournament_version = parseInt(
+          init_data_req.getResponseHeader("X-Tournament-Version"));
+      apply_pending_changes();
       render_initial_display();
       return;
     }
@@ -549,14 +850,57 @@ function on_websocket_open() {
   init_data_req.send(null);
 }
 
+// Asks the server for the changes since the loaded version, or loads the
+// snapshot if nothing has been loaded yet. Changes broadcast in the meantime
+// are queued until the data is up to date.
+function request_sync() {
+  if (tmdb_vars.sync_pending) {
+    return;
+  }
+  tmdb_vars.sync_pending = true;
+  tmdb_vars.pending_changes = [];
+  if (tmdb_vars.tournament_version == null) {
+    load_snapshot();
+    return;
+  }
+  tmdb_vars.match_update_ws.send(JSON.stringify({
+    message_type: "sync",
+    version: tmdb_vars.tournament_version,
+  }));
+}
+
+function on_websocket_open() {
+  tmdb_vars.reconnect_delay = tmdb_vars_MIN_RECONNECT_DELAY;
+  tmdb_vars.sync_pending = false;
+  request_sync();
+}
+
 function on_websocket_close() {
+  var num_pending_updates = Object.keys(tmdb_vars.pending_updates).length;
+  if (num_pending_updates) {
+    tmdb_vars.pending_updates = {};
+    alert("The connection to the server was lost before " + num_pending_updates + " update(s) were confirmed. Please check them once the page reconnects.");
+  }
   tmdb_vars.match_update_ws.send = function() {
-    alert("Operation failed. The connection to the server has been lost. Please reload the page.");
+    alert("Operation failed. The connection to the server has been lost. Reconnecting...");
     render_updated_display();
   }
-  setTimeout(function() {
-    alert("Lost connection to " + tmdb_vars.match_update_ws.url + "\n\nPlease reload the page.");
-  }, 5000);
+  // randomized, so that clients that lost their connections at the same time
+  // do not all reconnect at once
+  var delay = tmdb_vars.reconnect_delay * (1 + Math.random());
+  tmdb_vars.reconnect_delay = Math.min(tmdb_vars.reconnect_delay * 2,
+      tmdb_vars_MAX_RECONNECT_DELAY);
+  console.log("Lost connection to " + tmdb_vars.match_update_ws.url
+      + ", reconnecting in " + Math.round(delay) + "ms");
+  setTimeout(open_teammatch_websocket, delay);
+}
+
+function open_teammatch_websocket() {
+  console.log("Opening connection to " + tmdb_vars.match_update_ws_url);
+  tmdb_vars.match_update_ws = new WebSocket(tmdb_vars.match_update_ws_url);
+  tmdb_vars.match_update_ws.onmessage = handle_message;
+  tmdb_vars.match_update_ws.onopen = on_websocket_open;
+  tmdb_vars.match_update_ws.onclose = on_websocket_close;
 }
 
 function start_teammatch_websocket(tournament_slug, tournament_json_url) {
@@ -567,58 +911,53 @@ function start_teammatch_websocket(tournament_slug, tournament_json_url) {
   if (window.location.protocol == "http:") {
     ws_proto = "ws://"
   }
-  var ws_url = ws_proto + window.location.host + "/tmdb/tournament/ws/tournaments/" + tournament_slug + "/sparring_team_match_updates/";
+  tmdb_vars.match_update_ws_url = ws_proto + window.location.host + "/tmdb/tournament/ws/tournaments/" + tournament_slug + "/sparring_team_match_updates/";
   tmdb_vars.tournament_data.tournament_slug = tournament_slug;
   tmdb_vars.initial_tournament_data_url = window.location.protocol + "//" + window.location.host + tournament_json_url;
-  console.log("Opening connection to " + ws_url);
-  tmdb_vars.match_update_ws = new WebSocket(ws_url);
-  tmdb_vars.match_update_ws.onmessage = handle_message;
-  tmdb_vars.match_update_ws.onopen = on_websocket_open;
-  tmdb_vars.match_update_ws.onclose = on_websocket_close;
+  tmdb_vars.tournament_version = null;
+  tmdb_vars.pending_changes = [];
+  tmdb_vars.reconnect_delay = tmdb_vars_MIN_RECONNECT_DELAY;
+  tmdb_vars.last_message_id = 0;
+  tmdb_vars.pending_updates = {};
+  open_teammatch_websocket();
+}
+
+// Sends updates of the fields of one match. The server applies all the
+// updates of a message in one transaction and replies with an "ack" (with
+// the changed matches) or an "error" carrying the same message_id.
+function send_match_update(team_match_pk, fields) {
+  tmdb_vars.last_message_id += 1;
+  var message_id = tmdb_vars.last_message_id;
+  var team_match = tmdb_vars.tournament_data.tmdb_sparringteammatch[team_match_pk];
+  tmdb_vars.pending_updates[message_id] = team_match_pk;
+  tmdb_vars.match_update_ws.send(JSON.stringify({
+    message_type: "update",
+    message_id: message_id,
+    updates: [{
+      id: team_match_pk,
+      fields: fields,
+      // lets the server reject the update if the match changed in the meantime
+      version: team_match.fields.version,
+    }],
+  }));
 }
 
 function on_report_status_changed(element, team_match_pk) {
-  var team_match = {};
-  team_match.model = 'tmdb.sparringteammatch';
-  team_match.pk = team_match_pk;
-  team_match.fields = {};
-  team_match.fields.in_holding = (element.value >= tmdb_vars_REPORT_STATUS_HOLDING_VALUE);
-  team_match.fields.at_ring = (element.value >= tmdb_vars_REPORT_STATUS_AT_RING_VALUE);
-  team_match.fields.competing = (element.value >= tmdb_vars_REPORT_STATUS_COMPETING_VALUE);
-  tmdb_vars.match_update_ws.send(JSON.stringify([team_match]));
+  send_match_update(team_match_pk, {
+    in_holding: (element.value >= tmdb_vars_REPORT_STATUS_HOLDING_VALUE),
+    at_ring: (element.value >= tmdb_vars_REPORT_STATUS_AT_RING_VALUE),
+    competing: (element.value >= tmdb_vars_REPORT_STATUS_COMPETING_VALUE),
+  });
 }
 
 function on_ring_number_changed(element, team_match_pk) {
-  var team_match = {};
-  team_match.model = 'tmdb.sparringteammatch';
-  team_match.pk = team_match_pk;
-  team_match.fields = {};
-  if (element.value) {
-    team_match.fields.ring_number = element.value;
-  } else {
-    team_match.fields.ring_number = null;
-  }
-  tmdb_vars.match_update_ws.send(JSON.stringify([team_match]));
+  send_match_update(team_match_pk, {
+    ring_number: element.value ? parseInt(element.value) : null,
+  });
 }
 
 function on_winning_team_changed(element, team_match_pk) {
-  var team_match = {};
-  team_match.model = 'tmdb.sparringteammatch';
-  team_match.pk = team_match_pk;
-  team_match.fields = {};
-  team_match.fields.winning_team = element.value;
-  if (team_match.fields.winning_team == "") {
-    team_match.fields.winning_team = null;
-  }
-  tmdb_vars.match_update_ws.send(JSON.stringify([team_match]));
-}
-
-function get_school_name_from_team_registration(team_registration_id) {
-  if (team_registration_id == null) {
-    return null;
-  }
-  var team_registration = tmdb_vars.tournament_data.tmdb_sparringteamregistration[team_registration_id];
-  var team_id = team_registration.fields.team;
-  var team = tmdb_vars.tournament_data.tmdb_sparringteam[team_id];
-  return render_school_name(team.fields.school);
+  send_match_update(team_match_pk, {
+    winning_team: element.value ? parseInt(element.value) : null,
+  });
 }
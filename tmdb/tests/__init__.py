@@ -1 +1,13 @@
+from .test_assign_slots import *
+from .test_bracket_cache import *
+from .test_bracket_generator import *
+from .test_bracket_graph import *
+from .test_create_matches import *
+from .test_division_status import *
+from .test_import_benchmark import *
 from .test_import_registration_data import *
+from .test_match_queue import *
+from .test_record_result import *
+from .test_slot_assigner import *
+from .test_tournament_snapshot import *
+from .test_websocket_load_test import *
@@ -0,0 +1,68 @@
+from unittest.mock import patch
+
+from django.test import TestCase
+
+from tmdb import forms, models
+from .test_import_registration_data import TournamentImportTestCase
+
+class AssignSlotsTestCase(TestCase):
+    def setUp(self):
+        self.tournament, _ = TournamentImportTestCase.import_single_tournament()
+
+    def get_seeds(self):
+        return dict(models.SparringTeamRegistration.objects.filter(
+                tournament_division__tournament=self.tournament).values_list(
+                'pk', 'seed'))
+
+    def test_assign_slots_to_all_divisions(self):
+        teams_by_division = self.tournament.assign_slots_to_all_divisions(
+                seed=1, max_workers=2)
+        for tournament_division in models.TournamentSparringDivision.objects\
+                .filter(tournament=self.tournament):
+            teams = teams_by_division[tournament_division.pk]
+            # teams with fewer than two competitors are not slotted
+            seeds = [team.seed for team in teams
+                    if team.num_competitors() >= 2]
+            self.assertEqual(list(range(1, len(seeds) + 1)), sorted(seeds))
+            self.assertEqual(seeds, list(models.SparringTeamRegistration
+                    .objects.filter(pk__in=[team.pk for team in teams],
+                    seed__isnull=False).order_by('team__school',
+                    'team__number').values_list('seed', flat=True)))
+
+    def test_parallel_matches_serial(self):
+        self.tournament.assign_slots_to_all_divisions(seed=1, max_workers=2)
+        parallel_seeds = self.get_seeds()
+        # reassigning different slots must not violate the unique seeds
+        self.tournament.assign_slots_to_all_divisions(seed=2, max_workers=1)
+        self.assertNotEqual(parallel_seeds, self.get_seeds())
+        self.tournament.assign_slots_to_all_divisions(seed=1, max_workers=1)
+        self.assertEqual(parallel_seeds, self.get_seeds())
+
+    def test_assign_slots_to_team_registrations(self):
+        tournament_division = models.TournamentSparringDivision.objects.filter(
+                tournament=self.tournament).first()
+        self.tournament.assign_slots_to_all_divisions(seed=3, max_workers=1)
+        seeds = self.get_seeds()
+        tournament_division.assign_slots_to_team_registrations(seed=3)
+        self.assertEqual(seeds, self.get_seeds())
+
+    def test_points_form_assigns_slots_in_process(self):
+        team_registration = models.SparringTeamRegistration.objects.filter(
+                tournament_division__tournament=self.tournament).first()
+        for points, search in ((5, False), (6, True)):
+            form = forms.SparringTeamRegistrationPointsForm({'points': points,
+                    'search_slots': search, 'confirm_delete_matches': True},
+                    instance=team_registration)
+            # the slots are assigned when the form is validated
+            with patch('tmdb.util.slot_assigner.ProcessPoolExecutor') \
+                    as executor, patch('tmdb.models.search_slots',
+                            wraps=models.search_slots) as search_slots:
+                self.assertTrue(form.is_valid())
+                form.save()
+            executor.assert_not_called()
+            # the search only runs when it is asked for
+            self.assertEqual(search, search_slots.called)
+            self.assertEqual(points, models.SparringTeamRegistration.objects\
+                    .get(pk=team_registration.pk).points)
+            self.assertIsNotNone(models.SparringTeamMatch.objects.filter(
+                    division=team_registration.tournament_division).first())
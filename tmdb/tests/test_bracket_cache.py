@@ -0,0 +1,89 @@
+from django.core.cache import cache
+from django.test import TransactionTestCase
+from django.urls import reverse
+from django.utils.html import escape
+
+from tmdb import bracket_cache, models
+from .test_import_registration_data import TournamentImportTestCase
+from .test_tournament_snapshot import run_with_other_cache_client
+
+class BracketCacheTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.tournament, _ = TournamentImportTestCase.import_single_tournament()
+        self.tournament.assign_slots_to_all_divisions(seed=1, max_workers=1)
+        self.tournament_division = models.TournamentSparringDivision.objects\
+                .filter(tournament=self.tournament).select_related(
+                'tournament', 'division').first()
+        self.tournament_division.create_matches_from_slots()
+
+    def get_bracket_html(self):
+        response = self.client.get(reverse('tmdb:bracket', args=(
+                self.tournament.slug, self.tournament_division.division.slug)))
+        self.assertEqual(200, response.status_code)
+        return response.content.decode()
+
+    def test_bracket(self):
+        with self.assertNumQueries(2):
+            bracket = bracket_cache.build_bracket(self.tournament_division)
+        matches = models.SparringTeamMatch.objects.filter(
+                division=self.tournament_division).select_related(
+                'blue_team__team__school', 'blue_team__team__division')
+        cells = {(cell['round_num'], cell['round_slot']): cell
+                for column in bracket['columns'] for cell in column}
+        self.assertEqual(matches.count(), sum(cell['pk'] is not None
+                for cell in cells.values()))
+        for match in matches:
+            cell = cells[(match.round_num, match.round_slot)]
+            self.assertEqual(match.number, cell['number'])
+            if match.blue_team is not None:
+                self.assertEqual(match.blue_team.bracket_str(),
+                        cell['blue_team']['bracket_str'])
+                self.assertIn(escape(match.blue_team.bracket_str()),
+                        bracket['html'])
+        self.assertIn("bracket_finals_cell", cells[(0, 0)]['cell_type'])
+
+    def test_bracket_is_cached(self):
+        html = self.get_bracket_html()
+        # the division, then its version and bracket from the cache table
+        with self.assertNumQueries(3):
+            self.assertEqual(html, self.get_bracket_html())
+
+    def test_changes_invalidate_bracket(self):
+        version = bracket_cache.get_version(self.tournament_division.pk)
+        html = self.get_bracket_html()
+        match = models.SparringTeamMatch.objects.filter(
+                division=self.tournament_division,
+                blue_team__isnull=False).first()
+        team_registration = match.blue_team
+        team_registration.lightweight = not team_registration.lightweight
+        team_registration.save()
+        self.assertEqual(version + 1,
+                bracket_cache.get_version(self.tournament_division.pk))
+        new_html = self.get_bracket_html()
+        self.assertNotEqual(html, new_html)
+        self.assertIn(escape(models.SparringTeamRegistration.objects.get(
+                pk=team_registration.pk).bracket_str()), new_html)
+
+        version = bracket_cache.get_version(self.tournament_division.pk)
+        self.tournament_division.create_matches_from_slots()
+        self.assertLess(version,
+                bracket_cache.get_version(self.tournament_division.pk))
+
+    def test_version_bumped_by_other_process(self):
+        html = self.get_bracket_html()
+        match = models.SparringTeamMatch.objects.filter(
+                division=self.tournament_division,
+                blue_team__isnull=False).first()
+        # changed without signals, as by another process whose bump only
+        # reaches this one through the shared cache
+        models.SparringTeamRegistration.objects.filter(
+                pk=match.blue_team_id).update(
+                lightweight=not match.blue_team.lightweight)
+        self.assertEqual(html, self.get_bracket_html())
+        run_with_other_cache_client(bracket_cache.bump_version,
+                self.tournament_division.pk)
+        new_html = self.get_bracket_html()
+        self.assertNotEqual(html, new_html)
+        self.assertIn(escape(models.SparringTeamRegistration.objects.get(
+                pk=match.blue_team_id).bracket_str()), new_html)
@@ -0,0 +1,42 @@
+import random
+
+from django.test import SimpleTestCase
+
+from tmdb.util import BracketGenerator
+from .reference_bracket_generator import BracketGenerator \
+        as ReferenceBracketGenerator
+
+class BracketGeneratorTestCase(SimpleTestCase):
+    @staticmethod
+    def bracket_matches(bracket):
+        return [(match.round_num, match.round_slot, match.blue_team,
+                match.red_team, match.number, match.is_bye())
+                for match in bracket]
+
+    def assertSameBracket(self, seeds, match_number_start_val=101):
+        self.assertEqual(
+                BracketGeneratorTestCase.bracket_matches(
+                        ReferenceBracketGenerator(seeds,
+                                match_number_start_val)),
+                BracketGeneratorTestCase.bracket_matches(
+                        BracketGenerator(seeds, match_number_start_val)))
+
+    def test_full_brackets(self):
+        for num_seeds in range(0, 130):
+            self.assertSameBracket({seed: "team %d" %(seed,)
+                    for seed in range(1, num_seeds + 1)})
+
+    def test_random_seeds(self):
+        rng = random.Random(0)
+        for _ in range(300):
+            max_seed = rng.randint(1, 100)
+            seeds = rng.sample(range(1, max_seed + 1),
+                    rng.randint(0, max_seed))
+            self.assertSameBracket({seed: "team %d" %(seed,)
+                    for seed in seeds}, rng.randint(1, 600))
+
+    def test_matches_are_numbered_consecutively(self):
+        bracket = BracketGenerator({seed: "team %d" %(seed,)
+                for seed in range(1, 25)}, 201)
+        numbers = [match.number for match in bracket if not match.is_bye()]
+        self.assertEqual(list(range(201, 201 + 23)), numbers)
@@ -0,0 +1,110 @@
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from tmdb import forms, models
+from tmdb.util import BracketGraph
+from .test_import_registration_data import TournamentImportTestCase
+
+def count_match_reads(queries):
+    """Counts the queries reading the rounds of matches."""
+    return sum(query['sql'].startswith('SELECT')
+            and '"tmdb_sparringteammatch"."round_num"' in query['sql']
+            for query in queries.captured_queries)
+
+class BracketGraphTestCase(TestCase):
+    def setUp(self):
+        tournament, _ = TournamentImportTestCase.import_single_tournament()
+        tournament.assign_slots_to_all_divisions(seed=1, max_workers=1)
+        self.tournament_division = max(
+                models.TournamentSparringDivision.objects.filter(
+                        tournament=tournament),
+                key=lambda division: len(division.get_seeds()))
+        self.tournament_division.create_matches_from_slots()
+        self.matches = {(match.round_num, match.round_slot): match
+                for match in models.SparringTeamMatch.objects.filter(
+                        division=self.tournament_division)}
+
+    def first_round_match(self, side):
+        return next(match for (round_num, round_slot), match in sorted(
+                self.matches.items(), reverse=True)
+                if round_slot % 2 == side and match.blue_team_id
+                        and match.red_team_id)
+
+    def test_winner_advances_to_red_side(self):
+        match = self.first_round_match(1)
+        form = forms.MatchForm({'winning_team': match.red_team_id,
+                'ring_number': 2}, instance=match)
+        self.assertTrue(form.is_valid())
+        form.save()
+        match.refresh_from_db()
+        self.assertEqual((match.red_team_id, 2),
+                (match.winning_team_id, match.ring_number))
+        self.assertIsNotNone(match.ring_assignment_time)
+        parent_match = self.matches[BracketGraph.next_round_key(
+                match.round_num, match.round_slot)]
+        parent_match.refresh_from_db()
+        self.assertEqual(match.red_team_id, parent_match.red_team_id)
+
+    def test_lookups(self):
+        match = self.first_round_match(0)
+        with self.assertNumQueries(1):
+            parent_match = match.get_next_round_match()
+        self.assertEqual(self.matches[BracketGraph.next_round_key(
+                match.round_num, match.round_slot)], parent_match)
+        with self.assertNumQueries(1):
+            self.assertIn(match, parent_match.get_previous_round_matches())
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.matches[(0, 0)].get_next_round_match())
+
+    def test_record_result_uses_cached_graph(self):
+        match = self.first_round_match(0)
+        other_match = self.first_round_match(1)
+        models.bracket_graphs.invalidate(self.tournament_division.pk)
+        with CaptureQueriesContext(connection) as queries:
+            models.SparringTeamMatch.record_result(match.pk,
+                    match.blue_team_id)
+        # the match, the graph and the next round match
+        self.assertEqual(3, count_match_reads(queries))
+        with CaptureQueriesContext(connection) as queries:
+            models.SparringTeamMatch.record_result(other_match.pk,
+                    other_match.red_team_id)
+        self.assertEqual(1, count_match_reads(queries))
+        parent_match = self.matches[BracketGraph.next_round_key(
+                other_match.round_num, other_match.round_slot)]
+        parent_match.refresh_from_db()
+        self.assertEqual(other_match.red_team_id, parent_match.red_team_id)
+
+    def test_stale_graph_is_reloaded(self):
+        match = self.first_round_match(0)
+        models.SparringTeamMatch.record_result(match.pk, match.blue_team_id)
+        models.SparringTeamMatch.record_result(match.pk, None)
+        self.tournament_division.create_matches_from_slots()
+        # the graph of the old matches, without the next round matches
+        models.bracket_graphs._graphs[self.tournament_division.pk] = \
+                BracketGraph([(old_match.pk, old_match.round_num,
+                        old_match.round_slot)
+                        for old_match in self.matches.values()
+                        if old_match.round_num == match.round_num])
+        with self.assertRaises(models.SparringTeamMatch.DoesNotExist):
+            models.SparringTeamMatch.record_result(match.pk,
+                    match.blue_team_id)
+        new_match = models.SparringTeamMatch.objects.get(
+                division=self.tournament_division, round_num=match.round_num,
+                round_slot=match.round_slot)
+        changed_matches = models.SparringTeamMatch.record_result(
+                new_match.pk, new_match.blue_team_id)
+        parent_match = changed_matches[1]
+        self.assertEqual((match.round_num - 1, match.round_slot // 2),
+                (parent_match.round_num, parent_match.round_slot))
+        self.assertEqual(new_match.blue_team_id, parent_match.blue_team_id)
+        self.assertNotIn(parent_match.pk,
+                [old_match.pk for old_match in self.matches.values()])
+
+        # a graph missing the next round match still finds it
+        models.bracket_graphs._graphs[self.tournament_division.pk] = \
+                BracketGraph([(new_match.pk, new_match.round_num,
+                        new_match.round_slot)])
+        models.SparringTeamMatch.record_result(new_match.pk, None)
+        parent_match.refresh_from_db()
+        self.assertIsNone(parent_match.blue_team_id)
@@ -0,0 +1,191 @@
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from tmdb import forms, models
+from .reference_bracket_generator import BracketGenerator \
+        as ReferenceBracketGenerator
+from .test_import_registration_data import TournamentImportTestCase
+
+class CreateMatchesFromSlotsTestCase(TestCase):
+    def setUp(self):
+        tournament, _ = TournamentImportTestCase.import_single_tournament()
+        tournament.assign_slots_to_all_divisions(seed=1, max_workers=1)
+        self.tournament_divisions = models.TournamentSparringDivision.objects\
+                .filter(tournament=tournament).select_related('division')
+
+    def test_matches_follow_bracket(self):
+        for tournament_division in self.tournament_divisions:
+            tournament_division.create_matches_from_slots()
+            seeds = {team.seed: team.pk for team in
+                    models.SparringTeamRegistration.objects.filter(
+                            tournament_division=tournament_division,
+                            seed__isnull=False)}
+            bracket = ReferenceBracketGenerator(seeds,
+                    tournament_division.division.match_number_start_val())
+            self.assertEqual(
+                    sorted((match.number, match.round_num, match.round_slot,
+                            match.blue_team, match.red_team)
+                            for match in bracket),
+                    sorted(models.SparringTeamMatch.objects.filter(
+                            division=tournament_division).values_list(
+                            'number', 'round_num', 'round_slot',
+                            'blue_team', 'red_team')))
+
+    def test_number_of_queries_does_not_grow_with_bracket(self):
+        for tournament_division in self.tournament_divisions:
+            tournament_division.create_matches_from_slots()
+            with CaptureQueriesContext(connection) as queries:
+                tournament_division.create_matches_from_slots()
+            # seeds, select and delete the old matches, insert the new ones,
+            # plus the savepoint queries of the transaction
+            self.assertLessEqual(len(queries), 7)
+
+class DivisionMatchesRebuiltTestCase(TransactionTestCase):
+    def test_signal_sent_once_after_commit(self):
+        tournament, _ = TournamentImportTestCase.import_single_tournament()
+        tournament.assign_slots_to_all_divisions(seed=1, max_workers=1)
+        tournament_division = models.TournamentSparringDivision.objects\
+                .filter(tournament=tournament).first()
+        rebuilt_divisions = []
+        def on_rebuilt(sender, tournament_division, **kwargs):
+            rebuilt_divisions.append(tournament_division)
+        models.division_matches_rebuilt.connect(on_rebuilt)
+        try:
+            tournament_division.create_matches_from_slots()
+        finally:
+            models.division_matches_rebuilt.disconnect(on_rebuilt)
+        self.assertEqual([tournament_division], rebuilt_divisions)
+        self.assertFalse(models.TournamentSparringDivision.is_rebuilding(
+                tournament_division.pk))
+
+class UpdateMatchesFromSlotsTestCase(TestCase):
+    def setUp(self):
+        tournament, _ = TournamentImportTestCase.import_single_tournament()
+        tournament.assign_slots_to_all_divisions(seed=1, max_workers=1)
+        self.tournament_division = max(
+                models.TournamentSparringDivision.objects.filter(
+                        tournament=tournament),
+                key=lambda division: len(division.get_seeds()))
+        self.tournament_division.create_matches_from_slots()
+
+    def record_first_round_results(self):
+        """Makes the blue team win every match fought between two seeded
+        teams, returning the matches."""
+        matches = list(models.SparringTeamMatch.objects.filter(
+                division=self.tournament_division, blue_team__isnull=False,
+                red_team__isnull=False))
+        for match in matches:
+            match.winning_team_id = match.blue_team_id
+            match.save()
+            parent_match = models.SparringTeamMatch.objects.filter(
+                    division=self.tournament_division,
+                    round_num=match.round_num - 1,
+                    round_slot=match.round_slot // 2)
+            side = 'red_team' if match.round_slot % 2 else 'blue_team'
+            parent_match.update(**{side: match.winning_team_id})
+        return matches
+
+    def get_matches(self):
+        return {(match.round_num, match.round_slot): match for match in
+                models.SparringTeamMatch.objects.filter(
+                        division=self.tournament_division)}
+
+    def test_unchanged_seeds(self):
+        self.record_first_round_results()
+        diff = self.tournament_division.diff_matches_from_slots()
+        self.assertFalse(diff.has_changes())
+
+    def test_late_drop_preserves_untouched_results(self):
+        decided_matches = self.record_first_round_results()
+        seeds = self.tournament_division.get_seeds()
+        last_team = seeds[max(seeds)]
+        preview = self.tournament_division.diff_matches_from_slots(
+                self.tournament_division.get_seeds(last_team, None))
+
+        last_team.seed = None
+        last_team.save()
+        versions = {match.pk: match.version
+                for match in self.get_matches().values()}
+        diff = self.tournament_division.update_matches_from_slots()
+        matches = {match.pk: match for match in self.get_matches().values()}
+        for match in diff.updated:
+            self.assertEqual(versions[match.pk] + 1, match.version)
+            self.assertEqual(match.version, matches[match.pk].version)
+        self.assertEqual([match.pk for match in preview.lost_results],
+                [match.pk for match in diff.lost_results])
+        self.assertLess(len(diff.lost_results), len(decided_matches))
+
+        lost_pks = {match.pk for match in diff.lost_results}
+        matches = {match.pk: match for match in self.get_matches().values()}
+        for match in decided_matches:
+            if match.pk not in lost_pks:
+                self.assertEqual(match.winning_team_id,
+                        matches[match.pk].winning_team_id)
+        self.assertFalse(
+                self.tournament_division.diff_matches_from_slots().has_changes())
+
+    def test_late_add_agrees_with_rebuilt_bracket(self):
+        seeds = self.tournament_division.get_seeds()
+        late_team = seeds.pop(max(seeds))
+        self.tournament_division.update_matches_from_slots(seeds)
+        self.record_first_round_results()
+
+        diff = self.tournament_division.update_matches_from_slots()
+        self.assertLessEqual(len(diff.lost_results), 1)
+        updated_matches = {key: (match.number, match.blue_team_id,
+                match.red_team_id, match.winning_team_id)
+                for key, match in self.get_matches().items()}
+        self.tournament_division.create_matches_from_slots()
+        rebuilt_matches = self.get_matches()
+        self.assertEqual(set(rebuilt_matches), set(updated_matches))
+        for key, (number, blue_team_id, red_team_id, winning_team_id) in \
+                updated_matches.items():
+            self.assertEqual(rebuilt_matches[key].number, number)
+            if winning_team_id is None:
+                continue
+            self.assertIn(winning_team_id, (blue_team_id, red_team_id))
+        self.assertIn(late_team.pk, [team_id
+                for _, blue_team_id, red_team_id, _ in updated_matches.values()
+                for team_id in (blue_team_id, red_team_id)])
+
+    def seed_by_points(self):
+        """Gives the first four teams points, slots the teams as the points
+        form does and records the first round results, returning the
+        teams."""
+        teams = list(models.SparringTeamRegistration.objects.filter(
+                tournament_division=self.tournament_division).order_by('pk'))
+        for points, team in zip((10, 9, 8, 7), teams):
+            team.points = points
+            team.save()
+        self.tournament_division.assign_slots_to_team_registrations(
+                seed=self.tournament_division.pk)
+        self.tournament_division.create_matches_from_slots()
+        self.record_first_round_results()
+        return teams
+
+    def test_points_form_preserves_untouched_results(self):
+        team = self.seed_by_points()[0]
+        winners = {key: match.winning_team_id
+                for key, match in self.get_matches().items()}
+        # the top seed stays the top seed, so no slot moves
+        form = forms.SparringTeamRegistrationPointsForm({'points': 11},
+                instance=team)
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+        self.assertEqual(winners, {key: match.winning_team_id
+                for key, match in self.get_matches().items()})
+
+    def test_points_form_confirms_lost_results(self):
+        team = self.seed_by_points()[-1]
+        form = forms.SparringTeamRegistrationPointsForm({'points': 20},
+                instance=team)
+        self.assertFalse(form.is_valid())
+        form = forms.SparringTeamRegistrationPointsForm({'points': 20,
+                'confirm_delete_matches': True}, instance=team)
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+        team.refresh_from_db()
+        self.assertEqual(1, team.seed)
+        self.assertFalse(
+                self.tournament_division.diff_matches_from_slots().has_changes())
@@ -0,0 +1,54 @@
+from django.test import TestCase
+from django.urls import reverse
+
+from tmdb import models
+from .test_import_registration_data import TournamentImportTestCase
+
+class DivisionStatusTestCase(TestCase):
+    def setUp(self):
+        self.tournament, _ = \
+                TournamentImportTestCase.import_single_tournament()
+        self.tournament.assign_slots_to_all_divisions(seed=1, max_workers=1)
+        for tournament_division in models.TournamentSparringDivision.objects\
+                .filter(tournament=self.tournament):
+            tournament_division.create_matches_from_slots()
+
+    def test_division_statuses(self):
+        tournament_division = models.TournamentSparringDivision.objects\
+                .filter(tournament=self.tournament).first()
+        matches = list(models.SparringTeamMatch.objects.filter(
+                division=tournament_division, blue_team__isnull=False,
+                red_team__isnull=False))
+        matches[0].winning_team_id = matches[0].blue_team_id
+        matches[0].ring_number = 1
+        matches[0].competing = True
+        matches[0].save()
+        matches[1].ring_number = 2
+        matches[1].at_ring = matches[1].competing = True
+        matches[1].save()
+        matches[2].ring_number = 3
+        matches[2].at_ring = True
+        matches[2].save()
+        matches[3].at_ring = True
+        matches[3].save()
+
+        with self.assertNumQueries(1):
+            statuses = self.tournament.division_statuses()
+        status = statuses[tournament_division.pk]
+        self.assertEqual(models.SparringTeamMatch.objects.filter(
+                division=tournament_division).count(), status.num_matches)
+        self.assertEqual(1, status.num_matches_completed)
+        self.assertEqual(1, status.num_matches_competing)
+        self.assertEqual(1, status.num_matches_at_ring)
+        self.assertEqual(str(status), str(tournament_division.status()))
+        self.assertEqual(
+                models.TournamentSparringDivision.objects.filter(
+                        tournament=self.tournament).count(),
+                len(statuses))
+
+    def test_dashboard_queries(self):
+        url = reverse('tmdb:tournament_dashboard', args=(self.tournament.slug,))
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertContains(response, "0/")
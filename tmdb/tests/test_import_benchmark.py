@@ -0,0 +1,37 @@
+from django.test import TestCase
+
+from tmdb import models
+from tmdb.util import read_team_file
+from tmdb.util.import_benchmark import benchmark_import, scale_team_file
+
+from .test_import_registration_data import TournamentImportTestCase
+
+class ImportBenchmarkTestCase(TestCase):
+    @staticmethod
+    def registration_file_lines():
+        filenames = TournamentImportTestCase.registration_data_filenames()
+        filename, year, tournament_num = next(filenames)
+        with open(filename, 'r') as fh:
+            return fh.readlines()
+
+    def test_scale_team_file(self):
+        lines = ImportBenchmarkTestCase.registration_file_lines()
+        team_records = read_team_file(lines)
+        scaled_team_records = read_team_file(scale_team_file(lines, 3))
+        self.assertEqual(3 * len(team_records), len(scaled_team_records))
+        self.assertEqual(3 * len({r.school_name for r in team_records}),
+                len({r.school_name for r in scaled_team_records}))
+
+    def test_benchmark_import(self):
+        lines = ImportBenchmarkTestCase.registration_file_lines()
+        result = benchmark_import(scale_team_file(lines, 2), rounds=1)
+        self.assertEqual(2 * len(read_team_file(lines)), result['num_teams'])
+        self.assertEqual(1, result['parse_team_file']['num_queries'])
+        self.assertIn('add_sparring_teams', result['stages'])
+        for stage_result in result['stages'].values():
+            self.assertLessEqual(0, stage_result['peak_memory'])
+            self.assertLessEqual(stage_result['peak_memory'],
+                    result['import_registration_data']['peak_memory'])
+        self.assertLess(0, result['stages']['add_sparring_teams'][
+                'peak_memory'])
+        self.assertFalse(models.Tournament.objects.exists())
@@ -1,12 +1,18 @@
 from pathlib import Path
 from datetime import date
+from io import BytesIO, StringIO
 import os
 import logging
+import shutil
+import tempfile
 
-from django.test import TestCase
+from django.core.management import CommandError, call_command
+from django.test import TestCase, TransactionTestCase
 from django.db.utils import IntegrityError
 
 from tmdb import models
+from tmdb.models import sanitize_school_name
+from tmdb.util import TeamFileParseError
 
 LOGGER = logging.getLogger()
 
@@ -100,3 +106,191 @@ class TournamentImportTestCase(TestCase):
         team_match.winning_team = team_match.blue_team
         team_match.save()
         tournament.drop_registration_data()
+
+    def test_import_binary_team_file(self):
+        tournament, filename = TournamentImportTestCase.import_single_tournament()
+        team_registrations = models.SparringTeamRegistration.objects.filter(
+                tournament_division__tournament=tournament)
+        num_teams = team_registrations.count()
+        tournament.drop_registration_data()
+        with open(filename, 'rb') as fh:
+            tournament.import_registration_data(BytesIO(fh.read()))
+        self.assertEqual(num_teams, team_registrations.count())
+
+    def test_parse_team_file_reports_all_errors(self):
+        tournament, filename = TournamentImportTestCase.import_single_tournament()
+        with open(filename, 'r') as fh:
+            lines = fh.readlines()
+        lines[3] = lines[3].replace(" - (", " (")
+        lines[4] = lines[4].replace(" - (", " (")
+        with self.assertRaises(TeamFileParseError) as cm:
+            models.parse_team_file(lines)
+        errors = cm.exception.errors
+        self.assertTrue(any(e.startswith("Line 4:") for e in errors))
+        self.assertTrue(any(e.startswith("Line 5:") for e in errors))
+        self.assertTrue(any(e.startswith("Expected ") for e in errors))
+
+    def test_import_stages_with_existing_rows(self):
+        tournament, filename = TournamentImportTestCase.import_single_tournament()
+        other_tournament = models.Tournament.objects.create(
+                location='location-other', season=tournament.season,
+                date=tournament.date.replace(day=tournament.date.day + 1),
+                registration_doc_url='http://ectc-online.org/other')
+        with open(filename, 'r') as fh:
+            lines = fh.readlines()
+        lines[4] = lines[4].replace("University at Buffalo  Men's A1",
+                "Test School Men's A1")
+        teams_by_division = models.parse_team_file(lines)
+        num_rows = [model.objects.count() for model in (models.School,
+                models.SchoolSeasonRegistration, models.SparringTeam)]
+
+        # one new school, season registration and team among existing ones:
+        # look up, bulk_create the missing rows and look up again
+        with self.assertNumQueries(3):
+            teams_data = models.Tournament.create_schools(teams_by_division)
+        with self.assertNumQueries(3):
+            other_tournament.add_season_registrations(teams_data)
+        with self.assertNumQueries(3):
+            other_tournament.add_tournament_registrations(teams_data)
+        with self.assertNumQueries(3):
+            models.Tournament.add_sparring_teams(teams_data)
+        self.assertEqual([num + 1 for num in num_rows], [
+                model.objects.count() for model in (models.School,
+                models.SchoolSeasonRegistration, models.SparringTeam)])
+        self.assertEqual(len({team['school'].pk for team in teams_data}),
+                models.SchoolTournamentRegistration.objects.filter(
+                        tournament=other_tournament).count())
+        for team_data in teams_data:
+            school = team_data['school']
+            self.assertEqual(school, models.School.objects.get(
+                    name=sanitize_school_name(team_data['school_name'])))
+            self.assertEqual(school,
+                    team_data['school_season_registration'].school)
+            self.assertEqual(team_data['school_season_registration'],
+                    team_data['school_tournament_registration']\
+                            .school_season_registration)
+            self.assertEqual(other_tournament,
+                    team_data['school_tournament_registration'].tournament)
+            team = team_data['sparring_team']
+            self.assertEqual((school, team_data['sparring_division'],
+                    team_data['team_num']), (team.school, team.division,
+                    team.number))
+
+        # every row exists now: one look up per stage
+        teams_by_division = models.parse_team_file(lines)
+        with self.assertNumQueries(1):
+            new_teams_data = models.Tournament.create_schools(
+                    teams_by_division)
+        with self.assertNumQueries(1):
+            other_tournament.add_season_registrations(new_teams_data)
+        with self.assertNumQueries(1):
+            other_tournament.add_tournament_registrations(new_teams_data)
+        with self.assertNumQueries(1):
+            models.Tournament.add_sparring_teams(new_teams_data)
+        for key in ('school', 'school_season_registration',
+                'school_tournament_registration', 'sparring_team'):
+            self.assertEqual([team_data[key] for team_data in teams_data],
+                    [team_data[key] for team_data in new_teams_data])
+
+    def test_import_reuses_existing_teams(self):
+        tournament, filename = TournamentImportTestCase.import_single_tournament()
+        teams = models.SparringTeam.objects.filter(
+                sparringteamregistration__tournament_division__tournament=\
+                        tournament)
+        team_keys = {(team.school_id, team.division_id, team.number)
+                for team in teams}
+        num_teams = models.SparringTeam.objects.count()
+
+        other_tournament = TournamentImportTestCase.import_tournament(filename,
+                tournament.season.start_date.year, uniq_id=9)
+        self.assertEqual(num_teams, models.SparringTeam.objects.count())
+        self.assertEqual(set(teams), set(models.SparringTeam.objects.filter(
+                sparringteamregistration__tournament_division__tournament=\
+                        other_tournament)))
+        # one query for every team of the tournament
+        with self.assertNumQueries(1):
+            teams_by_key = models.SparringTeam.get_teams_by_key(team_keys)
+            for team in teams_by_key.values():
+                str(team)
+        self.assertEqual(team_keys, set(teams_by_key))
+        self.assertEqual({team.pk for team in teams},
+                {team.pk for team in teams_by_key.values()})
+
+    def test_update_registration_data(self):
+        tournament, filename = TournamentImportTestCase.import_single_tournament()
+        team_registrations = models.SparringTeamRegistration.objects.filter(
+                tournament_division__tournament=tournament)
+        num_teams = team_registrations.count()
+        unaffected_match = TournamentImportTestCase.create_team_match(
+                tournament)
+        removed_team = team_registrations.get(
+                team__school__name='UNIVERSITY AT BUFFALO',
+                tournament_division__division__slug='mens-a', team__number=1)
+        models.SparringTeamMatch.objects.create(
+                division=removed_team.tournament_division, number=101,
+                round_num=0, round_slot=0, blue_team=removed_team)
+
+        with open(filename, 'r') as fh:
+            lines = fh.readlines()
+        lines[3] = lines[3].replace("Men's A1 - (L)", "Men's A1 - (LMH)")
+        lines[4] = lines[4].replace("University at Buffalo  Men's A1",
+                "Test School Men's A1")
+
+        diff = tournament.update_registration_data(lines, dry_run=True)
+        self.assertEqual((1, 1, 1), (len(diff.added), len(diff.removed),
+                len(diff.updated)))
+        self.assertEqual([removed_team.tournament_division],
+                diff.reset_divisions)
+        self.assertTrue(team_registrations.filter(pk=removed_team.pk))
+
+        tournament.update_registration_data(lines)
+        self.assertEqual(num_teams, team_registrations.count())
+        self.assertFalse(team_registrations.filter(pk=removed_team.pk))
+        self.assertTrue(team_registrations.get(
+                team__school__name='TEST SCHOOL', team__number=1))
+        self.assertTrue(team_registrations.get(
+                team__school__name='BROWN UNIVERSITY',
+                tournament_division__division__slug='mens-a',
+                team__number=1).heavyweight)
+        self.assertFalse(models.SparringTeamMatch.objects.filter(
+                division=removed_team.tournament_division))
+        self.assertTrue(models.SparringTeamMatch.objects.filter(
+                pk=unaffected_match.pk))
+        self.assertFalse(tournament.update_registration_data(lines)
+                .has_changes())
+
+class ImportRegistrationsCommandTestCase(TransactionTestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.directory = Path(temp_dir.name)
+        for filename, year, tournament_num in list(
+                TournamentImportTestCase.registration_data_filenames())[:2]:
+            shutil.copy(str(filename), str(self.directory))
+
+    def import_registrations(self):
+        stdout, stderr = StringIO(), StringIO()
+        call_command('import_registrations', str(self.directory),
+                '--workers', '1', '--create-tournaments', stdout=stdout,
+                stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_import_registrations(self):
+        stdout, stderr = self.import_registrations()
+        self.assertEqual("", stderr)
+        self.assertEqual([(2017, 'mit', True), (2017, 'cornell', True)], [
+                (t.season.start_date.year, t.location, t.imported)
+                for t in models.Tournament.objects.order_by('date')])
+        for tournament in models.Tournament.objects.all():
+            self.assertTrue(models.SparringTeamRegistration.objects.filter(
+                    tournament_division__tournament=tournament))
+            self.assertIn("into %s" %(tournament,), stdout)
+
+        stdout, stderr = self.import_registrations()
+        self.assertEqual(2, stderr.count("has already been imported"))
+
+    def test_unmatched_filename_is_reported(self):
+        (self.directory / 'sparring_teams.csv').write_text("")
+        with self.assertRaisesMessage(CommandError, "sparring_teams.csv"):
+            self.import_registrations()
+        self.assertFalse(models.Tournament.objects.exists())
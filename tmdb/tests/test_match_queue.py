@@ -0,0 +1,264 @@
+import json
+from itertools import product
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
+from django.test import TestCase, TransactionTestCase
+from django.urls import reverse
+
+from tmdb import match_queue, models, routing, tournament_snapshot
+from tmdb.tournament_snapshot import compact_values, json_fields
+from .test_import_registration_data import TournamentImportTestCase
+
+class MatchQueueTestCase(TestCase):
+    def setUp(self):
+        self.tournament, _ = TournamentImportTestCase.import_single_tournament()
+        self.tournament.assign_slots_to_all_divisions(seed=1, max_workers=1)
+        for tournament_division in models.TournamentSparringDivision.objects\
+                .filter(tournament=self.tournament):
+            tournament_division.create_matches_from_slots()
+        # give the matches a mix of statuses and rings
+        matches = models.SparringTeamMatch.objects.filter(
+                division__tournament=self.tournament).order_by('number')
+        for match_num, match in enumerate(matches):
+            match.ring_number = (match_num % 4) or None
+            match.in_holding = match_num % 3 == 0
+            match.at_ring = match_num % 5 == 0
+            match.competing = match_num % 7 == 0
+            if match_num % 6 == 0 and match.blue_team_id is not None:
+                match.winning_team_id = match.blue_team_id
+            match.save()
+        self.school_ids = match_queue.get_school_ids(self.tournament.pk)
+
+    def all_matches(self):
+        compact_matches = compact_values(models.SparringTeamMatch.objects\
+                .filter(division__tournament=self.tournament).order_by(
+                'number', 'id'), json_fields['team_match'])
+        return [(row[0], dict(zip(compact_matches['fields'], row[1:])))
+                for row in compact_matches['rows']]
+
+    def queue_filters(self):
+        tournament_division = models.TournamentSparringDivision.objects\
+                .filter(tournament=self.tournament).first()
+        school_id = next(iter(self.school_ids.values()))
+        for ring_number, division_id, school_id, status in product(
+                [None, 2], [None, tournament_division.pk], [None, school_id],
+                [None] + list(match_queue.STATUS_QUERIES)):
+            yield match_queue.MatchQueueFilter(ring_number=ring_number,
+                    division_id=division_id, school_id=school_id,
+                    status=status)
+
+    def test_queryset_matches_filter(self):
+        all_matches = self.all_matches()
+        num_nonempty = 0
+        for queue_filter in self.queue_filters():
+            expected_ids = [match_id for match_id, fields in all_matches
+                    if queue_filter.matches(fields, self.school_ids)]
+            self.assertEqual(expected_ids, list(queue_filter.queryset(
+                    self.tournament.pk).values_list('id', flat=True)))
+            num_nonempty += bool(expected_ids)
+        self.assertGreater(num_nonempty, 20)
+
+    def test_pagination(self):
+        queue_filter = match_queue.MatchQueueFilter(status='active')
+        match_ids = []
+        after = None
+        while True:
+            page = match_queue.get_page(self.tournament.pk, queue_filter,
+                    after=after, limit=7)
+            self.assertLessEqual(len(page['matches']['rows']), 7)
+            match_ids.extend(row[0] for row in page['matches']['rows'])
+            after = page['next']
+            if after is None:
+                break
+        self.assertEqual(list(queue_filter.queryset(
+                self.tournament.pk).values_list('id', flat=True)), match_ids)
+
+    def test_match_queue_json(self):
+        url = reverse('tmdb:tournament_match_queue_json',
+                args=(self.tournament.slug,))
+        response = self.client.get(url, {'ring': 1, 'limit': 5})
+        self.assertEqual(200, response.status_code)
+        page = json.loads(response.content)
+        ring_number_index = page['matches']['fields'].index('ring_number') + 1
+        self.assertEqual({1}, {row[ring_number_index]
+                for row in page['matches']['rows']})
+        team_index = page['matches']['fields'].index('blue_team') + 1
+        for row in page['matches']['rows']:
+            if row[team_index] is not None:
+                self.assertIn(str(row[team_index]),
+                        page['team_registrations'])
+        self.assertIn('version', page)
+
+        for params in [{'ring': 'x'}, {'status': 'x'}, {'after': 'x'},
+                {'limit': 'x'}]:
+            response = self.client.get(url, params)
+            self.assertEqual(400, response.status_code)
+
+    def test_subscription(self):
+        match_id, fields = self.all_matches()[1]
+        subscription = match_queue.MatchQueueSubscription(
+                match_queue.MatchQueueFilter(ring_number=3), self.school_ids)
+
+        def send_update(ring_number):
+            change = {'message_type': 'update', 'version': 1,
+                    'message_content': {'model': 'tmdb.sparringteammatch',
+                    'fields': list(fields), 'rows': [[match_id] + [
+                            ring_number if field_name == 'ring_number'
+                            else value for field_name, value in fields.items()
+                    ]]}}
+            return len(subscription.filter_change(change)[
+                    'message_content']['rows'])
+
+        self.assertEqual(0, send_update(2))
+        self.assertEqual(1, send_update(3))
+        # sent once more, so that the client sees the match leave its queue
+        self.assertEqual(1, send_update(2))
+        self.assertEqual(0, send_update(2))
+
+class MatchQueueGroupsTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.tournament, _ = TournamentImportTestCase.import_single_tournament()
+        self.tournament.assign_slots_to_all_divisions(seed=1, max_workers=1)
+        self.tournament_divisions = list(models.TournamentSparringDivision\
+                .objects.filter(tournament=self.tournament).order_by('pk')[:2])
+        for tournament_division in self.tournament_divisions:
+            tournament_division.create_matches_from_slots()
+
+    async def connect(self, queue_filter=None):
+        communicator = WebsocketCommunicator(
+                URLRouter(routing.websocket_urlpatterns),
+                "/ws/tournaments/%s/sparring_team_match_updates/" %(
+                        self.tournament.slug,))
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        if queue_filter is not None:
+            await communicator.send_to(text_data=json.dumps({
+                    'message_type': 'subscribe', 'filter': queue_filter}))
+            await communicator.receive_from()
+        return communicator
+
+    async def receive_match_ids(self, communicator, version):
+        """Receives the one message of version from communicator, if it was
+        sent one, and returns its previous_version and the ids of its
+        matches, or None."""
+        if await communicator.receive_nothing():
+            return None
+        message = json.loads(await communicator.receive_from())
+        self.assertEqual(version, message['version'])
+        self.assertTrue(await communicator.receive_nothing())
+        compact_matches = message['message_content']
+        if message['message_type'] == 'division_rebuilt':
+            compact_matches = compact_matches['matches']
+        return (message.get('previous_version'),
+                [row[0] for row in compact_matches['rows']])
+
+    @staticmethod
+    def update_match(match, ring_number):
+        match.ring_number = ring_number
+        match.save()
+
+    @async_to_sync
+    async def test_malformed_messages_are_rejected(self):
+        communicator = await self.connect()
+        for text_data in ("{", "not json", "[1, 2"):
+            await communicator.send_to(text_data=text_data)
+            message = json.loads(await communicator.receive_from())
+            self.assertEqual('error', message['message_type'])
+        await communicator.send_to(bytes_data=b"{}")
+        message = json.loads(await communicator.receive_from())
+        self.assertEqual('error', message['message_type'])
+        for version in (None, "latest", [1]):
+            await communicator.send_to(text_data=json.dumps({
+                    'message_type': 'sync', 'version': version}))
+            message = json.loads(await communicator.receive_from())
+            self.assertEqual('snapshot_required', message['message_type'])
+        await communicator.send_to(text_data=json.dumps({
+                'message_type': 'sync'}))
+        message = json.loads(await communicator.receive_from())
+        self.assertEqual('snapshot_required', message['message_type'])
+        await communicator.disconnect()
+
+    @async_to_sync
+    async def test_updates_are_sent_to_their_groups(self):
+        # saved twice, so that the ring it leaves is the one of its first save
+        match = await database_sync_to_async(
+                models.SparringTeamMatch.objects.filter(
+                        division=self.tournament_divisions[0]).first)()
+        match_id = match.pk
+        communicators = {
+            'all': await self.connect(),
+            'ring 1': await self.connect({'ring': 1}),
+            'ring 2': await self.connect({'ring': 2}),
+            'division 0': await self.connect({
+                    'division': self.tournament_divisions[0].pk}),
+            'division 1': await self.connect({
+                    'division': self.tournament_divisions[1].pk}),
+        }
+        try:
+            version = await database_sync_to_async(
+                    tournament_snapshot.get_version)(self.tournament.pk)
+
+            # the clients of the other rings and divisions are not sent the
+            # update
+            async def receive_all():
+                return {name: await self.receive_match_ids(communicator,
+                        version) for name, communicator
+                        in communicators.items()}
+
+            await database_sync_to_async(self.update_match)(match, 1)
+            version += 1
+            first_version = version
+            self.assertEqual({'all': (None, [match_id]),
+                    'ring 1': (None, [match_id]), 'ring 2': None,
+                    'division 0': (None, [match_id]), 'division 1': None},
+                    await receive_all())
+
+            # the clients of ring 1 see the match leave
+            await database_sync_to_async(self.update_match)(match, 2)
+            version += 1
+            self.assertEqual({'all': (None, [match_id]),
+                    'ring 1': (first_version, [match_id]),
+                    'ring 2': (None, [match_id]),
+                    'division 0': (first_version, [match_id]),
+                    'division 1': None}, await receive_all())
+
+            # an update of another division skips a version of division 0
+            other_match = await database_sync_to_async(
+                    models.SparringTeamMatch.objects.filter(
+                            division=self.tournament_divisions[1]).first)()
+            await database_sync_to_async(self.update_match)(other_match, 3)
+            version += 1
+            self.assertEqual({'all': (None, [other_match.pk]),
+                    'ring 1': None, 'ring 2': None, 'division 0': None,
+                    'division 1': (None, [other_match.pk])},
+                    await receive_all())
+
+            # every client sees a rebuild
+            await database_sync_to_async(
+                    self.tournament_divisions[1].create_matches_from_slots)()
+            version += 1
+            messages = await receive_all()
+            self.assertEqual((version - 2, []), messages['ring 1'])
+            self.assertEqual(version - 2, messages['division 0'][0])
+            self.assertEqual(version - 1, messages['division 1'][0])
+            self.assertNotEqual([], messages['division 1'][1])
+
+            # a client that missed previous_version syncs its own changes
+            communicator = communicators['division 0']
+            await communicator.send_to(text_data=json.dumps({
+                    'message_type': 'sync', 'version': first_version}))
+            message = json.loads(await communicator.receive_from())
+            self.assertEqual(('changes', version),
+                    (message['message_type'], message['version']))
+            self.assertEqual([[match_id], []], [[row[0]
+                    for row in change['message_content']['rows']]
+                    for change in message['message_content']
+                    if change['message_type'] == 'update'])
+        finally:
+            for communicator in communicators.values():
+                await communicator.disconnect()
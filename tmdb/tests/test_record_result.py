@@ -0,0 +1,201 @@
+import json
+
+from django.contrib.auth.models import Permission, User
+from django.core.exceptions import ValidationError
+from django.db.utils import IntegrityError
+from django.test import TestCase
+from django.urls import reverse
+
+from tmdb import models
+from tmdb.consumers import SparringTeamMatchConsumer
+from .test_import_registration_data import TournamentImportTestCase
+
+class RecordResultTestCase(TestCase):
+    def setUp(self):
+        tournament, _ = TournamentImportTestCase.import_single_tournament()
+        tournament.assign_slots_to_all_divisions(seed=1, max_workers=1)
+        self.tournament_division = max(
+                models.TournamentSparringDivision.objects.filter(
+                        tournament=tournament),
+                key=lambda division: len(division.get_seeds()))
+        self.tournament_division.create_matches_from_slots()
+        self.match = models.SparringTeamMatch.objects.filter(
+                division=self.tournament_division, blue_team__isnull=False,
+                red_team__isnull=False).order_by('-round_num',
+                '-round_slot').first()
+
+    def get_parent_match(self):
+        return models.SparringTeamMatch.objects.get(
+                division=self.tournament_division,
+                round_num=self.match.round_num - 1,
+                round_slot=self.match.round_slot // 2)
+
+    def test_record_result(self):
+        changed_matches = models.SparringTeamMatch.record_result(
+                self.match.pk, self.match.red_team_id, self.match.version)
+        parent_match = self.get_parent_match()
+        self.assertEqual([self.match.pk, parent_match.pk],
+                [match.pk for match in changed_matches])
+        side = 'red_team_id' if self.match.round_slot % 2 else 'blue_team_id'
+        self.assertEqual(self.match.red_team_id, getattr(parent_match, side))
+        self.assertEqual(parent_match.version, changed_matches[1].version)
+        self.match.refresh_from_db()
+        self.assertEqual(self.match.red_team_id, self.match.winning_team_id)
+        self.assertEqual(changed_matches[0].version, self.match.version)
+
+    def test_clear_result(self):
+        models.SparringTeamMatch.record_result(self.match.pk,
+                self.match.blue_team_id)
+        models.SparringTeamMatch.record_result(self.match.pk, None)
+        parent_match = self.get_parent_match()
+        side = 'red_team_id' if self.match.round_slot % 2 else 'blue_team_id'
+        self.assertIsNone(getattr(parent_match, side))
+        self.assertEqual([], models.SparringTeamMatch.record_result(
+                self.match.pk, None))
+
+    def test_version_conflict(self):
+        version = self.match.version
+        models.SparringTeamMatch.record_result(self.match.pk,
+                self.match.blue_team_id, version)
+        with self.assertRaises(models.MatchVersionConflict):
+            models.SparringTeamMatch.record_result(self.match.pk,
+                    self.match.red_team_id, version)
+        self.match.refresh_from_db()
+        self.assertEqual(self.match.blue_team_id, self.match.winning_team_id)
+
+    def test_concurrent_saves_bump_version(self):
+        version = self.match.version
+        first = models.SparringTeamMatch.objects.get(pk=self.match.pk)
+        second = models.SparringTeamMatch.objects.get(pk=self.match.pk)
+        first.ring_number = 1
+        first.save()
+        second.in_holding = True
+        second.save(update_fields=['in_holding'])
+        # each instance only knows its own increment
+        self.assertEqual(version + 1, first.version)
+        self.assertEqual(version + 1, second.version)
+        self.match.refresh_from_db()
+        self.assertEqual(version + 2, self.match.version)
+        with self.assertRaises(models.MatchVersionConflict):
+            models.SparringTeamMatch.record_result(self.match.pk,
+                    self.match.blue_team_id, first.version)
+
+    def test_invalid_winning_team(self):
+        other_team = models.SparringTeamRegistration.objects.filter(
+                tournament_division=self.tournament_division).exclude(
+                pk__in=[self.match.blue_team_id, self.match.red_team_id])\
+                .first()
+        with self.assertRaises(IntegrityError):
+            models.SparringTeamMatch.record_result(self.match.pk,
+                    other_team.pk)
+
+    def test_decided_parent_match(self):
+        models.SparringTeamMatch.record_result(self.match.pk,
+                self.match.blue_team_id)
+        parent_match = self.get_parent_match()
+        parent_match.blue_team_id = parent_match.blue_team_id \
+                or self.match.blue_team_id
+        parent_match.red_team_id = parent_match.red_team_id \
+                or self.match.blue_team_id
+        parent_match.winning_team_id = self.match.blue_team_id
+        parent_match.save()
+        with self.assertRaises(IntegrityError):
+            models.SparringTeamMatch.record_result(self.match.pk,
+                    self.match.red_team_id)
+        self.match.refresh_from_db()
+        self.assertEqual(self.match.blue_team_id, self.match.winning_team_id)
+
+    def test_status_form_records_result(self):
+        self.client.force_login(User.objects.create_superuser('headtable',
+                'headtable@example.com', 'password'))
+        url = reverse('tmdb:update_teammatch_status', args=(
+                self.tournament_division.tournament.slug,
+                self.tournament_division.division.slug, self.match.number))
+        parent_match = self.get_parent_match()
+        models.SparringTeamMatch.objects.filter(pk=parent_match.pk).update(
+                winning_team=parent_match.blue_team_id
+                        or self.match.blue_team_id)
+        response = self.client.post(url, {
+                'winning_team': self.match.red_team_id, 'ring_number': 1})
+        self.assertEqual(200, response.status_code)
+        self.assertIn("winning team must be removed first",
+                response.context['team_match_form'].non_field_errors()[0])
+        self.match.refresh_from_db()
+        self.assertEqual((None, None),
+                (self.match.winning_team_id, self.match.ring_number))
+
+        models.SparringTeamMatch.objects.filter(pk=parent_match.pk).update(
+                winning_team=None)
+        response = self.client.post(url, {
+                'winning_team': self.match.red_team_id, 'ring_number': 1})
+        self.assertEqual(302, response.status_code)
+        self.match.refresh_from_db()
+        self.assertEqual((self.match.red_team_id, 1),
+                (self.match.winning_team_id, self.match.ring_number))
+        side = 'red_team_id' if self.match.round_slot % 2 else 'blue_team_id'
+        self.assertEqual(self.match.red_team_id,
+                getattr(self.get_parent_match(), side))
+
+class ApplyUpdatesTestCase(TestCase):
+    setUp = RecordResultTestCase.setUp
+    get_parent_match = RecordResultTestCase.get_parent_match
+
+    def test_apply_updates(self):
+        parent_match = self.get_parent_match()
+        changed_matches = models.SparringTeamMatch.apply_updates([
+                (self.match.pk, {'ring_number': '3', 'at_ring': True,
+                        'winning_team': self.match.blue_team_id},
+                        self.match.version),
+                (parent_match.pk, {'in_holding': True}, None),
+        ])
+        self.assertEqual({self.match.pk, parent_match.pk},
+                {match.pk for match in changed_matches})
+        self.match.refresh_from_db()
+        self.assertEqual((3, True, self.match.blue_team_id),
+                (self.match.ring_number, self.match.at_ring,
+                        self.match.winning_team_id))
+        parent_match.refresh_from_db()
+        self.assertTrue(parent_match.in_holding)
+        side = 'red_team_id' if self.match.round_slot % 2 else 'blue_team_id'
+        self.assertEqual(self.match.blue_team_id,
+                getattr(parent_match, side))
+
+    def test_failed_update_applies_nothing(self):
+        parent_match = self.get_parent_match()
+        for invalid_update in [
+                (parent_match.pk, {'number': 1}, None),
+                (parent_match.pk, {'at_ring': None}, None),
+                (parent_match.pk, {'in_holding': True},
+                        parent_match.version + 1),
+                (-1, {'in_holding': True}, None)]:
+            with self.assertRaises((ValidationError, IntegrityError,
+                    models.SparringTeamMatch.DoesNotExist)):
+                models.SparringTeamMatch.apply_updates([
+                        (self.match.pk, {'ring_number': 2}, None),
+                        invalid_update])
+            self.match.refresh_from_db()
+            self.assertIsNone(self.match.ring_number)
+
+    def test_process_update(self):
+        user = User.objects.create_user('headtable')
+        message = {'message_type': 'update', 'message_id': 4, 'updates': [
+                {'id': self.match.pk, 'fields': {'ring_number': 5},
+                        'version': self.match.version}]}
+        reply = json.loads(SparringTeamMatchConsumer.process_update(user,
+                message))
+        self.assertEqual(('error', 4),
+                (reply['message_type'], reply['message_id']))
+
+        user.user_permissions.add(Permission.objects.get(
+                codename='change_sparringteammatch'))
+        user = User.objects.get(pk=user.pk)
+        reply = json.loads(SparringTeamMatchConsumer.process_update(user,
+                message))
+        self.assertEqual(('ack', 4),
+                (reply['message_type'], reply['message_id']))
+        content = reply['message_content']
+        self.assertEqual(self.match.pk, content['rows'][0][0])
+        self.assertEqual(5, content['rows'][0][
+                content['fields'].index('ring_number') + 1])
+        self.assertEqual(self.match.version + 1, content['rows'][0][
+                content['fields'].index('version') + 1])
@@ -0,0 +1,138 @@
+import time
+
+from django.test import SimpleTestCase
+
+from tmdb.util import SlotAssigner, SlotAssignmentTeam, search_slots
+
+class SlotAssignerTeam():
+    def __init__(self, school_name, number, points=0, num_competitors=3):
+        self.school_name = school_name
+        self.number = number
+        self.points = points
+        self._num_competitors = num_competitors
+
+    def num_competitors(self):
+        return self._num_competitors
+
+    def __repr__(self):
+        return "%s %d" %(self.school_name, self.number)
+
+class SlotAssignerTestCase(SimpleTestCase):
+    @staticmethod
+    def create_teams(num_schools, teams_per_school):
+        teams = []
+        for school_num in range(num_schools):
+            for team_num in range(teams_per_school):
+                teams.append(SlotAssignerTeam("School %d" %(school_num,),
+                        team_num + 1, points=school_num * 10 + team_num))
+        return teams
+
+    @staticmethod
+    def slots_by_name(slot_assigner):
+        return {repr(team): slot
+                for team, slot in slot_assigner.slots_by_team.items()}
+
+    def test_every_team_gets_a_unique_slot(self):
+        teams = SlotAssignerTestCase.create_teams(20, 6)
+        slot_assigner = SlotAssigner(teams, 4, seed=1)
+        self.assertEqual(set(range(1, len(teams) + 1)),
+                set(slot_assigner.slots_by_team.values()))
+
+    def test_seeded_teams(self):
+        teams = SlotAssignerTestCase.create_teams(8, 2)
+        slot_assigner = SlotAssigner(teams, 4, seed=1)
+        seeded_teams = sorted(teams, key=lambda team: -team.points)[:4]
+        for slot, team in enumerate(seeded_teams):
+            self.assertEqual(slot + 1, slot_assigner.slots_by_team[team])
+
+    def test_same_seed_same_slots(self):
+        teams = SlotAssignerTestCase.create_teams(30, 4)
+        slots = SlotAssignerTestCase.slots_by_name(
+                SlotAssigner(teams, 4, seed=42))
+        self.assertEqual(slots, SlotAssignerTestCase.slots_by_name(
+                SlotAssigner(teams, 4, seed=42)))
+        self.assertNotEqual(slots, SlotAssignerTestCase.slots_by_name(
+                SlotAssigner(teams, 4, seed=43)))
+
+    def test_school_teams_in_different_halves(self):
+        teams = SlotAssignerTestCase.create_teams(4, 2)
+        for seed in range(20):
+            slot_assigner = SlotAssigner(teams, 0, seed=seed)
+            halves = slot_assigner._partition_slots(2)
+            for school_teams in slot_assigner.teams_grouped_by_school.values():
+                team_halves = {next(half_num
+                        for half_num, half in enumerate(halves)
+                        if slot_assigner.slots_by_team[team] in half)
+                        for team in school_teams}
+                self.assertEqual(2, len(team_halves))
+
+    def test_one_person_teams_are_not_assigned(self):
+        teams = SlotAssignerTestCase.create_teams(4, 2)
+        teams.append(SlotAssignerTeam("School 0", 3, num_competitors=1))
+        slot_assigner = SlotAssigner(teams, 4, seed=1)
+        self.assertNotIn(teams[-1], slot_assigner.slots_by_team)
+        self.assertEqual(8, len(slot_assigner.slots_by_team))
+
+    @staticmethod
+    def create_uneven_teams():
+        teams = []
+        for school_num, num_teams in enumerate([5, 4, 4, 3, 2, 2, 1, 1]):
+            for team_num in range(num_teams):
+                teams.append(SlotAssignerTeam("School %d" %(school_num,),
+                        team_num + 1, points=(school_num * 7 + team_num) % 5))
+        return teams
+
+    def test_optimize_cost_matches_recomputed_cost(self):
+        teams = SlotAssignerTestCase.create_uneven_teams()
+        for seed in range(10):
+            slot_assigner = SlotAssigner(teams, 4, seed=seed)
+            cost = slot_assigner.cost()
+            optimized_cost = slot_assigner.optimize(10, max_iterations=2000)
+            self.assertEqual(optimized_cost, slot_assigner.cost())
+            self.assertLessEqual(optimized_cost, cost)
+            self.assertEqual(set(range(1, len(teams) + 1)),
+                    set(slot_assigner.slots_by_team.values()))
+
+    def test_optimize_keeps_seeded_teams(self):
+        teams = SlotAssignerTestCase.create_uneven_teams()
+        slot_assigner = SlotAssigner(teams, 4, seed=1)
+        seeded_slots = {slot: slot_assigner.slots[slot]
+                for slot in range(1, slot_assigner.num_seeded + 1)}
+        slot_assigner.optimize(10, max_iterations=2000)
+        for slot, team in seeded_slots.items():
+            self.assertIs(team, slot_assigner.slots[slot])
+
+    def test_optimize_balances_halves(self):
+        teams = SlotAssignerTestCase.create_uneven_teams()
+        total_imbalance = total_optimized_imbalance = 0
+        for seed in range(10):
+            slot_assigner = SlotAssigner(teams, 0, seed=seed)
+            total_imbalance += slot_assigner.cost()[1]
+            total_optimized_imbalance += slot_assigner.optimize(10,
+                    max_iterations=2000)[1]
+        self.assertLess(total_optimized_imbalance, total_imbalance)
+
+    def test_optimize_stops_early(self):
+        teams = SlotAssignerTestCase.create_uneven_teams()
+        slot_assigner = SlotAssigner(teams, 4, seed=1)
+        start = time.perf_counter()
+        cost = slot_assigner.optimize(60, max_stale_iterations=100)
+        self.assertLess(time.perf_counter() - start, 10)
+        self.assertEqual(cost, slot_assigner.cost())
+        # an assignment without cost is not searched
+        teams = [SlotAssignmentTeam(team_num, "SCHOOL %d" %(team_num,), 0, 3)
+                for team_num in range(8)]
+        slot_assigner = SlotAssigner(teams, 0, seed=1)
+        self.assertEqual((0, 0), slot_assigner.cost())
+        start = time.perf_counter()
+        self.assertEqual((0, 0), slot_assigner.optimize(60))
+        self.assertLess(time.perf_counter() - start, 10)
+
+    def test_search_slots(self):
+        teams = [SlotAssignmentTeam(team_num, team.school_name, team.points,
+                3) for team_num, team in enumerate(
+                SlotAssignerTestCase.create_uneven_teams())]
+        slots = search_slots(teams, 4, seed=1, time_budget=0.1,
+                max_workers=2)
+        self.assertEqual(set(range(1, len(teams) + 1)), set(slots.values()))
+        self.assertEqual({team.id for team in teams}, set(slots))
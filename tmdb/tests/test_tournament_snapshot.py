@@ -0,0 +1,290 @@
+import json
+import threading
+from unittest.mock import patch
+
+from django.conf import settings
+from django.core import serializers
+from django.core.cache import cache, caches
+from django.db import IntegrityError, connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from tmdb import models, tournament_snapshot
+from tmdb.consumers import SparringTeamMatchConsumer
+from .test_import_registration_data import TournamentImportTestCase
+
+def run_with_other_cache_client(function, *args):
+    """
+    Runs function in another thread, which has its own cache client and
+    database connection, like another process (e.g. a management command)
+    changing the tournament would.
+    """
+    cache_clients = [caches['default']]
+    def run():
+        try:
+            cache_clients.append(caches['default'])
+            function(*args)
+        finally:
+            connection.close()
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    assert cache_clients[0] is not cache_clients[1]
+
+class SharedCacheTestCase(SimpleTestCase):
+    def test_cache_is_shared_between_processes(self):
+        # the versions bumped by one process must invalidate the snapshots
+        # and brackets cached by the others
+        self.assertNotIn(settings.CACHES['default']['BACKEND'], (
+                'django.core.cache.backends.locmem.LocMemCache',
+                'django.core.cache.backends.dummy.DummyCache',))
+
+    def test_cache_holds_change_log(self):
+        self.assertGreater(settings.CACHES['default'].get('OPTIONS', {}).get(
+                'MAX_ENTRIES', 300), 2 * tournament_snapshot.CHANGE_LOG_SIZE)
+
+class TournamentSnapshotTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        filenames = list(TournamentImportTestCase.registration_data_filenames())
+        self.tournament = TournamentImportTestCase.import_tournament(
+                *filenames[0][:2], uniq_id=1)
+        self.other_tournament = TournamentImportTestCase.import_tournament(
+                *filenames[-1][:2], uniq_id=2)
+        self.tournament.assign_slots_to_all_divisions(seed=1, max_workers=1)
+        for tournament_division in models.TournamentSparringDivision.objects\
+                .filter(tournament=self.tournament):
+            tournament_division.create_matches_from_slots()
+
+    def get_snapshot(self, tournament):
+        return json.loads(tournament_snapshot.get_snapshot(tournament)[1])
+
+    def test_snapshot_matches_serializer(self):
+        snapshot = self.get_snapshot(self.tournament)
+        matches = models.SparringTeamMatch.objects.filter(
+                division__tournament=self.tournament)
+        serialized_matches = json.loads(serializers.serialize('json', matches,
+                fields=tournament_snapshot.json_fields['team_match']))
+        self.assertEqual(
+                sorted(serialized_matches, key=lambda match: match['pk']),
+                sorted([datum for datum in snapshot
+                        if datum['model'] == 'tmdb.sparringteammatch'],
+                        key=lambda match: match['pk']))
+        serialized_tournament = json.loads(serializers.serialize('json',
+                [self.tournament],
+                fields=tournament_snapshot.json_fields['tournament']))
+        self.assertEqual(serialized_tournament, [datum for datum in snapshot
+                if datum['model'] == 'tmdb.tournament'])
+
+    def test_snapshot_is_scoped_to_tournament(self):
+        snapshot = self.get_snapshot(self.tournament)
+        pks = {}
+        for datum in snapshot:
+            pks.setdefault(datum['model'], set()).add(datum['pk'])
+        registrations = models.SparringTeamRegistration.objects.filter(
+                tournament_division__tournament=self.tournament)
+        self.assertEqual(set(registrations.values_list('pk', flat=True)),
+                pks['tmdb.sparringteamregistration'])
+        self.assertEqual(set(registrations.values_list('team', flat=True)),
+                pks['tmdb.sparringteam'])
+        self.assertEqual(set(registrations.values_list('team__school',
+                flat=True)), pks['tmdb.school'])
+        self.assertLess(len(pks['tmdb.sparringteam']),
+                models.SparringTeam.objects.count())
+
+    def test_etag(self):
+        url = reverse('tmdb:tournament_json', args=(self.tournament.slug,))
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        etag = response['ETag']
+        self.assertEqual(self.get_snapshot(self.tournament),
+                json.loads(response.content))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        tournament_snapshot.bump_version(self.tournament.pk)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+
+class TournamentSnapshotInvalidationTestCase(TransactionTestCase):
+    def test_changes_bump_version(self):
+        cache.clear()
+        tournament, _ = TournamentImportTestCase.import_single_tournament()
+        version = tournament_snapshot.get_version(tournament.pk)
+        tournament.assign_slots_to_all_divisions(seed=1, max_workers=1)
+        self.assertLess(version, tournament_snapshot.get_version(
+                tournament.pk))
+
+        tournament_division = models.TournamentSparringDivision.objects\
+                .filter(tournament=tournament).first()
+        version = tournament_snapshot.get_version(tournament.pk)
+        tournament_division.create_matches_from_slots()
+        self.assertLess(version, tournament_snapshot.get_version(
+                tournament.pk))
+
+        version, snapshot = tournament_snapshot.get_snapshot(tournament)
+        match = models.SparringTeamMatch.objects.filter(
+                division=tournament_division).first()
+        match.ring_number = 1
+        match.save()
+        new_version, new_snapshot = tournament_snapshot.get_snapshot(
+                tournament)
+        self.assertLess(version, new_version)
+        self.assertNotEqual(snapshot, new_snapshot)
+
+    def test_bumps_get_their_own_versions(self):
+        tournament, _ = TournamentImportTestCase.import_single_tournament()
+        version = tournament_snapshot.get_version(tournament.pk)
+        versions = []
+        for _ in range(3):
+            versions.append(tournament_snapshot.bump_version(tournament.pk))
+            run_with_other_cache_client(lambda: versions.append(
+                    tournament_snapshot.bump_version(tournament.pk)))
+        self.assertEqual(list(range(version + 1, version + 7)), versions)
+        # the database increments the version, so that concurrent bumps
+        # cannot both read the same one
+        with CaptureQueriesContext(connection) as queries:
+            tournament_snapshot.bump_version(tournament.pk)
+        self.assertTrue(any(query['sql'].startswith('UPDATE')
+                and '"version" + 1' in query['sql']
+                for query in queries.captured_queries))
+        # and the versions are not lost with the cache
+        cache.clear()
+        self.assertEqual(version + 7,
+                tournament_snapshot.get_version(tournament.pk))
+
+    def test_version_bumped_by_other_process(self):
+        cache.clear()
+        tournament, _ = TournamentImportTestCase.import_single_tournament()
+        url = reverse('tmdb:tournament_json', args=(tournament.slug,))
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(304, self.client.get(url,
+                HTTP_IF_NONE_MATCH=etag).status_code)
+        run_with_other_cache_client(tournament_snapshot.bump_version,
+                tournament.pk)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+
+class TournamentChangeLogTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.tournament, _ = TournamentImportTestCase.import_single_tournament()
+        self.tournament.assign_slots_to_all_divisions(seed=1, max_workers=1)
+        self.tournament_division = models.TournamentSparringDivision.objects\
+                .filter(tournament=self.tournament).first()
+        self.tournament_division.create_matches_from_slots()
+
+    def update_match(self, match, ring_number):
+        match.ring_number = ring_number
+        match.save()
+
+    def test_replays_match_changes(self):
+        version = tournament_snapshot.get_version(self.tournament.pk)
+        matches = models.SparringTeamMatch.objects.filter(
+                division=self.tournament_division).order_by('number')[:2]
+        self.update_match(matches[0], 1)
+        self.update_match(matches[1], 2)
+        self.update_match(matches[0], 3)
+
+        current_version, changes = tournament_snapshot.get_changes(
+                self.tournament.pk, version)
+        self.assertEqual(version + 3, current_version)
+        self.assertEqual(list(range(version + 1, version + 4)),
+                [change['version'] for change in changes])
+        ring_number_index = changes[0]['message_content']['fields'].index(
+                'ring_number') + 1
+        self.assertEqual([[(matches[0].pk, 1)], [(matches[1].pk, 2)],
+                [(matches[0].pk, 3)]], [[(row[0], row[ring_number_index])
+                        for row in change['message_content']['rows']]
+                for change in changes])
+        self.assertEqual((current_version, []), tournament_snapshot.get_changes(
+                self.tournament.pk, current_version))
+
+    def test_rebuild_is_one_change(self):
+        version = tournament_snapshot.get_version(self.tournament.pk)
+        self.tournament_division.create_matches_from_slots()
+        _, changes = tournament_snapshot.get_changes(self.tournament.pk,
+                version)
+        self.assertEqual(1, len(changes))
+        self.assertEqual('division_rebuilt', changes[0]['message_type'])
+        self.assertEqual(models.SparringTeamMatch.objects.filter(
+                division=self.tournament_division).count(),
+                len(changes[0]['message_content']['matches']['rows']))
+
+    def test_transaction_is_one_change(self):
+        version = tournament_snapshot.get_version(self.tournament.pk)
+        matches = list(models.SparringTeamMatch.objects.filter(
+                division=self.tournament_division))
+        with transaction.atomic():
+            for match in matches:
+                self.update_match(match, 5)
+            self.update_match(matches[0], 6)
+        _, changes = tournament_snapshot.get_changes(self.tournament.pk,
+                version)
+        self.assertEqual(1, len(changes))
+        compact_data = changes[0]['message_content']
+        ring_number_index = compact_data['fields'].index('ring_number') + 1
+        ring_numbers = {row[0]: row[ring_number_index]
+                for row in compact_data['rows']}
+        self.assertEqual(len(matches), len(compact_data['rows']))
+        self.assertEqual(6, ring_numbers.pop(matches[0].pk))
+        self.assertEqual({5}, set(ring_numbers.values()))
+
+    def test_rolled_back_transaction_is_not_logged(self):
+        version = tournament_snapshot.get_version(self.tournament.pk)
+        match = models.SparringTeamMatch.objects.filter(
+                division=self.tournament_division).first()
+        try:
+            with transaction.atomic():
+                self.update_match(match, 7)
+                raise IntegrityError()
+        except IntegrityError:
+            pass
+        self.assertEqual((version, []), tournament_snapshot.get_changes(
+                self.tournament.pk, version))
+
+    def test_unlogged_change_requires_snapshot(self):
+        version = tournament_snapshot.get_version(self.tournament.pk)
+        team_registration = models.SparringTeamRegistration.objects.filter(
+                tournament_division=self.tournament_division).first()
+        team_registration.points = 5
+        team_registration.save()
+        self.assertIsNone(tournament_snapshot.get_changes(self.tournament.pk,
+                version))
+
+    def test_truncated_log_requires_snapshot(self):
+        version = tournament_snapshot.get_version(self.tournament.pk)
+        match = models.SparringTeamMatch.objects.filter(
+                division=self.tournament_division).first()
+        with patch.object(tournament_snapshot, 'CHANGE_LOG_SIZE', 2):
+            for ring_number in range(3):
+                self.update_match(match, ring_number + 1)
+            self.assertIsNone(tournament_snapshot.get_changes(
+                    self.tournament.pk, version))
+            self.assertEqual(2, len(tournament_snapshot.get_changes(
+                    self.tournament.pk, version + 1)[1]))
+
+    def test_sync_message(self):
+        version = tournament_snapshot.get_version(self.tournament.pk)
+        match = models.SparringTeamMatch.objects.filter(
+                division=self.tournament_division).first()
+        self.update_match(match, 4)
+        message = json.loads(SparringTeamMatchConsumer.create_sync_message(
+                self.tournament.pk, version))
+        self.assertEqual('changes', message['message_type'])
+        self.assertEqual(version + 1, message['version'])
+        change = message['message_content'][0]['message_content']
+        self.assertEqual(4, change['rows'][0][
+                change['fields'].index('ring_number') + 1])
+        # a version sent as a string is read as the integer it holds
+        message = json.loads(SparringTeamMatchConsumer.create_sync_message(
+                self.tournament.pk, str(version)))
+        self.assertEqual('changes', message['message_type'])
+        self.assertEqual(version + 1, message['version'])
+        for since_version in (None, "", "latest", 1.5j, [version], {},
+                version - tournament_snapshot.CHANGE_LOG_SIZE - 1):
+            message = json.loads(SparringTeamMatchConsumer\
+                    .create_sync_message(self.tournament.pk, since_version))
+            self.assertEqual('snapshot_required', message['message_type'])
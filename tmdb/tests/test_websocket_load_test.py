@@ -0,0 +1,18 @@
+from django.core.cache import cache
+from django.test import TransactionTestCase
+
+from tmdb.util.websocket_load_test import load_test_match_list
+
+from .test_import_registration_data import TournamentImportTestCase
+
+class WebsocketLoadTestTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_load_test_match_list(self):
+        tournament, _ = TournamentImportTestCase.import_single_tournament()
+        result = load_test_match_list(tournament, 5, num_updates=3)
+        self.assertEqual(15, result['num_delivered'])
+        self.assertEqual(0, result['num_lost'])
+        self.assertLessEqual(result['latency']['p95'],
+                result['latency']['max'])
@@ -0,0 +1,316 @@
+"""
+The JSON snapshot of a tournament that the match list loads when it
+connects, in the format of django.core.serializers.
+
+Snapshots are cached per tournament under a version number which is
+incremented (once the transaction commits) whenever the data of the
+tournament changes. Versions are kept in the database (see CacheVersion),
+so that concurrent changes each get their own version and versions never
+decrease; a snapshot's version can be used as its ETag. The cache must be
+shared between processes (see CACHES in settings.py), and large enough to
+keep the change log, for a change made by one process to reach the
+clients of the others.
+
+Changes to matches are also kept in a bounded per-tournament change log,
+keyed on the version they created, so that a client that has already
+loaded the snapshot at some version can catch up by replaying the
+changes since then. Changes that are not logged (e.g. to registrations)
+still bump the version, which leaves a gap in the log and makes clients
+load a new snapshot instead.
+"""
+
+import json
+import threading
+import time
+
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+
+from tmdb import models
+
+SNAPSHOT_TIMEOUT = 60 * 60
+CHANGE_LOG_SIZE = 1000
+
+# sent after a change to a tournament has been committed and logged; change
+# is None if it was not logged. previous_ring_numbers maps the ids of the
+# matches of an update that left a ring to the ring numbers they left.
+tournament_changed = Signal(providing_args=['tournament_id', 'version',
+        'change', 'previous_ring_numbers'])
+
+json_fields = {
+    'tournament': ('id', 'location', 'date',),
+    'division': ('id', 'sex', 'skill_level',),
+    'school': ('id', 'name',),
+    'team': ('id', 'division', 'school', 'number',),
+    'tournament_division': ('id', 'division', 'tournament',),
+    'school_tournament_registration': ('id', 'school_season_registration',
+                    'tournament',),
+    'school_season_registration': ('id', 'school',),
+    'team_registration': ('id', 'lightweight', 'middleweight', 'heavyweight',
+                    'alternate1', 'alternate2', 'team', 'tournament_division',
+                    'points', 'seed',),
+    'team_match': ('id', 'blue_team', 'red_team', 'winning_team', 'division',
+                    'in_holding', 'at_ring', 'number', 'ring_assignment_time',
+                    'ring_number', 'round_num', 'round_slot', 'competing',
+                    'version',),
+}
+
+def _version_key(tournament_id):
+    return "tournament-version-%d" %(tournament_id,)
+
+def _snapshot_key(tournament_id, version):
+    return "tournament-snapshot-%d-%d" %(tournament_id, version)
+
+def _change_key(tournament_id, version):
+    return "tournament-change-%d-%d" %(tournament_id, version)
+
+def initial_version():
+    # start from the current time, so that a version that is created again
+    # (e.g. after the database was reset) is greater than the ETags and
+    # versions clients still hold
+    return int(time.time() * 1000)
+
+def get_version(tournament_id):
+    return models.CacheVersion.get_version(_version_key(tournament_id),
+            initial_version())
+
+def bump_version(tournament_id):
+    return models.CacheVersion.bump_version(_version_key(tournament_id),
+            initial_version())
+
+def record_change(tournament_id, change=None, previous_ring_numbers=None):
+    """
+    Bumps the version of tournament_id, logs change (a dict with the
+    message_type and message_content of a match update) under the new
+    version and sends tournament_changed. Returns the new version.
+    """
+    version = bump_version(tournament_id)
+    if change is not None:
+        cache.set(_change_key(tournament_id, version), change,
+                SNAPSHOT_TIMEOUT)
+        cache.delete(_change_key(tournament_id, version - CHANGE_LOG_SIZE))
+    tournament_changed.send(sender=models.Tournament,
+            tournament_id=tournament_id, version=version, change=change,
+            previous_ring_numbers=previous_ring_numbers or {})
+    return version
+
+def get_changes(tournament_id, since_version):
+    """
+    Returns the current version of tournament_id and the changes logged
+    after since_version, each with its version, or None if any of them is
+    no longer (or was never) in the log.
+    """
+    version = get_version(tournament_id)
+    if not 0 <= version - since_version <= CHANGE_LOG_SIZE:
+        return None
+    versions = range(since_version + 1, version + 1)
+    keys = [_change_key(tournament_id, change_version)
+            for change_version in versions]
+    changes = cache.get_many(keys)
+    if len(changes) != len(keys):
+        return None
+    return version, [dict(changes[key], version=change_version)
+            for key, change_version in zip(keys, versions)]
+
+def get_etag(tournament_id, version):
+    return "%d-%d" %(tournament_id, version)
+
+def model_values(queryset, fields):
+    """Serializes queryset with .values(), in the same format as
+    serializers.serialize('python', queryset, fields=fields)."""
+    model_label = queryset.model._meta.label_lower
+    field_names = [field_name for field_name in fields if field_name != 'id']
+    return [{
+        'model': model_label,
+        'pk': row['id'],
+        'fields': {field_name: row[field_name] for field_name in field_names},
+    } for row in queryset.values('id', *field_names)]
+
+def compact_values(queryset, fields):
+    """
+    Serializes queryset for match updates as one list of values per row,
+    with the primary key first, instead of a dict per row:
+    {'model': ..., 'fields': [field names], 'rows': [[pk, values...], ...]}
+    """
+    field_names = [field_name for field_name in fields if field_name != 'id']
+    return {
+        'model': queryset.model._meta.label_lower,
+        'fields': field_names,
+        'rows': [list(row) for row in queryset.values_list('id', *field_names)],
+    }
+
+def build_snapshot(tournament):
+    """
+    Returns the objects the match list needs for tournament: the divisions,
+    schools, teams, registrations and matches of this tournament only.
+    """
+    teams = models.SparringTeam.objects.filter(
+            sparringteamregistration__tournament_division__tournament=
+                    tournament)
+    school_season_registrations = \
+            models.SchoolSeasonRegistration.objects.filter(
+                    schooltournamentregistration__tournament=tournament)
+    schools = models.School.objects.filter(
+            Q(pk__in=teams.values('school'))
+            | Q(pk__in=school_season_registrations.values('school')))
+
+    snapshot = []
+    snapshot.extend(model_values(
+            models.Tournament.objects.filter(pk=tournament.pk),
+            json_fields['tournament']))
+    snapshot.extend(model_values(
+            models.SparringDivision.objects.filter(tournaments=tournament),
+            json_fields['division']))
+    snapshot.extend(model_values(schools, json_fields['school']))
+    snapshot.extend(model_values(teams, json_fields['team']))
+    snapshot.extend(model_values(
+            models.TournamentSparringDivision.objects.filter(
+                    tournament=tournament),
+            json_fields['tournament_division']))
+    snapshot.extend(model_values(
+            models.SchoolTournamentRegistration.objects.filter(
+                    tournament=tournament),
+            json_fields['school_tournament_registration']))
+    snapshot.extend(model_values(school_season_registrations,
+            json_fields['school_season_registration']))
+    snapshot.extend(model_values(
+            models.SparringTeamRegistration.objects.filter(
+                    tournament_division__tournament=tournament),
+            json_fields['team_registration']))
+    snapshot.extend(model_values(
+            models.SparringTeamMatch.objects.filter(
+                    division__tournament=tournament),
+            json_fields['team_match']))
+    return snapshot
+
+def get_snapshot(tournament):
+    """Returns the current version of tournament and its snapshot as a
+    JSON string, building the snapshot if it is not cached."""
+    version = get_version(tournament.pk)
+    key = _snapshot_key(tournament.pk, version)
+    snapshot = cache.get(key)
+    if snapshot is None:
+        snapshot = json.dumps(build_snapshot(tournament), cls=DjangoJSONEncoder)
+        cache.set(key, snapshot, SNAPSHOT_TIMEOUT)
+    return version, snapshot
+
+_division_tournament_ids = {}
+
+def _get_division_tournament_id(tournament_division_id):
+    # divisions never move between tournaments, so this is safe to cache
+    tournament_id = _division_tournament_ids.get(tournament_division_id)
+    if tournament_id is None:
+        tournament_id = models.TournamentSparringDivision.objects.filter(
+                pk=tournament_division_id).values_list(
+                'tournament', flat=True).first()
+        _division_tournament_ids[tournament_division_id] = tournament_id
+    return tournament_id
+
+_get_tournament_ids = {
+    models.Tournament: lambda tournament: [tournament.pk],
+    models.TournamentSparringDivision:
+            lambda tournament_division: [tournament_division.tournament_id],
+    models.SchoolTournamentRegistration:
+            lambda registration: [registration.tournament_id],
+    models.SparringTeamRegistration: lambda registration: [
+            _get_division_tournament_id(registration.tournament_division_id)],
+    models.SparringTeamMatch: lambda match: [
+            _get_division_tournament_id(match.division_id)],
+    models.SparringTeam: lambda team: models.TournamentSparringDivision\
+            .objects.filter(sparringteamregistration__team=team)\
+            .values_list('tournament', flat=True),
+    models.SchoolSeasonRegistration: lambda registration:
+            models.SchoolTournamentRegistration.objects.filter(
+                    school_season_registration=registration)\
+            .values_list('tournament', flat=True),
+    models.School: lambda school: models.Tournament.objects.filter(
+            Q(tournamentsparringdivision__sparringteamregistration__team__school=
+                    school)
+            | Q(schooltournamentregistration__school_season_registration__school=
+                    school)).values_list('id', flat=True).distinct(),
+}
+
+def invalidate_tournaments(tournament_ids, change=None):
+    for tournament_id in set(tournament_ids):
+        if tournament_id is not None:
+            transaction.on_commit(
+                    lambda tournament_id=tournament_id:
+                            record_change(tournament_id, change))
+
+def invalidate_snapshot(sender, instance, **kwargs):
+    if sender is models.SparringTeamMatch \
+            and models.TournamentSparringDivision.is_rebuilding(
+                    instance.division_id):
+        # logged as one change by invalidate_snapshot_on_rebuild
+        return
+    invalidate_tournaments(_get_tournament_ids[sender](instance))
+
+for sender in _get_tournament_ids:
+    if sender is not models.SparringTeamMatch:
+        post_save.connect(invalidate_snapshot, sender=sender,
+                dispatch_uid="invalidate_snapshot_on_save")
+    post_delete.connect(invalidate_snapshot, sender=sender,
+            dispatch_uid="invalidate_snapshot_on_delete")
+
+# ids of the saved matches of each tournament that have not been logged yet
+_changed_matches = threading.local()
+
+def _log_changed_matches():
+    changed_match_ids = getattr(_changed_matches, 'match_ids', None)
+    if not changed_match_ids:
+        return
+    _changed_matches.match_ids = {}
+    for tournament_id, match_ids in changed_match_ids.items():
+        record_change(tournament_id, {
+            'message_type': 'update',
+            'message_content': compact_values(
+                    models.SparringTeamMatch.objects.filter(pk__in=match_ids),
+                    json_fields['team_match']),
+        }, {match_id: ring_numbers
+                for match_id, ring_numbers in match_ids.items()
+                if ring_numbers})
+
+@receiver(post_save, sender=models.SparringTeamMatch,
+        dispatch_uid="log_team_match_change")
+def log_team_match_change(sender, instance, **kwargs):
+    """
+    Collects the matches saved during a transaction, which are logged as one
+    change per tournament once it commits. The matches are read again then,
+    so the change has their committed values; the rings they were read at
+    are kept, so that a match leaving a ring is sent to that ring's clients.
+    """
+    if models.TournamentSparringDivision.is_rebuilding(instance.division_id):
+        return
+    if not hasattr(_changed_matches, 'match_ids'):
+        _changed_matches.match_ids = {}
+    tournament_id = _get_division_tournament_id(instance.division_id)
+    ring_numbers = _changed_matches.match_ids.setdefault(tournament_id,
+            {}).setdefault(instance.pk, set())
+    if instance.loaded_ring_number not in (None, instance.ring_number):
+        ring_numbers.add(instance.loaded_ring_number)
+    # only the first callback to run after the commit logs anything; if the
+    # transaction is rolled back, its matches are read again (harmlessly) by
+    # the next one
+    transaction.on_commit(_log_changed_matches)
+
+@receiver(models.division_matches_rebuilt,
+        sender=models.TournamentSparringDivision,
+        dispatch_uid="invalidate_snapshot_on_rebuild")
+def invalidate_snapshot_on_rebuild(sender, tournament_division, **kwargs):
+    invalidate_tournaments([tournament_division.tournament_id], {
+        'message_type': 'division_rebuilt',
+        'message_content': {
+            'division': tournament_division.pk,
+            'matches': compact_values(models.SparringTeamMatch.objects.filter(
+                    division=tournament_division), json_fields['team_match']),
+        },
+    })
+
+@receiver(models.tournament_data_changed, sender=models.Tournament,
+        dispatch_uid="invalidate_snapshot_on_change")
+def invalidate_snapshot_on_change(sender, tournament_id, **kwargs):
+    invalidate_tournaments([tournament_id])
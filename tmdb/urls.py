@@ -75,9 +75,17 @@ urlpatterns = [
             + r'/delete_teams/*$',
             views.tournament_view.tournament_delete_teams,
             name='tournament_delete_teams'),
+    url(tournament_base
+            + r'/update_teams/*$',
+            views.tournament_view.tournament_update_teams,
+            name='tournament_update_teams'),
     url(tournament_base
             + r'/json_data/*$',
             views.tournament_view.tournament_json, name='tournament_json'),
+    url(tournament_base
+            + r'/match_queue/*$',
+            views.tournament_view.tournament_match_queue_json,
+            name='tournament_match_queue_json'),
 
     # tournament import
     url(tournament_base
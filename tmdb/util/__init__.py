@@ -1,3 +1,5 @@
 from .bracket_generator import *
+from .bracket_graph import *
+from .import_statistics import *
 from .slot_assigner import *
-from .team_file_importer import parse_team_file
+from .team_file_importer import *
@@ -20,36 +20,8 @@ class BracketNode():
         self.round_num = round_num
         self.round_slot = round_slot
         self.blue_team = self.red_team = None
-
-    def _set_teams(self, seeds):
-        upper_seeds = {}
-        lower_seeds = {}
-        for seed_num, team in seeds.items():
-            match_side = self._get_side_of_match(seed_num - 1, self.round_num)
-            if match_side == BracketNode.UPPER_SIDE:
-                upper_seeds[seed_num] = team
-                continue
-            if match_side == BracketNode.LOWER_SIDE:
-                lower_seeds[seed_num] = team
-                continue
-            raise Exception("Unexpected result from"
-                    " BracketNode._get_side_of_match: %d" %(match_side))
-
-        if len(upper_seeds) > 1:
-            upper_predecessor = BracketNode(
-                    self.bracket, self.round_num + 1, self.round_slot * 2)
-            self.bracket._add_bracket_node(upper_predecessor)
-            upper_predecessor._set_teams(upper_seeds)
-        elif len(upper_seeds) == 1:
-            self.blue_team = next(iter(upper_seeds.values()))
-
-        if len(lower_seeds) > 1:
-            lower_predecessor = BracketNode(
-                    self.bracket, self.round_num + 1, self.round_slot * 2 + 1)
-            self.bracket._add_bracket_node(lower_predecessor)
-            lower_predecessor._set_teams(lower_seeds)
-        elif len(lower_seeds) == 1:
-            self.red_team = next(iter(lower_seeds.values()))
+        self.number = None
+        self._is_bye = False
 
     def _get_previous_round_match(self, match_side):
         upper_side, lower_side = self._get_previous_round_matches()
@@ -65,42 +37,17 @@ class BracketNode():
                 self.bracket._get_bracket_node(
                 self.round_num + 1, self.round_slot * 2 + 1),)
 
-    _cached_match_side_values = {(0, 0,): False, (1, 0,): True, (2, 0,): True,
-                (3, 0,): False}
     @staticmethod
     def _get_side_of_match(seed, round_num):
-
-        pivot = 2 ** (round_num + 2)
-        seed %= pivot
-        cached_value = BracketNode._cached_match_side_values.get(
-                (seed, round_num,))
-        if cached_value is not None: return cached_value
-
-        result = BracketNode._get_side_of_match(seed, round_num - 1)
-        if seed >= pivot // 4 and seed < pivot * 3 // 4:
-            result = not result
-        BracketNode._cached_match_side_values[(seed, round_num,)] = result
-        return result
+        """ Returns the side (UPPER_SIDE or LOWER_SIDE) of the match in
+            round_num that the zero-based seed enters from. This is bit 0
+            of the seed XOR bit round_num + 1, so the slot of the seed's
+            match in round r is formed by the sides of rounds 0 to r - 1,
+            most significant first."""
+        return (seed ^ (seed >> (round_num + 1))) & 1
 
     def is_bye(self):
-        upper_pred, lower_pred = self._get_previous_round_matches()
-        if upper_pred:
-            upper_match_is_bye = upper_pred.is_bye()
-        else:
-            upper_match_is_bye = not bool(self.blue_team)
-
-        if upper_match_is_bye:
-            return True
-
-        if lower_pred:
-            lower_match_is_bye = lower_pred.is_bye()
-        else:
-            lower_match_is_bye = not bool(self.red_team)
-
-        if lower_match_is_bye:
-            return True
-
-        return False
+        return self._is_bye
 
     def _render_pprint(self):
         indent = " " * 8
@@ -138,42 +85,91 @@ class BracketNode():
             lower_pred.pprint()
 
 class BracketGenerator():
+    """
+    Generates the matches of a single elimination bracket from a dict of
+    seed numbers to teams.
+
+    The matches are stored in one list per round, indexed by round_slot.
+    Each round is built from the previous one by splitting the seeds of
+    every match on BracketNode._get_side_of_match, byes are computed in one
+    pass from the last round to the final and the matches are numbered in
+    one more pass, so generating a bracket takes O(n log n) time for n
+    seeds.
+    """
 
     def __init__(self, seeds, match_number_start_val):
-        self.matches = {}
         self.seeds = seeds
-        self._add_bracket_node(BracketNode(self, 0, 0))
+        self.rounds = []
         self._set_seeds(self.seeds)
+        self._compute_byes()
         self._assign_match_numbers(match_number_start_val)
 
     def _set_seeds(self, seeds):
-        self._get_bracket_node(0, 0)._set_teams(seeds)
+        round_seeds = {0: sorted(seeds.items())}
+        round_num = 0
+        while round_seeds:
+            bracket_round = [None] * (1 << round_num)
+            next_round_seeds = {}
+            for round_slot, match_seeds in round_seeds.items():
+                bracket_node = BracketNode(self, round_num, round_slot)
+                bracket_round[round_slot] = bracket_node
+                side_seeds = ([], [])
+                for seed_num, team in match_seeds:
+                    side_seeds[BracketNode._get_side_of_match(
+                            seed_num - 1, round_num)].append((seed_num, team))
+                upper_seeds, lower_seeds = side_seeds
+                if len(upper_seeds) > 1:
+                    next_round_seeds[round_slot * 2] = upper_seeds
+                elif upper_seeds:
+                    bracket_node.blue_team = upper_seeds[0][1]
+                if len(lower_seeds) > 1:
+                    next_round_seeds[round_slot * 2 + 1] = lower_seeds
+                elif lower_seeds:
+                    bracket_node.red_team = lower_seeds[0][1]
+            self.rounds.append(bracket_round)
+            round_seeds = next_round_seeds
+            round_num += 1
 
     def _get_bracket_node(self, round_num, round_slot):
-        return self.matches.get((round_num, round_slot,))
-
-    def _add_bracket_node(self, bracket_node):
-        round_num = bracket_node.round_num
-        round_slot = bracket_node.round_slot
-        self.matches[(round_num, round_slot,)] = bracket_node
+        if round_num >= len(self.rounds):
+            return None
+        bracket_round = self.rounds[round_num]
+        if round_slot >= len(bracket_round):
+            return None
+        return bracket_round[round_slot]
+
+    def _compute_byes(self):
+        """ A match is a bye if either side has no team, either because
+            no seed enters from that side or because the match feeding it
+            is a bye. The later rounds are computed first so each match
+            only looks at its two predecessors."""
+        for bracket_round in reversed(self.rounds):
+            for bracket_node in filter(None, bracket_round):
+                upper_pred, lower_pred = \
+                        bracket_node._get_previous_round_matches()
+                if upper_pred:
+                    upper_match_is_bye = upper_pred._is_bye
+                else:
+                    upper_match_is_bye = not bool(bracket_node.blue_team)
+                if lower_pred:
+                    lower_match_is_bye = lower_pred._is_bye
+                else:
+                    lower_match_is_bye = not bool(bracket_node.red_team)
+                bracket_node._is_bye = upper_match_is_bye or lower_match_is_bye
 
     def _assign_match_numbers(self, match_number_start_val):
-        match_keys = self._sorted_match_keys()
-        for match_key in match_keys:
-            match = self.matches[match_key]
+        for match in self:
             if match.is_bye():
                 match.number = None
                 continue
             match.number = match_number_start_val
             match_number_start_val+= 1
 
-    def _sorted_match_keys(self):
-        match_keys = list(self.matches.keys())
-        match_keys.sort(reverse=True, key = lambda x: (x[0], -x[1]))
-        return match_keys
-
     def __iter__(self):
-        return BracketIterator(self)
+        """ Yields the matches from the first round to the final, in
+            round_slot order within each round."""
+        for bracket_round in reversed(self.rounds):
+            yield from filter(None, bracket_round)
 
     @staticmethod
     def create_from_teams_file(filename):
@@ -191,17 +187,6 @@ class BracketGenerator():
     def pprint(self):
         return self._get_bracket_node(0,0).pprint()
 
-class BracketIterator():
-
-    def __init__(self, bracket_generator):
-        self.bracket_generator = bracket_generator
-        self.match_keys_iterator = iter(
-                self.bracket_generator._sorted_match_keys())
-
-    def __next__(self):
-        match_key = next(self.match_keys_iterator)
-        return self.bracket_generator._get_bracket_node(*match_key)
-
 if __name__ == "__main__":
     bracket = BracketGenerator.create_from_teams_file('seeds.txt')
     for match in bracket:
@@ -0,0 +1,80 @@
+import threading
+
+__all__ = ["BracketGraph", "BracketGraphCache"]
+
+class BracketGraph():
+    """
+    The shape of one division's bracket: the id of the match at each
+    (round_num, round_slot) and the links between a match, the match its
+    winner advances to and the two matches that feed it.
+    """
+
+    def __init__(self, matches):
+        """matches is an iterable of (match_id, round_num, round_slot)."""
+        self.match_ids = {}
+        self.round_keys = {}
+        for match_id, round_num, round_slot in matches:
+            self.match_ids[(round_num, round_slot)] = match_id
+            self.round_keys[match_id] = (round_num, round_slot)
+
+    def __contains__(self, match_id):
+        return match_id in self.round_keys
+
+    def get_match_id(self, round_num, round_slot):
+        return self.match_ids.get((round_num, round_slot))
+
+    @staticmethod
+    def next_round_key(round_num, round_slot):
+        return round_num - 1, round_slot // 2
+
+    @staticmethod
+    def previous_round_keys(round_num, round_slot):
+        return ((round_num + 1, round_slot * 2),
+                (round_num + 1, round_slot * 2 + 1))
+
+    def get_next_round_match_id(self, match_id):
+        return self.match_ids.get(BracketGraph.next_round_key(
+                *self.round_keys[match_id]))
+
+    def get_previous_round_match_ids(self, match_id):
+        return [self.match_ids.get(round_key) for round_key in
+                BracketGraph.previous_round_keys(*self.round_keys[match_id])]
+
+class BracketGraphCache():
+    """
+    Keeps one BracketGraph per division in process memory. A graph is
+    loaded with load_matches(division_id) the first time it is requested
+    and again after the division has been invalidated.
+    """
+
+    def __init__(self, load_matches):
+        self.load_matches = load_matches
+        self._graphs = {}
+        self._lock = threading.Lock()
+
+    def get(self, division_id):
+        with self._lock:
+            graph = self._graphs.get(division_id)
+        if graph is not None:
+            return graph
+        graph = BracketGraph(self.load_matches(division_id))
+        with self._lock:
+            return self._graphs.setdefault(division_id, graph)
+
+    def find(self, match_id):
+        """Returns the division id and the loaded BracketGraph containing
+        match_id, or (None, None) if no loaded graph contains it."""
+        with self._lock:
+            graphs = list(self._graphs.items())
+        for division_id, graph in graphs:
+            if match_id in graph:
+                return division_id, graph
+        return None, None
+
+    def invalidate(self, division_id):
+        with self._lock:
+            self._graphs.pop(division_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._graphs.clear()
@@ -0,0 +1,168 @@
+import csv
+import platform
+import statistics
+import time
+import tracemalloc
+from datetime import date
+from io import StringIO
+from itertools import product
+
+from django.db import connection, transaction
+
+from tmdb import models
+from tmdb.util.team_file_importer import DIVISION_NAMES, \
+        DIVISION_RE_PATTERNS, NUM_TEAMS_RE, parse_team_file
+
+__all__ = ["BenchmarkResult", "benchmark", "benchmark_import", "environment",
+        "scale_team_file"]
+
+class BenchmarkResult():
+    def __init__(self, name):
+        self.name = name
+        self.timings = []
+        self.values = []
+        self.num_queries = None
+        self.peak_memory = None
+        # the value of the call that measured the queries and memory
+        self.traced_value = None
+
+    def as_dict(self):
+        return {
+            'wall_time': summarize_timings(self.timings),
+            'num_queries': self.num_queries,
+            'peak_memory': self.peak_memory,
+        }
+
+def summarize_timings(timings):
+    return {
+        'rounds': len(timings),
+        'min': min(timings),
+        'max': max(timings),
+        'mean': statistics.mean(timings),
+    }
+
+def benchmark(name, function, rounds=5):
+    """
+    Calls function `rounds` times and records the wall time of each call,
+    in the manner of the pytest-benchmark fixture. The query count and
+    peak memory are measured in one extra call, so that tracemalloc does
+    not skew the timings.
+    """
+    result = BenchmarkResult(name)
+    for _ in range(rounds):
+        start = time.perf_counter()
+        value = function()
+        result.timings.append(time.perf_counter() - start)
+        result.values.append(value)
+
+    num_queries = 0
+    def count_query(execute, sql, params, many, context):
+        nonlocal num_queries
+        num_queries += 1
+        return execute(sql, params, many, context)
+
+    tracemalloc.start()
+    try:
+        with connection.execute_wrapper(count_query):
+            result.traced_value = function()
+        result.peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    result.num_queries = num_queries
+    return result
+
+def scale_team_file(lines, scale):
+    """
+    Returns the lines of a registration file with `scale` copies of every
+    team. Each copy belongs to a differently named school, so the scaled
+    file imports scale times as many schools and teams.
+    """
+    rows = list(csv.reader(lines))
+    header, num_teams_row = rows[0], list(rows[1])
+    team_rows = rows[3:]
+    for column, column_name in enumerate(header):
+        if column_name not in DIVISION_NAMES:
+            continue
+        match = NUM_TEAMS_RE.match(num_teams_row[column])
+        num_teams_row[column] = "%d Teams" %(
+                int(match.group('num_teams')) * scale,)
+
+    scaled_rows = [header, num_teams_row, rows[2]] + team_rows
+    for copy_num in range(2, scale + 1):
+        for team_row in team_rows:
+            scaled_row = list(team_row)
+            for column, team_cell in enumerate(team_row):
+                if column >= len(header) or header[column] not in \
+                        DIVISION_NAMES or not team_cell:
+                    continue
+                pattern = DIVISION_RE_PATTERNS[header[column]]
+                school_end = pattern.search(team_cell).span()[0]
+                scaled_row[column] = "%s Copy %d%s" %(
+                        team_cell[:school_end], copy_num,
+                        team_cell[school_end:])
+            scaled_rows.append(scaled_row)
+
+    scaled_file = StringIO()
+    csv.writer(scaled_file).writerows(scaled_rows)
+    return scaled_file.getvalue().splitlines(keepends=True)
+
+def _import_and_roll_back(tournament, lines):
+    with transaction.atomic():
+        tournament.import_registration_data(lines)
+        transaction.set_rollback(True)
+    tournament.imported = False
+    return tournament.import_statistics
+
+def benchmark_import(lines, rounds=5):
+    """
+    Benchmarks parse_team_file and a full import (one transaction per
+    round, rolled back afterwards) of the registration file `lines`, with
+    the wall time, query count and peak memory of each import stage.
+    """
+    with transaction.atomic():
+        # parse_team_file needs the sparring divisions to exist
+        for sex, skill_level in product(models.SexField.SEX_LABELS,
+                models.SparringDivisionLevelField.DIVISION_LEVEL_LABELS):
+            models.SparringDivision.objects.get_or_create(sex=sex,
+                    skill_level=skill_level)
+        season = models.Season.objects.create(
+                start_date=date(year=1900, month=9, day=1),
+                end_date=date(year=1901, month=9, day=1))
+        tournament = models.Tournament.objects.create(season=season,
+                location='benchmark', date=date(year=1900, month=10, day=1),
+                registration_doc_url='http://ectc-online.org/benchmark')
+        parse_result = benchmark('parse_team_file',
+                lambda: parse_team_file(lines), rounds=rounds)
+        import_result = benchmark('import_registration_data',
+                lambda: _import_and_roll_back(tournament, lines),
+                rounds=rounds)
+        transaction.set_rollback(True)
+
+    # the stages reset the peak of the traced memory
+    import_result.peak_memory = max(import_result.peak_memory,
+            import_result.traced_value.peak_traced_memory or 0)
+    stages = {}
+    for import_statistics in import_result.values:
+        for stage in import_statistics.stages:
+            stage_results = stages.setdefault(stage.name,
+                    {'timings': [], 'num_queries': stage.num_queries})
+            stage_results['timings'].append(stage.elapsed)
+    for stage in import_result.traced_value.stages:
+        stages[stage.name]['peak_memory'] = stage.peak_memory
+    return {
+        'num_teams': sum(len(teams) for teams in
+                parse_result.values[0].values()),
+        'parse_team_file': parse_result.as_dict(),
+        'import_registration_data': import_result.as_dict(),
+        'stages': {name: {
+            'wall_time': summarize_timings(stage_results['timings']),
+            'num_queries': stage_results['num_queries'],
+            'peak_memory': stage_results['peak_memory'],
+        } for name, stage_results in stages.items()},
+    }
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'database': connection.vendor,
+    }
@@ -0,0 +1,78 @@
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from django.db import connection
+
+__all__ = ["ImportStage", "ImportStatistics"]
+
+class ImportStage():
+    def __init__(self, name):
+        self.name = name
+        self.num_queries = 0
+        self.elapsed = 0.0
+        # bytes allocated above the traced memory at the start of the stage,
+        # if tracemalloc is tracing
+        self.peak_memory = None
+
+    def __str__(self):
+        return "%s: %d queries in %.3fs" %(
+                self.name, self.num_queries, self.elapsed)
+
+class ImportStatistics():
+    """Records the number of database queries and the elapsed time of
+    each stage of a registration import, and its peak memory if tracemalloc
+    is tracing."""
+
+    def __init__(self):
+        self.stages = []
+        # the highest traced memory seen, since resetting the peak of each
+        # stage discards the peak of the whole import
+        self.peak_traced_memory = None
+
+    @contextmanager
+    def stage(self, name):
+        stage = ImportStage(name)
+
+        def count_query(execute, sql, params, many, context):
+            stage.num_queries += 1
+            return execute(sql, params, many, context)
+
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            start_memory, peak_memory = tracemalloc.get_traced_memory()
+            self._record_peak(peak_memory)
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(count_query):
+                yield stage
+        finally:
+            stage.elapsed = time.perf_counter() - start
+            if tracing:
+                peak_memory = tracemalloc.get_traced_memory()[1]
+                self._record_peak(peak_memory)
+                stage.peak_memory = peak_memory - start_memory
+            self.stages.append(stage)
+
+    def _record_peak(self, peak_memory):
+        self.peak_traced_memory = max(self.peak_traced_memory or 0,
+                peak_memory)
+
+    @property
+    def num_queries(self):
+        return sum(stage.num_queries for stage in self.stages)
+
+    @property
+    def elapsed(self):
+        return sum(stage.elapsed for stage in self.stages)
+
+    def as_dict(self):
+        return {stage.name: {'num_queries': stage.num_queries,
+                'elapsed': stage.elapsed} for stage in self.stages}
+
+    def __str__(self):
+        lines = [str(stage) for stage in self.stages]
+        lines.append("total: %d queries in %.3fs" %(
+                self.num_queries, self.elapsed))
+        return "\n".join(lines)
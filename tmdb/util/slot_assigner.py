@@ -1,11 +1,15 @@
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import os
 import random
 import itertools as it
+import time
 
 import logging
 logger = logging.getLogger(__name__)
 
-__all__ = ["SlotAssignerException", "SlotAssigner"]
+__all__ = ["SlotAssignerException", "SlotAssigner", "SlotAssignmentTeam",
+        "assign_slots", "search_slots"]
 
 def _group_by(group_function, items):
     grouped_items = defaultdict(list)
@@ -36,13 +40,27 @@ def _next_power_of_2(num):
 class SlotAssignerException(Exception): pass
 
 class SlotAssigner:
+    """
+    Assigns teams to the slots of a bracket, keeping teams from the same
+    school as far apart as possible.
+
+    The slot groups for every partition size (halves, quarters, etc.) are
+    computed once, and each group keeps a bitmask of the schools already
+    placed in it, so placing a team does not rescan the bracket. Passing
+    the same seed with the same teams reproduces the same assignment.
+    """
+    # swaps tried without lowering cost() before optimize gives up
+    MAX_STALE_ITERATIONS = 5000
+
     def __init__(self, teams, num_seeds, get_school_name=None,
-            get_points=None):
+            get_points=None, seed=None):
         self.teams = teams
         # FIXME do not assign one-person teams for now
         self._drop_one_person_teams()
         self.num_teams = len(self.teams)
         self.num_seeds = num_seeds
+        self.seed = seed
+        self.rng = random.Random(seed)
         self.get_school_name = get_school_name
         if self.get_school_name is None:
             self.get_school_name = lambda team: team.school_name
@@ -53,8 +71,37 @@ class SlotAssigner:
                 self.get_school_name, self.teams)
         self.slots = {}
         self.slots_by_team = {}
+        self.num_seeded = 0
+        self._init_partitions()
         self._compute_bracket()
 
+    def _init_partitions(self):
+        self._school_bits = {school_name: 1 << school_num for school_num,
+                school_name in enumerate(self.teams_grouped_by_school)}
+        self._team_school_bits = {team: self._school_bits[school_name]
+                for school_name, school_teams in
+                        self.teams_grouped_by_school.items()
+                for team in school_teams}
+        self._partition_sizes = []
+        num_partitions = 1
+        while True:
+            self._partition_sizes.append(num_partitions)
+            if num_partitions >= self.num_teams:
+                break
+            num_partitions <<= 1
+        # for each partition size: the unfilled slots of each group, the
+        # schools present in each group and the group of each slot
+        self._free_slots = {}
+        self._group_schools = {}
+        self._slot_groups = {}
+        for num_partitions in self._partition_sizes:
+            slot_groups = self._partition_slots(num_partitions)
+            self._free_slots[num_partitions] = slot_groups
+            self._group_schools[num_partitions] = [0] * num_partitions
+            self._slot_groups[num_partitions] = {slot: group_num
+                    for group_num, slots in enumerate(slot_groups)
+                    for slot in slots}
+
     def _drop_one_person_teams(self):
         all_teams = self.teams
         filtered_teams = list(filter(
@@ -81,11 +128,14 @@ class SlotAssigner:
                 self.assign_slot(school_team)
 
     def assign_slot(self, team):
-        for num_partitions in [1,2,4,8,16,32,64,128]:
-            slot_groups = self._partition_slots(num_partitions)
-            slot_groups = self._prune_slot_groups_with_team_from_same_school(
-                    slot_groups, self.get_school_name(team))
-            slot_groups = self._prune_filled_slot_groups(slot_groups)
+        school_bit = self._team_school_bits[team]
+        for num_partitions in self._partition_sizes:
+            free_slots = self._free_slots[num_partitions]
+            group_schools = self._group_schools[num_partitions]
+            slot_groups = [free_slots[group_num]
+                    for group_num in range(num_partitions)
+                    if free_slots[group_num]
+                            and not group_schools[group_num] & school_bit]
             if slot_groups:
                 break
 
@@ -93,13 +143,9 @@ class SlotAssigner:
         # we must use the largest one because otherwise, all but one group may
         # fill and two schools from a later team might get grouped together
         # earlier than they should
-        random.shuffle(slot_groups)
-        max_slot_group_size = 0
-        for slot_group in slot_groups:
-            slot_group_size = len(slot_group)
-            if slot_group_size > max_slot_group_size:
-                max_slot_group_size = slot_group_size
-                slot = random.sample(slot_group, 1)[0]
+        self.rng.shuffle(slot_groups)
+        slot_group = max(slot_groups, key=len)
+        slot = self.rng.choice(sorted(slot_group))
         self.set_slot(team, slot)
 
     def _partition_slots(self, num_partitions):
@@ -114,7 +160,7 @@ class SlotAssigner:
         [{8, 1, 9}, {15, 2, 10, 7}, {3, 11, 6, 14}, {4, 5, 12, 13}]
         """
         if num_partitions < 1:
-            raise ArgumentError("Must have at least one partition")
+            raise ValueError("Must have at least one partition")
 
         brackets = [set() for i in range(num_partitions)]
         forward_groups = range(num_partitions)
@@ -125,36 +171,6 @@ class SlotAssigner:
             brackets[group_num].add(slot + 1)
         return brackets
 
-    def _prune_slot_groups_with_team_from_same_school(self, slot_groups,
-            school_name):
-        """Return all slot groups which do not already have a team from
-        this school"""
-        pruned_slot_groups = []
-        for slots in slot_groups:
-            team_found = False
-            for slot in slots:
-                slotted_team = self.slots.get(slot)
-                if slotted_team is None:
-                    continue
-                if self.get_school_name(slotted_team) == school_name:
-                    team_found = True
-                    break
-            if not team_found:
-                pruned_slot_groups.append(slots)
-
-        return pruned_slot_groups
-
-    def _prune_filled_slot_groups(self, slot_groups):
-        pruned_slot_groups = []
-        for slots in slot_groups:
-            pruned_slot_group = set()
-            for slot in slots:
-                if slot not in self.slots:
-                    pruned_slot_group.add(slot)
-            if pruned_slot_group:
-                pruned_slot_groups.append(pruned_slot_group)
-        return pruned_slot_groups
-
     def _assign_seeds(self, min_num_seeds):
         """ Calculates all the teams that deserve a seed and inserts
             them in the appropriate location of the bracket. This method
@@ -181,16 +197,134 @@ class SlotAssigner:
                     point_group))
 
             # break ties by shuffling all teams in the same group of points
-            random.shuffle(point_group)
+            self.rng.shuffle(point_group)
             seeded_teams.extend(point_group)
 
         for slot_num, seeded_team in enumerate(seeded_teams):
             self.set_slot(seeded_team, slot_num + 1)
+        self.num_seeded = len(seeded_teams)
 
     def set_slot(self, team, slot_num):
         logger.info("Assigning %s to %d" %(team, slot_num))
         self.slots[slot_num] = team
         self.slots_by_team[team] = slot_num
+        school_bit = self._team_school_bits[team]
+        for num_partitions in self._partition_sizes:
+            group_num = self._slot_groups[num_partitions][slot_num]
+            self._free_slots[num_partitions][group_num].discard(slot_num)
+            self._group_schools[num_partitions][group_num] |= school_bit
+
+    def _meeting_depth(self, slot, other_slot):
+        """ Returns the number of partition levels (halves, quarters,
+            etc.) that slot and other_slot share. Teams sharing more levels
+            can meet in an earlier round; sharing every level means they
+            meet in the first round."""
+        depth = 0
+        for num_partitions in self._partition_sizes[1:]:
+            slot_groups = self._slot_groups[num_partitions]
+            if slot_groups[slot] != slot_groups[other_slot]:
+                break
+            depth += 1
+        return depth
+
+    def _school_cost(self, slot, school_slots, team_slot=None):
+        """ Returns the cost of a team of a school placed in slot, given
+            the slots of the school's teams. team_slot is the slot the team
+            currently holds, if it is not slot."""
+        if team_slot is None:
+            team_slot = slot
+        return sum(4 ** self._meeting_depth(slot, other_slot)
+                for other_slot in school_slots if other_slot != team_slot)
+
+    def _half(self, slot):
+        if len(self._partition_sizes) < 2:
+            return 0
+        return self._slot_groups[2][slot]
+
+    def cost(self):
+        """ Scores the current assignment as a (same school cost, half
+            imbalance) tuple, where lower is better. The same school cost
+            grows by a factor of 4 for every round earlier that two teams
+            from the same school can meet, and the half imbalance is the
+            difference between the points of the two halves."""
+        school_cost = 0
+        for school_teams in self.teams_grouped_by_school.values():
+            school_slots = [self.slots_by_team[team] for team in school_teams]
+            school_cost += sum(self._school_cost(slot, school_slots)
+                    for slot in school_slots) // 2
+        half_points = [0, 0]
+        for team, slot in self.slots_by_team.items():
+            half_points[self._half(slot)] += self.get_points(team) or 0
+        return school_cost, abs(half_points[0] - half_points[1])
+
+    def optimize(self, time_budget, max_iterations=None,
+            max_stale_iterations=MAX_STALE_ITERATIONS):
+        """ Improves the assignment by swapping the slots of unseeded
+            teams, keeping every swap that does not make cost() worse, until
+            time_budget seconds have passed, max_iterations swaps have been
+            tried, max_stale_iterations swaps in a row have not lowered the
+            cost or it is (0, 0). Each swap is scored incrementally from the
+            slots of the two schools involved. Returns the final cost()."""
+        school_cost, half_imbalance = self.cost()
+        movable_slots = list(range(self.num_seeded + 1, self.num_teams + 1))
+        if len(movable_slots) < 2 or (school_cost, half_imbalance) == (0, 0):
+            return school_cost, half_imbalance
+        school_slots = {school_name: {self.slots_by_team[team]
+                for team in school_teams} for school_name, school_teams in
+                self.teams_grouped_by_school.items()}
+        half_points = [0, 0]
+        for team, slot in self.slots_by_team.items():
+            half_points[self._half(slot)] += self.get_points(team) or 0
+        half_difference = half_points[0] - half_points[1]
+
+        deadline = time.perf_counter() + time_budget
+        last_improvement = 0
+        for iteration in it.count():
+            if iteration == max_iterations \
+                    or iteration - last_improvement == max_stale_iterations:
+                break
+            if iteration % 256 == 0 and time.perf_counter() > deadline:
+                break
+            slot, other_slot = self.rng.sample(movable_slots, 2)
+            team, other_team = self.slots[slot], self.slots[other_slot]
+            school_name = self.get_school_name(team)
+            other_school_name = self.get_school_name(other_team)
+            if school_name == other_school_name:
+                continue
+
+            team_slots = school_slots[school_name]
+            other_team_slots = school_slots[other_school_name]
+            school_cost_delta = (
+                    self._school_cost(other_slot, team_slots, slot)
+                    - self._school_cost(slot, team_slots)
+                    + self._school_cost(slot, other_team_slots, other_slot)
+                    - self._school_cost(other_slot, other_team_slots))
+            new_half_difference = half_difference
+            if self._half(slot) != self._half(other_slot):
+                points_moved = (self.get_points(team) or 0) \
+                        - (self.get_points(other_team) or 0)
+                if self._half(slot) == 0:
+                    points_moved = -points_moved
+                new_half_difference += 2 * points_moved
+            new_cost = (school_cost + school_cost_delta,
+                    abs(new_half_difference))
+            if new_cost > (school_cost, abs(half_difference)):
+                continue
+            if new_cost < (school_cost, abs(half_difference)):
+                last_improvement = iteration
+
+            school_cost += school_cost_delta
+            half_difference = new_half_difference
+            team_slots.remove(slot)
+            team_slots.add(other_slot)
+            other_team_slots.remove(other_slot)
+            other_team_slots.add(slot)
+            self.slots[slot], self.slots[other_slot] = other_team, team
+            self.slots_by_team[team] = other_slot
+            self.slots_by_team[other_team] = slot
+            if new_cost == (0, 0):
+                break
+        return school_cost, abs(half_difference)
 
     def pprint(self):
         strs = []
@@ -199,3 +333,48 @@ class SlotAssigner:
             strs.append("slot %3d: %s" %(slot, self.slots.get(slot)))
         return "\n".join(strs)
 
+
+class SlotAssignmentTeam(namedtuple('SlotAssignmentTeam',
+        ['id', 'school_name', 'points', 'num_weight_classes'])):
+    """A picklable stand-in for a team, so that slots can be assigned in a
+    worker process."""
+
+    def num_competitors(self):
+        return self.num_weight_classes
+
+    def __str__(self):
+        return "%s #%d" %(self.school_name, self.id)
+
+def assign_slots(teams, num_seeds, seed=None, time_budget=None):
+    """Assigns slots to SlotAssignmentTeams, returning the slot of each
+    team keyed by its id. The assignment is optimized for time_budget
+    seconds if it is given."""
+    return _assign_slots(teams, num_seeds, seed, time_budget)[1]
+
+def _assign_slots(teams, num_seeds, seed, time_budget):
+    slot_assigner = SlotAssigner(teams, num_seeds, seed=seed)
+    if time_budget:
+        cost = slot_assigner.optimize(time_budget)
+    else:
+        cost = slot_assigner.cost()
+    return cost, {team.id: slot
+            for team, slot in slot_assigner.slots_by_team.items()}
+
+def search_slots(teams, num_seeds, seed=None, time_budget=1.0,
+        max_workers=None):
+    """Optimizes one candidate assignment of SlotAssignmentTeams per worker
+    process, each starting from a different seed, and returns the slots of
+    the candidate with the lowest SlotAssigner.cost()."""
+    num_candidates = max_workers or os.cpu_count() or 1
+    rng = random.Random(seed)
+    seeds = [rng.getrandbits(32) for _ in range(num_candidates)]
+    if num_candidates == 1:
+        return assign_slots(teams, num_seeds, seeds[0], time_budget)
+    with ProcessPoolExecutor(max_workers=num_candidates) as executor:
+        candidates = list(executor.map(_assign_slots,
+                [teams] * num_candidates, [num_seeds] * num_candidates,
+                seeds, [time_budget] * num_candidates))
+    cost, slots = min(candidates, key=lambda candidate: candidate[0])
+    logger.info("Best of %d candidate slot assignments has cost %s",
+            num_candidates, cost)
+    return slots
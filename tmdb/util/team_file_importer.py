@@ -1,13 +1,15 @@
+import codecs
 import csv
+import itertools
 import re
-from io import StringIO
-from collections import defaultdict
+from collections import Counter, defaultdict, namedtuple
 
 from tmdb import models
 
 NUM_TEAMS_RE = re.compile('(?P<num_teams>\d+) Teams')
 
-__all__ = ['parse_team_file']
+__all__ = ['group_team_records', 'parse_team_file', 'read_team_file',
+        'TeamFileParseError', 'TeamFileReader', 'TeamRecord']
 
 DIVISION_NAMES = [
     "Men's A",
@@ -18,6 +20,14 @@ DIVISION_NAMES = [
     "Women's C",
 ]
 
+TeamRecord = namedtuple('TeamRecord', ['division_name', 'school_name',
+        'team_num', 'has_lightweight', 'has_middleweight', 'has_heavyweight'])
+
+class TeamFileParseError(ValueError):
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("\n".join(errors))
+
 def _generate_division_re(division_name):
     return re.compile(f' {division_name}(?P<team_num>\d+) - \('
             + '(?P<has_lightweight>L?)'
@@ -25,52 +35,145 @@ def _generate_division_re(division_name):
             + '(?P<has_heavyweight>H?)'
             + '\)$')
 
-def parse_team_file(team_file):
-    team_file_data = team_file.read()
-    if type(team_file_data) is not str:
-        team_file_data = team_file_data.decode('utf-8')
-    teams_fh = StringIO(team_file_data)
-    teams_csv = csv.DictReader(teams_fh)
-    # ignore first two rows of the file (they are empty)
-    num_teams = _parse_num_teams(next(teams_csv))
-    next(teams_csv)
+DIVISION_RE_PATTERNS = {division_name: _generate_division_re(division_name)
+        for division_name in DIVISION_NAMES}
 
-    teams = defaultdict(list)
+def _iter_lines(team_file):
+    """Yields the lines of team_file as strings, decoding them one at a
+    time if the file was opened in binary mode (e.g. an UploadedFile)."""
+    lines = iter(team_file)
+    first_line = next(lines, None)
+    if first_line is None:
+        return
+    lines = itertools.chain([first_line], lines)
+    if isinstance(first_line, str):
+        yield from lines
+    else:
+        yield from codecs.iterdecode(lines, 'utf-8')
 
-    division_re_patterns = {}
-    for division_name in DIVISION_NAMES:
-        division_re_patterns[division_name] = _generate_division_re(
-                division_name)
+class TeamFileReader():
+    """
+    Streams TeamRecords out of a registration dashboard export.
 
-    for team_row in teams_csv:
+    Malformed rows are skipped and described in self.errors, which is
+    complete once the reader has been exhausted.
+    """
+
+    def __init__(self, team_file):
+        self.team_file = team_file
+        self.errors = []
+        self.num_teams = {}
+        self.num_teams_read = Counter()
+
+    def __iter__(self):
+        teams_csv = csv.DictReader(_iter_lines(self.team_file))
+        missing_columns = [division_name for division_name in DIVISION_NAMES
+                if division_name not in (teams_csv.fieldnames or [])]
+        if missing_columns:
+            self.errors.append("Missing division columns: %s" %(
+                    ", ".join(missing_columns)))
+            return
+        # the first row holds the number of teams in each division and the
+        # second row is empty
+        self._parse_num_teams(next(teams_csv, {}), teams_csv.line_num)
+        next(teams_csv, None)
+
+        for team_row in teams_csv:
+            for division_name in DIVISION_NAMES:
+                team_cell = team_row.get(division_name)
+                if not team_cell:
+                    continue
+                team_record = self._parse_team_cell(division_name, team_cell,
+                        teams_csv.line_num)
+                if team_record is None:
+                    continue
+                self.num_teams_read[division_name] += 1
+                yield team_record
+        self._validate_num_teams()
+
+    def _parse_num_teams(self, num_teams_row, line_num):
         for division_name in DIVISION_NAMES:
-            if not team_row[division_name]:
+            num_teams_cell = num_teams_row.get(division_name) or ''
+            match = NUM_TEAMS_RE.match(num_teams_cell)
+            if not match:
+                self.errors.append("Line %d: expected number of %s teams,"
+                        " found [%s]" %(line_num, division_name,
+                        num_teams_cell))
                 continue
-            sparring_division = _get_sparring_division(division_name)
-            team_cell = team_row[division_name]
-            match = division_re_patterns[division_name].search(team_cell)
-            school_name = team_cell[:match.span()[0]]
-            team_data = {
-                    'sparring_division': sparring_division,
-                    'school_name': school_name,
-                    'team_num': int(match.group('team_num')),
-                    'has_lightweight': bool(match.group('has_lightweight')),
-                    'has_middleweight': bool(match.group('has_middleweight')),
-                    'has_heavyweight': bool(match.group('has_heavyweight')),
-            }
-            teams[division_name].append(team_data)
-    for division_name in DIVISION_NAMES:
-        assert len(teams[division_name]) == num_teams[division_name]
+            self.num_teams[division_name] = int(match.group('num_teams'))
+
+    def _parse_team_cell(self, division_name, team_cell, line_num):
+        match = DIVISION_RE_PATTERNS[division_name].search(team_cell)
+        if not match:
+            self.errors.append("Line %d: unable to parse %s team [%s]" %(
+                    line_num, division_name, team_cell))
+            return None
+        return TeamRecord(
+                division_name=division_name,
+                school_name=team_cell[:match.span()[0]],
+                team_num=int(match.group('team_num')),
+                has_lightweight=bool(match.group('has_lightweight')),
+                has_middleweight=bool(match.group('has_middleweight')),
+                has_heavyweight=bool(match.group('has_heavyweight')))
+
+    def _validate_num_teams(self):
+        for division_name, num_teams in self.num_teams.items():
+            num_teams_read = self.num_teams_read[division_name]
+            if num_teams_read == num_teams:
+                continue
+            self.errors.append("Expected %d %s teams, found %d" %(
+                    num_teams, division_name, num_teams_read))
+
+def parse_team_file(team_file):
+    team_file_reader = TeamFileReader(team_file)
+    teams = group_team_records(team_file_reader)
+    if team_file_reader.errors:
+        raise TeamFileParseError(team_file_reader.errors)
     return teams
 
-def _parse_num_teams(num_teams_row):
-    num_teams = {}
-    for division_name in DIVISION_NAMES:
-        match = re.match(NUM_TEAMS_RE, num_teams_row[division_name])
-        num_teams[division_name] = int(match.group('num_teams'))
-    return num_teams
+def read_team_file(team_file):
+    """
+    Returns the TeamRecords of team_file without accessing the database,
+    so it can be called from a worker process.
+    """
+    team_file_reader = TeamFileReader(team_file)
+    team_records = list(team_file_reader)
+    if team_file_reader.errors:
+        raise TeamFileParseError(team_file_reader.errors)
+    return team_records
+
+def group_team_records(team_records):
+    """Groups team_records by division name, converting them to the team
+    data dicts used by Tournament.import_parsed_registration_data."""
+    sparring_divisions = _get_sparring_divisions()
+    teams = defaultdict(list)
+    for team_record in team_records:
+        teams[team_record.division_name].append(
+                _team_data(team_record, sparring_divisions))
+    return teams
+
+def _team_data(team_record, sparring_divisions):
+    team_data = team_record._asdict()
+    team_data['sparring_division'] = sparring_divisions[
+            team_record.division_name]
+    return team_data
+
+def _get_sparring_divisions():
+    division_keys = {_get_sparring_division_key(division_name): division_name
+            for division_name in DIVISION_NAMES}
+    sparring_divisions = {}
+    for sparring_division in models.SparringDivision.objects.all():
+        division_key = (sparring_division.sex, sparring_division.skill_level)
+        if division_key in division_keys:
+            sparring_divisions[division_keys[division_key]] = sparring_division
+    missing_divisions = set(DIVISION_NAMES) - set(sparring_divisions)
+    if missing_divisions:
+        raise models.SparringDivision.DoesNotExist(
+                "Sparring divisions do not exist: %s" %(
+                ", ".join(sorted(missing_divisions))))
+    return sparring_divisions
 
-def _get_sparring_division(division_name):
+def _get_sparring_division_key(division_name):
     sex = division_name[:-1].strip()
     skill_level = division_name[-1:]
     if sex == "Men's":
@@ -79,4 +182,4 @@ def _get_sparring_division(division_name):
         sex = models.SexField.FEMALE
     else:
         raise ValueError(f"Unrecognized division_name: [{division_name}]")
-    return models.SparringDivision.objects.get(sex=sex, skill_level=skill_level)
+    return sex, skill_level
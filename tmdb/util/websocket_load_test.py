@@ -0,0 +1,111 @@
+import asyncio
+import json
+import statistics
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+
+from tmdb import consumers, routing, tournament_snapshot
+
+__all__ = ["load_test_match_list"]
+
+def _summarize_latencies(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return None
+    return {
+        'mean': statistics.mean(latencies),
+        'p95': latencies[int(0.95 * (len(latencies) - 1))],
+        'max': latencies[-1],
+    }
+
+async def _connect(application, path):
+    communicator = WebsocketCommunicator(application, path)
+    connected, _ = await communicator.connect(timeout=60)
+    if not connected:
+        raise ValueError("Could not connect to %s" %(path,))
+    return communicator
+
+async def _sync(communicator, version):
+    await communicator.send_to(text_data=json.dumps({
+        'message_type': 'sync',
+        'version': version,
+    }))
+    return json.loads(await communicator.receive_from(timeout=60))
+
+async def _receive_updates(communicator, num_updates, send_times, timeout):
+    latencies = []
+    try:
+        for _ in range(num_updates):
+            message = json.loads(await communicator.receive_from(
+                    timeout=timeout))
+            latencies.append(time.perf_counter()
+                    - send_times[message['version']])
+    except asyncio.TimeoutError:
+        pass
+    return latencies
+
+async def _load_test(tournament, num_clients, num_updates, timeout):
+    application = URLRouter(routing.websocket_urlpatterns)
+    path = "/ws/tournaments/%s/sparring_team_match_updates/" %(
+            tournament.slug,)
+    result = {'num_clients': num_clients, 'num_updates': num_updates}
+
+    start = time.perf_counter()
+    communicators = await asyncio.gather(*[_connect(application, path)
+            for _ in range(num_clients)])
+    result['connect_time'] = time.perf_counter() - start
+
+    try:
+        # every client reconnecting at once, and catching up from the
+        # version it had loaded
+        version = tournament_snapshot.get_version(tournament.pk)
+        start = time.perf_counter()
+        await asyncio.gather(*[_sync(communicator, version)
+                for communicator in communicators])
+        result['sync_time'] = time.perf_counter() - start
+
+        channel_layer = get_channel_layer()
+        group_name = consumers.match_updates_group_name(tournament.pk)
+        send_times = {}
+        receivers = [asyncio.ensure_future(_receive_updates(communicator,
+                num_updates, send_times, timeout))
+                for communicator in communicators]
+        start = time.perf_counter()
+        for update_num in range(num_updates):
+            send_times[update_num] = time.perf_counter()
+            await channel_layer.group_send(group_name, {
+                'type': 'update_sparring_team_match',
+                'message': consumers.create_message('update',
+                        {'model': 'tmdb.sparringteammatch', 'fields': [],
+                                'rows': []},
+                        dump_message_content=False, version=update_num),
+            })
+        latencies = []
+        for receiver in receivers:
+            latencies.extend(await receiver)
+        result['fan_out_time'] = time.perf_counter() - start
+    finally:
+        await asyncio.gather(*[communicator.disconnect()
+                for communicator in communicators])
+
+    result['num_delivered'] = len(latencies)
+    result['num_lost'] = num_clients * num_updates - len(latencies)
+    result['deliveries_per_second'] = len(latencies) / result['fan_out_time']
+    result['latency'] = _summarize_latencies(latencies)
+    return result
+
+def load_test_match_list(tournament, num_clients, num_updates=20,
+        timeout=10):
+    """
+    Connects num_clients match list clients to the SparringTeamMatchConsumer
+    of tournament in this process, has them all sync at once and broadcasts
+    num_updates match updates to them through the channel layer. Returns
+    the connect and sync times, the fan-out throughput and the delivery
+    latencies. Updates not delivered within timeout seconds are lost.
+    """
+    return async_to_sync(_load_test)(tournament, num_clients, num_updates,
+            timeout)
@@ -9,6 +9,7 @@ from django.contrib.auth import models as auth_models
 from django.contrib import messages
 from django import forms as django_forms
 
+from tmdb import bracket_cache
 from tmdb import forms
 from tmdb import models
 
@@ -65,70 +66,17 @@ def bracket_printable_pdf(request, tournament_slug, division_slug):
     return response
 
 def bracket(request, tournament_slug, division_slug):
-    tournament = get_object_or_404(models.Tournament, slug=tournament_slug)
-    tournament_division = get_object_or_404(models.TournamentSparringDivision,
-            tournament=tournament, division__slug=division_slug)
-    bracket_columns = []
-    matches, num_rounds = models.SparringTeamMatch.get_matches_by_round(
-            tournament_division)
-    bracket_column_height = str(64 * 2**num_rounds) + "px"
-    for round_num in reversed(range(num_rounds + 1)):
-        round_num_matches = 2**round_num
-        bracket_column = [None] * round_num_matches
-        bracket_columns.append(bracket_column)
-        for round_slot in range(round_num_matches):
-            key = (round_num, round_slot)
-            cell_type = []
-            if key not in matches:
-                match = models.SparringTeamMatch()
-                cell_type.append("bracket_cell_without_match")
-            else:
-                match = matches[key]
-                cell_type.append("bracket_cell_with_match")
-            if round_slot % 2:
-                cell_type.append("lower_child_cell")
-            else:
-                cell_type.append("upper_child_cell")
-            bracket_column[round_slot] = match
-            match.cell_type = " ".join(cell_type)
-            match.height = str(100 / (round_num_matches)) + "%"
-    if (0, 0) in matches:
-        matches[(0, 0)].cell_type = "bracket_cell_with_match" \
-                + " bracket_finals_cell"
-    unassigned_teams = models.SparringTeamRegistration.get_teams_without_assigned_slot(
-            tournament_division)
-
+    tournament_division = get_object_or_404(
+            models.TournamentSparringDivision.objects.select_related(
+                    'tournament', 'division'),
+            tournament__slug=tournament_slug, division__slug=division_slug)
     context = {
             'tournament_division': tournament_division,
-            'tournament': tournament,
-            'bracket_columns': bracket_columns,
-            'bracket_column_height': bracket_column_height,
-            'unassigned_teams': unassigned_teams,
-            'lowest_bye_seed': get_lowest_bye_seed(tournament_division),
+            'tournament': tournament_division.tournament,
+            'bracket': bracket_cache.get_bracket(tournament_division),
     }
     return render(request, 'tmdb/brackets.html', context)
 
-def get_lowest_bye_seed(tournament_division):
-    team_registrations = models.SparringTeamRegistration.objects.filter(
-            tournament_division=tournament_division)
-    team_matches = models.SparringTeamMatch.objects.filter(
-            division=tournament_division).order_by('-round_num')
-    if not team_matches:
-        return 1
-    max_round_num = team_matches[0].round_num
-    seeds = {tr.seed for tr in team_registrations if tr.seed}
-    max_seed = max(seeds)
-    for team_match in team_matches:
-        if team_match.round_num != max_round_num:
-            break
-        if team_match.blue_team:
-            seeds.remove(team_match.blue_team.seed)
-        if team_match.red_team:
-            seeds.remove(team_match.red_team.seed)
-    if not seeds:
-        return max_seed
-    return max(seeds)
-
 @permission_required("tmdb.add_sparringteammatch")
 def add_team_to_bracket(request, tournament_slug, division_slug):
     tournament_division = get_object_or_404(models.TournamentSparringDivision,
@@ -7,6 +7,7 @@ from django.urls import reverse
 from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib.auth import models as auth_models
 from django.contrib import messages
+from django.db.utils import IntegrityError
 
 from tmdb import forms
 from tmdb import models
@@ -31,9 +32,13 @@ def update_teammatch_status(request, tournament_slug, division_slug, match_num):
     if request.method == 'POST':
         team_match_form = forms.MatchForm(request.POST, instance=team_match)
         if team_match_form.is_valid():
-            team_match_form.save()
-            return HttpResponseRedirect(reverse("tmdb:match_list",
-                    args=(tournament_slug,)))
+            try:
+                team_match_form.save()
+            except IntegrityError as e:
+                team_match_form.add_error(None, str(e))
+            else:
+                return HttpResponseRedirect(reverse("tmdb:match_list",
+                        args=(tournament_slug,)))
     else:
         team_match_form = forms.MatchForm(instance=team_match)
         match_teams = []
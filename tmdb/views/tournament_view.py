@@ -2,20 +2,25 @@ import json
 
 from django.shortcuts import redirect, render, get_object_or_404
 from django.core import serializers
-from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden
+from django.core.exceptions import ValidationError
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden, JsonResponse
 from django.urls import reverse
 from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib.auth import models as auth_models
 from django.contrib import messages
+from django.utils.http import quote_etag
+from django.views.decorators.http import condition
 from django import forms
 
-from tmdb import models
+from tmdb import match_queue, models, tournament_snapshot
+from tmdb.tournament_snapshot import json_fields
 
 from collections import defaultdict, OrderedDict
 import datetime
 
 from tmdb.util.match_sheet import create_match_sheets
 from tmdb.util.bracket_svg import SvgBracket
+from tmdb.util.team_file_importer import TeamFileParseError
 
 class TournamentEditForm(forms.ModelForm):
     class Meta:
@@ -43,6 +48,15 @@ class TournamentImportForm(forms.ModelForm):
         model = models.Tournament
         fields = ['team_file']
 
+class TournamentUpdateTeamsForm(forms.ModelForm):
+    team_file = forms.FileField()
+    dry_run = forms.BooleanField(required=False, initial=True,
+            help_text="Only show the changes, do not apply them")
+
+    class Meta:
+        model = models.Tournament
+        fields = ['team_file', 'dry_run']
+
 def tournaments(request, tournament_slug=None):
     seasons = models.Season.objects.order_by('-start_date')
     tournaments_by_season = {}
@@ -118,6 +132,40 @@ def tournament_delete_teams(request, tournament_slug):
         context['delete_teams_form'] = delete_teams_form
     return render(request, template_name, context)
 
+@permission_required([
+        "tmdb.add_sparringteamregistration",
+        "tmdb.change_sparringteamregistration",
+        "tmdb.delete_sparringteamregistration",
+])
+def tournament_update_teams(request, tournament_slug):
+    instance = get_object_or_404(models.Tournament, slug=tournament_slug)
+    template_name = 'tmdb/tournament_update_teams.html'
+    context = {'tournament': instance}
+    if request.method == 'POST':
+        update_teams_form = TournamentUpdateTeamsForm(request.POST,
+                request.FILES, instance=instance)
+        if update_teams_form.is_valid():
+            dry_run = update_teams_form.cleaned_data['dry_run']
+            try:
+                registration_diff = instance.update_registration_data(
+                        request.FILES['team_file'], dry_run=dry_run)
+            except TeamFileParseError as e:
+                for error in e.errors:
+                    messages.error(request, error,
+                            extra_tags="alert alert-danger")
+            else:
+                if not dry_run:
+                    messages.success(request, "Updated teams: %s" %(
+                            registration_diff,),
+                            extra_tags="alert alert-success")
+                    return HttpResponseRedirect(reverse(
+                            'tmdb:tournament_change', args=(instance.slug,)))
+                context['registration_diff'] = registration_diff
+    else:
+        update_teams_form = TournamentUpdateTeamsForm(instance=instance)
+    context['update_teams_form'] = update_teams_form
+    return render(request, template_name, context)
+
 @permission_required("tmdb.delete_tournament")
 def tournament_delete(request, tournament_slug):
     instance = get_object_or_404(models.Tournament, slug=tournament_slug)
@@ -146,7 +194,14 @@ def tournament_import(request, tournament_slug):
         upload_form = TournamentImportForm(
                 request.POST, request.FILES, instance=instance)
         if upload_form.is_valid():
-            instance.import_registration_data(request.FILES['team_file'])
+            try:
+                instance.import_registration_data(request.FILES['team_file'])
+            except TeamFileParseError as e:
+                for error in e.errors:
+                    messages.error(request, error,
+                            extra_tags="alert alert-danger")
+                return HttpResponseRedirect(reverse('tmdb:tournament_change',
+                        args=(tournament_slug,)))
             return HttpResponseRedirect(reverse('tmdb:tournament_dashboard',
                     args=(tournament_slug,)))
     else:
@@ -157,8 +212,13 @@ def tournament_import(request, tournament_slug):
 def tournament_dashboard(request, tournament_slug):
     tournament = get_object_or_404(models.Tournament, slug=tournament_slug)
     tournament_divisions = models.TournamentSparringDivision.objects.filter(
-            tournament=tournament).order_by(
+            tournament=tournament).select_related(
+            'tournament', 'division').order_by(
             'division__sex', 'division__skill_level')
+    division_statuses = tournament.division_statuses()
+    for tournament_division in tournament_divisions:
+        tournament_division.division_status = division_statuses.get(
+                tournament_division.pk, models.TournamentSparringDivisionStatus())
 
     context = {
         'tournament': tournament,
@@ -166,64 +226,44 @@ def tournament_dashboard(request, tournament_slug):
     }
     return render(request, 'tmdb/tournament_dashboard.html', context)
 
-def model_to_json(query_set, fields):
-    obj_json = serializers.serialize('json', query_set, fields=fields)
-    return json.loads(obj_json)
-
-json_fields = {
-    'tournament': ('id', 'location', 'date',),
-    'division': ('id', 'sex', 'skill_level',),
-    'school': ('id', 'name',),
-    'team': ('id', 'division', 'school', 'number',),
-    'tournament_division': ('id', 'division', 'tournament',),
-    'school_tournament_registration': ('id', 'school_season_registration',
-                    'tournament',),
-    'school_season_registration': ('id', 'school',),
-    'team_registration': ('id', 'lightweight', 'middleweight', 'heavyweight',
-                    'alternate1', 'alternate2', 'team', 'tournament_division',
-                    'points', 'seed',),
-    'team_match': ('id', 'blue_team', 'red_team', 'winning_team', 'division',
-                    'in_holding', 'at_ring', 'number', 'ring_assignment_time',
-                    'ring_number', 'round_num', 'round_slot', 'competing',),
-}
+def tournament_json_etag(request, tournament_slug):
+    tournament_id = models.Tournament.objects.filter(
+            slug=tournament_slug).values_list('id', flat=True).first()
+    if tournament_id is None:
+        return None
+    return tournament_snapshot.get_etag(tournament_id,
+            tournament_snapshot.get_version(tournament_id))
 
+@condition(etag_func=tournament_json_etag)
 def tournament_json(request, tournament_slug):
-    msg = []
-    tournament = models.Tournament.objects.get(slug=tournament_slug)
-    msg.extend(model_to_json(
-            [tournament],
-            json_fields['tournament']))
-    msg.extend(model_to_json(
-            models.SparringDivision.objects.all(),
-            json_fields['division']))
-    msg.extend(model_to_json(
-            models.School.objects.all(),
-            json_fields['school']))
-    msg.extend(model_to_json(
-            models.SparringTeam.objects.all(),
-            json_fields['team']))
-    msg.extend(model_to_json(
-            models.TournamentSparringDivision.objects.filter(
-                    tournament=tournament),
-            json_fields['tournament_division']))
-    msg.extend(model_to_json(
-            models.SchoolTournamentRegistration.objects.filter(
-                    tournament=tournament),
-            json_fields['school_tournament_registration']))
-    msg.extend(model_to_json(
-            models.SchoolSeasonRegistration.objects.all(),
-            json_fields['school_season_registration']))
-    msg.extend(model_to_json(
-            models.SparringTeamRegistration.objects.filter(
-                    tournament_division__tournament=tournament),
-            json_fields['team_registration']))
-    msg.extend(model_to_json(
-            models.SparringTeamMatch.objects.filter(
-                    division__tournament=tournament),
-            json_fields['team_match']))
+    tournament = get_object_or_404(models.Tournament, slug=tournament_slug)
+    version, snapshot = tournament_snapshot.get_snapshot(tournament)
+    response = HttpResponse(snapshot, content_type="application/json")
+    response['ETag'] = quote_etag(tournament_snapshot.get_etag(
+            tournament.pk, version))
+    # the version the match list syncs the websocket from
+    response['X-Tournament-Version'] = version
+    # make browsers revalidate the snapshot with If-None-Match
+    response['Cache-Control'] = 'no-cache'
+    return response
 
-    msg_json = json.dumps(msg)
-    return HttpResponse(msg_json, content_type="application/json")
+def tournament_match_queue_json(request, tournament_slug):
+    """
+    The matches of the tournament that pass the ring, division, school and
+    status filters of the request, one page at a time: pass the returned
+    `next` cursor as `after` to get the next page.
+    """
+    tournament = get_object_or_404(models.Tournament, slug=tournament_slug)
+    try:
+        queue_filter = match_queue.MatchQueueFilter.from_params(request.GET)
+        limit = match_queue.parse_limit(request.GET.get('limit'))
+        version = tournament_snapshot.get_version(tournament.pk)
+        page = match_queue.get_page(tournament.pk, queue_filter,
+                after=request.GET.get('after'), limit=limit)
+    except ValidationError as e:
+        return JsonResponse({'error': " ".join(e.messages)}, status=400)
+    page['version'] = version
+    return JsonResponse(page)
 
 @login_required
 def tournament_school(request, tournament_slug, school_slug):